@@ -0,0 +1,123 @@
+"""Parse time and memory per detail page of MosRestScraper,
+full soup vs subtrees from MosRestScraper.parse_only, for each parser backend.
+
+    PYTHONPATH=src python benchmarks/parse_details.py --pages 200
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, Optional
+
+from bs4 import FeatureNotFound, SoupStrainer
+
+from src_rest.scrapying.scrapers import MosRestScraper
+from src_rest.scrapying.utils import make_soup
+
+
+def generate_page(i: int, n_reviews: int = 30, n_nav: int = 300) -> str:
+    """Synthetic detail page, shaped like moscow-restaurants.ru:
+    the data is a small part of a page full of navigation and scripts"""
+    nav = "".join(
+        f'<li class="menu-item"><a href="/restaurants/{j}/">Ресторан {j}</a></li>'
+        for j in range(n_nav)
+    )
+    scripts = "".join(
+        f'<script type="text/javascript">var counter{j} = {{"id": {j}}};</script>'
+        for j in range(20)
+    )
+    reviews = "".join(
+        f"""<div class="item-review"><div class="item-review-col_left">
+        <span class="author">Гость {j}</span></div>
+        <div class="item-review-col_right">
+        <div class="data-text">\r\n\tОтзыв {j}: {"очень вкусно и уютно " * 20}</div>
+        </div></div>"""
+        for j in range(n_reviews)
+    )
+    stars = "".join(
+        f'<div class="title">{title}</div><div class="stars">'
+        + '<i class="i-star orange"></i>' * (j % 5 + 1)
+        + "</div>"
+        for j, title in enumerate(["Кухня", "Интерьер", "Обслуживание"])
+    )
+    return f"""<!DOCTYPE html><html><head><title>Ресторан {i}</title>{scripts}</head>
+    <body><div class="header"><ul class="menu">{nav}</ul></div>
+    <div class="content">
+    <div class="col col_img"><script type="text/javascript">
+    myMap.geoObjects.add(new ymaps.Placemark([55.{i:04d}, 37.{i:04d}]));</script></div>
+    <div class="data">
+    <div class="row average_check">Средний чек: {1000 + i} руб.</div>
+    <meta itemprop="openingHours" content="Mo-Su 12:00-00:00">
+    <meta itemprop="streetAddress" content="ул. Тверская, д. {i}">
+    <meta itemprop="addressLocality" content="Москва">
+    </div>
+    <div class="rest_stats">{stars}</div>
+    {reviews}
+    </div><div class="footer"><ul>{nav}</ul></div></body></html>"""
+
+
+def parse(page: str, parser: str, parse_only: Optional[SoupStrainer]) -> dict:
+    # parse_data does not use the scraper state
+    parse_data: Callable = MosRestScraper.parse_data
+    return parse_data(None, make_soup(page, parser, parse_only))
+
+
+def measure(
+    pages: List[str], parser: str, parse_only: Optional[SoupStrainer]
+) -> Dict[str, Any]:
+    times = []
+    results = []
+    for page in pages:
+        start = time.perf_counter()
+        results.append(parse(page, parser, parse_only))
+        times.append(time.perf_counter() - start)
+
+    # Memory is traced in a separate pass, tracing slows parsing down
+    peaks = []
+    for page in pages:
+        tracemalloc.start()
+        parse(page, parser, parse_only)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "ms": statistics.mean(times) * 1000,
+        "kb": statistics.mean(peaks) / 1024,
+        "results": results,
+    }
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("--pages", default=100, type=int)
+    argparser.add_argument(
+        "--parsers", default=["html.parser", "lxml", "html5lib"], nargs="+"
+    )
+    args = argparser.parse_args()
+
+    pages = [generate_page(i) for i in range(args.pages)]
+    size = statistics.mean(map(len, pages)) / 1024
+    print(f"{args.pages} pages, {size:.0f} KB of html per page")
+    print(f"{'parser':<12} {'subtrees':<9} {'ms/page':>8} {'peak KB/page':>13}")
+
+    expected = None
+    for parser in args.parsers:
+        for parse_only in (None, MosRestScraper.parse_only):
+            try:
+                result = measure(pages, parser, parse_only)
+            except FeatureNotFound:
+                print(f"{parser:<12} not installed")
+                break
+            if expected is None:
+                expected = result["results"]
+            elif result["results"] != expected:
+                raise ValueError(f"{parser} parsed data differs from html.parser")
+            strained = "yes" if parse_only is not None else "no"
+            print(
+                f"{parser:<12} {strained:<9} {result['ms']:>8.2f} {result['kb']:>13.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
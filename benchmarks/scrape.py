@@ -0,0 +1,356 @@
+"""Throughput, latency and memory of MosRestCrawler and MosRestScraper against
+a local stand-in of moscow-restaurants.ru, for each backend and concurrency level.
+
+The server adds latency and errors to generated listing and detail pages.
+Every run is a separate process, so that its peak RSS is its own,
+and its results are appended to a json lines file to compare engines.
+RSS of worker processes is sampled from /proc and summed, so it is Linux only.
+
+    PYTHONPATH=src python benchmarks/scrape.py --pages 500 --latency 0.05 \\
+        --error_rate 0.02 --n_jobs 1 10 50 --output scrape_results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from functools import lru_cache
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+from parse_details import generate_page
+
+from src_rest.scrapying.cache import open_cache
+from src_rest.scrapying.scrapers import MosRestCrawler, MosRestScraper
+
+CARDS_PER_PAGE = 20
+
+
+def listing_link(page: int) -> str:
+    return "/restaurants/" if page == 0 else f"/restaurants/?curPos={page * 20}"
+
+
+def generate_listing(page: int, n_pages: int) -> str:
+    """Listing page with restaurant cards and links to every listing page"""
+    cards = "".join(
+        f'<li><span class="vcard"><a href="/restaurants/{j}/">Ресторан {j}</a>'
+        "</span></li>"
+        for j in range(page * CARDS_PER_PAGE, (page + 1) * CARDS_PER_PAGE)
+    )
+    links = "".join(
+        f'<li><a href="{listing_link(k)}">{k + 1}</a></li>' for k in range(n_pages)
+    )
+    return f"""<!DOCTYPE html><html><head><title>Рестораны</title></head>
+    <body><div class="content">
+    <ul class="l-restaurants clearfix">{cards}</ul>
+    <div class="restaurants_rating clearfix"><ul class="l-links clearfix">{links}</ul>
+    </div></div></body></html>"""
+
+
+@lru_cache(maxsize=None)
+def generate_detail(i: int, page_kb: int) -> str:
+    """Detail page, padded with navigation to about page_kb kilobytes"""
+    page = generate_page(i, n_nav=0)
+    item = len(generate_page(i, n_nav=1)) - len(page)
+    return generate_page(i, n_nav=max(0, (page_kb * 1024 - len(page)) // item))
+
+
+class StandInServer:
+    """aiohttp server on its own thread and event loop"""
+
+    def __init__(
+        self, n_pages: int, latency: float, error_rate: float, page_kb: int
+    ) -> None:
+        self.n_pages = n_pages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_kb = page_kb
+        self.random = random.Random(0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def respond(self, text: str) -> web.Response:
+        # Uniform around the mean latency
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.error_rate:
+            return web.Response(status=503, text="Service Unavailable")
+        return web.Response(text=text, content_type="text/html")
+
+    async def listing(self, request: web.Request) -> web.Response:
+        page = int(request.query.get("curPos", 0)) // 20
+        return await self.respond(generate_listing(page, self.n_pages))
+
+    async def detail(self, request: web.Request) -> web.Response:
+        i = int(request.match_info["i"])
+        return await self.respond(generate_detail(i, self.page_kb))
+
+    async def start_app(self) -> None:
+        app = web.Application()
+        app.router.add_get("/restaurants/", self.listing)
+        app.router.add_get("/restaurants/{i}/", self.detail)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def __enter__(self) -> "StandInServer":
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start_app(), self.loop).result()
+        return self
+
+    def __exit__(self, *args) -> None:
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+def quantile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class RssSampler:
+    """Peak RSS of this process and of its descendant processes, summed,
+    sampled on a thread every interval seconds"""
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak_total = 0
+        self.peak_workers = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def descendants(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", "r") as file:
+                    # Command name in parentheses may contain spaces
+                    ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+
+        pids = []
+        stack = [os.getpid()]
+        while stack:
+            for child in children.get(stack.pop(), []):
+                pids.append(child)
+                stack.append(child)
+        return pids
+
+    def rss(self, pid: int) -> int:
+        try:
+            with open(f"/proc/{pid}/statm", "r") as file:
+                return int(file.read().split()[1]) * self.page_size
+        except OSError:
+            # Worker exited between listing and reading
+            return 0
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            workers = sum(self.rss(pid) for pid in self.descendants())
+            self.peak_workers = max(self.peak_workers, workers)
+            self.peak_total = max(self.peak_total, self.rss(os.getpid()) + workers)
+
+    def __enter__(self) -> "RssSampler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+def run(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs one scraper configuration in this process"""
+    output = tempfile.mkdtemp(prefix="scrape_bench_")
+    common = dict(
+        output=output,
+        cache=False,
+        backoff=config["backoff"],
+        timeout=config["timeout"],
+        progress_interval=3600,
+    )
+    try:
+        if config["scraper"] == "crawler":
+            scraper = MosRestCrawler(
+                link=config["url"] + listing_link(0),
+                frontier=config["backend"] == "frontier",
+                n_jobs=config["n_jobs"],
+                **common,
+            )
+        else:
+            links = [
+                f"{config['url']}/restaurants/{i}/" for i in range(config["pages"])
+            ]
+            scraper = MosRestScraper(
+                links=links,
+                backend=config["backend"],
+                n_jobs=config["n_jobs"],
+                **common,
+            )
+
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            scraper.load_data()
+            seconds = time.perf_counter() - start
+
+        # Latency from the elapsed of every stored response
+        records = [record for _, record in open_cache(output).items()]
+        elapsed = [record["elapsed"] for record in records]
+    finally:
+        shutil.rmtree(output)
+
+    # RUSAGE_CHILDREN would only hold the largest worker, which was waited for,
+    # so workers of loky and pipeline engines are sampled and summed instead.
+    # ru_maxrss is in kilobytes on Linux
+    main_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        **config,
+        "pages_done": len(records),
+        "not_ok": sum(not record["ok"] for record in records),
+        "seconds": seconds,
+        "pages_per_second": len(records) / seconds,
+        "p50_ms": quantile(elapsed, 0.5) * 1000,
+        "p99_ms": quantile(elapsed, 0.99) * 1000,
+        "main_peak_rss_mb": main_rss / 2 ** 20,
+        "workers_peak_rss_mb": sampler.peak_workers / 2 ** 20,
+        "total_peak_rss_mb": max(main_rss, sampler.peak_total) / 2 ** 20,
+    }
+
+
+def configurations(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    configs = []
+    for scraper in args.scrapers:
+        backends = args.crawler_backends if scraper == "crawler" else args.backends
+        for backend in backends:
+            # The sequential crawler fetches one page at a time
+            n_jobs_list = [1] if backend == "sequential" else args.n_jobs
+            for n_jobs in n_jobs_list:
+                configs.append(
+                    {"scraper": scraper, "backend": backend, "n_jobs": n_jobs}
+                )
+    return configs
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument("--pages", default=200, type=int, help="Detail pages")
+    argparser.add_argument(
+        "--latency", default=0.05, type=float, help="Mean response latency, seconds"
+    )
+    argparser.add_argument(
+        "--error_rate", default=0.0, type=float, help="Share of 503 responses"
+    )
+    argparser.add_argument(
+        "--page_kb", default=60, type=int, help="Size of detail pages, KB"
+    )
+    argparser.add_argument(
+        "--scrapers",
+        default=["crawler", "scraper"],
+        nargs="+",
+        choices=["crawler", "scraper"],
+    )
+    argparser.add_argument(
+        "--backends",
+        default=["threading", "loky", "asyncio", "pipeline"],
+        nargs="+",
+        help="Backends of MosRestScraper",
+    )
+    argparser.add_argument(
+        "--crawler_backends",
+        default=["sequential", "frontier"],
+        nargs="+",
+        choices=["sequential", "frontier"],
+    )
+    argparser.add_argument("--n_jobs", default=[1, 10, 50], type=int, nargs="+")
+    argparser.add_argument("--backoff", default=0.05, type=float)
+    argparser.add_argument("--timeout", default=30, type=int)
+    argparser.add_argument(
+        "--output", default="scrape_results.jsonl", help="Results are appended here"
+    )
+    argparser.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.run is not None:
+        with open(args.run, "r", encoding="utf-8") as file:
+            config = json.load(file)
+        result = run(config)
+        with open(args.run, "w", encoding="utf-8") as file:
+            json.dump(result, file)
+        return
+
+    n_listing = -(-args.pages // CARDS_PER_PAGE)
+    print(
+        f"{args.pages} detail pages of {args.page_kb} KB, {n_listing} listing pages, "
+        f"latency {args.latency * 1000:.0f} ms, error rate {args.error_rate:.0%}"
+    )
+    print(
+        f"{'scraper':<8} {'backend':<11} {'n_jobs':>6} {'pages':>6} {'pages/s':>8} "
+        f"{'p50 ms':>7} {'p99 ms':>7} "
+        f"{'main RSS MB':>11} {'workers RSS MB':>14} {'total RSS MB':>12}"
+    )
+
+    server = StandInServer(n_listing, args.latency, args.error_rate, args.page_kb)
+    with server:
+        for config in configurations(args):
+            config.update(
+                url=server.url,
+                pages=args.pages,
+                latency=args.latency,
+                error_rate=args.error_rate,
+                page_kb=args.page_kb,
+                backoff=args.backoff,
+                timeout=args.timeout,
+                dttm=time.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+            fd, path = tempfile.mkstemp(suffix=".json")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as file:
+                    json.dump(config, file)
+                subprocess.run(
+                    [sys.executable, __file__, "--run", path],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+                with open(path, "r", encoding="utf-8") as file:
+                    result = json.load(file)
+            finally:
+                os.remove(path)
+
+            with open(args.output, "a", encoding="utf-8") as file:
+                file.write(json.dumps(result) + "\n")
+            print(
+                f"{result['scraper']:<8} {result['backend']:<11} "
+                f"{result['n_jobs']:>6} {result['pages_done']:>6} "
+                f"{result['pages_per_second']:>8.1f} {result['p50_ms']:>7.1f} "
+                f"{result['p99_ms']:>7.1f} {result['main_peak_rss_mb']:>11.0f} "
+                f"{result['workers_peak_rss_mb']:>14.0f} "
+                f"{result['total_peak_rss_mb']:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+
+from collections import deque
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Deque,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from aiohttp import (
+    ClientError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+from src_rest.api.utils import (
+    AdaptiveRateLimiter,
+    get_query_params,
+    parse_retry_after,
+)
+
+
+def get_query_async(
+    session: ClientSession, query: str, **kwargs
+) -> AsyncContextManager[ClientResponse]:
+    query = query.format(**kwargs)
+    return session.get(query)
+
+
+class AsyncMosApi:
+    """Asyncio Mos api instance, to be used as an async context manager"""
+
+    def __init__(
+        self,
+        api_key: str,
+        n_retries: int = 10,
+        backoff: float = 1,
+        limit: int = 10,
+        timeout: float = 60,
+        host: str = "https://apidata.mos.ru",
+        status_forcelist: list = [429, 500, 502, 503, 504],
+        rate: Optional[float] = None,
+    ) -> None:
+        api_string = f"&api_key={api_key}"
+        object_string = host + "/v1/{object_type}/{object_id}"
+        base_query = "/rows?$skip={skip}&$top={top}{params}"
+        self.query = object_string + base_query + api_string
+        self.count_query = object_string + "/count?{params}" + api_string
+        self.n_retries = n_retries
+        self.backoff = backoff
+        self.limit = limit
+        self.timeout = timeout
+        self.status_forcelist = status_forcelist
+        self.session: Optional[ClientSession] = None
+        self.limiter = AdaptiveRateLimiter(rate) if rate is not None else None
+
+    async def open(self) -> None:
+        if self.session is None:
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.limit),
+                timeout=ClientTimeout(total=self.timeout),
+            )
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self) -> "AsyncMosApi":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def get_response_text(self, query: str, **kwargs) -> str:
+        if self.session is None:
+            raise RuntimeError("AsyncMosApi session is not opened")
+
+        for attempt in range(self.n_retries + 1):
+            last_attempt = attempt == self.n_retries
+            retry_after = None
+            paused = False
+            if self.limiter is not None:
+                await asyncio.sleep(self.limiter.reserve())
+            try:
+                async with get_query_async(self.session, query, **kwargs) as response:
+                    text = await response.text()
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if self.limiter is not None:
+                        if response.status in (429, 503):
+                            self.limiter.on_throttle(retry_after)
+                            # The limiter pauses this and every other request
+                            paused = retry_after is not None
+                        elif response.ok:
+                            self.limiter.on_success()
+
+                    if response.ok:
+                        return text
+                    elif last_attempt or response.status not in self.status_forcelist:
+                        raise ValueError(
+                            f"Response not ok.\nText: {text}\nReason:{response.reason}"
+                        )
+            except (ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            if retry_after is None:
+                await asyncio.sleep(self.backoff * 2**attempt)
+            elif not paused:
+                await asyncio.sleep(retry_after)
+
+        raise RuntimeError("Unreachable")
+
+    async def get(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        skip: int,
+        top: int,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
+    ) -> Union[list, dict]:
+        text = await self.get_response_text(
+            self.query,
+            object_type=object_type,
+            object_id=object_id,
+            skip=skip,
+            top=top,
+            params=get_query_params(columns, filter),
+        )
+        return json.loads(text)
+
+    async def count(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        filter: Optional[str] = None,
+    ) -> int:
+        text = await self.get_response_text(
+            self.count_query,
+            object_type=object_type,
+            object_id=object_id,
+            params=get_query_params(None, filter),
+        )
+        return int(text)
+
+
+class AsyncMosDataset:
+    def __init__(
+        self,
+        api: AsyncMosApi,
+        dataset_id: Union[str, int],
+        step: int = 1000,
+        n_jobs: int = 10,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
+    ) -> None:
+        self.api = api
+        self.step = step
+        self.dataset_id = dataset_id
+        self.object_type = "datasets"
+        self.n_jobs = n_jobs
+        self.columns = columns
+        self.filter = filter
+
+    async def get_page(self, i: int) -> Union[list, dict]:
+        return await self.api.get(
+            object_type=self.object_type,
+            object_id=self.dataset_id,
+            skip=i * self.step,
+            top=self.step,
+            columns=self.columns,
+            filter=self.filter,
+        )
+
+    async def load_indexed(self) -> AsyncIterator[Tuple[int, Union[list, dict]]]:
+        full_count = await self.api.count(
+            self.object_type, self.dataset_id, self.filter
+        )
+        n_pages = max(1, -(-full_count // self.step))
+        pending: Deque[Tuple[int, asyncio.Task]] = deque()
+        next_page = 0
+
+        def schedule() -> None:
+            nonlocal next_page
+            while len(pending) < self.n_jobs and next_page < n_pages:
+                task = asyncio.ensure_future(self.get_page(next_page))
+                pending.append((next_page, task))
+                next_page += 1
+
+        try:
+            schedule()
+            while pending:
+                i, task = pending.popleft()
+                result = await task
+                print(f"Request {i}: {(i + 1) * self.step} / {full_count}")
+                yield i, result
+
+                # Count may be stale if the dataset grew after the count request
+                if next_page == n_pages and not pending and len(result) == self.step:
+                    n_pages += 1
+                schedule()
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def load(self) -> AsyncIterator[Union[list, dict]]:
+        async for _, result in self.load_indexed():
+            yield result
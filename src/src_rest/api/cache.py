@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Iterable, Iterator, Mapping, Optional
+
+CHUNK_SIZE = 1 << 16
+
+
+class ResponseCache:
+    """On-disk cache of api response bodies, revalidated with ETag / Last-Modified
+    after ttl seconds and evicted least recently used first above max_size bytes.
+    Metadata of the entries is kept in memory in the order of use, so that a hit
+    only reads the body; used_at is written to disk on store and revalidation"""
+
+    def __init__(
+        self, path: str, ttl: float = 0, max_size: Optional[int] = None
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        entries = sorted(self.read_entries().items(), key=lambda x: x[1]["used_at"])
+        self.index: "OrderedDict[str, dict]" = OrderedDict(entries)
+        self.size = sum(meta["size"] for meta in self.index.values())
+        self.remove_orphans()
+
+    def key(self, request: str) -> str:
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def meta_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def body_path(self, key: str, meta: dict) -> str:
+        return os.path.join(self.path, meta.get("body", f"{key}.body"))
+
+    def read_entries(self) -> Dict[str, dict]:
+        result = {}
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                key = name[: -len(".json")]
+                try:
+                    with open(self.meta_path(key), "r", encoding="utf-8") as file:
+                        meta = json.load(file)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+                if os.path.exists(self.body_path(key, meta)):
+                    result[key] = meta
+        return result
+
+    def remove_orphans(self) -> None:
+        """Removes bodies and temporary files left by interrupted stores"""
+        bodies = {
+            os.path.basename(self.body_path(key, meta))
+            for key, meta in self.index.items()
+        }
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp") or name.endswith(".body") and name not in bodies:
+                self._remove_file(os.path.join(self.path, name))
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, key: str) -> Optional[dict]:
+        with self.lock:
+            return self.index.get(key)
+
+    def entries(self) -> Dict[str, dict]:
+        with self.lock:
+            return dict(self.index)
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time.time() - meta["stored_at"] < self.ttl
+
+    def conditional_headers(self, meta: dict) -> Dict[str, str]:
+        headers = {}
+        if meta.get("etag") is not None:
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified") is not None:
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        os.replace(tmp, self.meta_path(key))
+
+    def open_body(self, key: str, meta: dict) -> Optional[BinaryIO]:
+        """Body of the entry, None if it was evicted meanwhile.
+        An opened body stays readable after it is evicted"""
+        try:
+            return open(self.body_path(key, meta), "rb")
+        except FileNotFoundError:
+            return None
+
+    def iter_body(self, body: BinaryIO) -> Iterator[bytes]:
+        for block in iter(lambda: body.read(CHUNK_SIZE), b""):
+            yield block
+
+    def revalidated(self, key: str, meta: dict) -> None:
+        meta = dict(meta, stored_at=time.time(), used_at=time.time())
+        # Meta files are written and removed under the lock, along with the index
+        with self.lock:
+            if self.index.get(key, {}).get("body") == meta.get("body"):
+                self._write_meta(key, meta)
+                self.index[key] = meta
+                self.index.move_to_end(key)
+
+    def used(self, key: str, meta: dict) -> None:
+        with self.lock:
+            if key in self.index:
+                self.index[key] = dict(self.index[key], used_at=time.time())
+                self.index.move_to_end(key)
+
+    def store(
+        self, key: str, headers: Mapping[str, str], chunks: Iterable[bytes]
+    ) -> Iterator[bytes]:
+        """Passes chunks through, saving them to the cache once all are consumed"""
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        size = 0
+        # Every stored body gets a new file, which the meta written after it
+        # points to, so that a meta is never paired with another body
+        body = f"{key}.{uuid.uuid4().hex}.body"
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.replace(tmp, os.path.join(self.path, body))
+        finally:
+            self._remove_file(tmp)
+
+        now = time.time()
+        meta = {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "stored_at": now,
+            "used_at": now,
+            "size": size,
+            "body": body,
+        }
+        with self.lock:
+            self._write_meta(key, meta)
+            previous = self.index.pop(key, None)
+            self.index[key] = meta
+            self.size += size - (previous["size"] if previous is not None else 0)
+        if previous is not None:
+            self._remove_file(self.body_path(key, previous))
+        self.evict()
+
+    def _pop(self, key: str) -> dict:
+        meta = self.index.pop(key)
+        self.size -= meta["size"]
+        self._remove_file(self.meta_path(key))
+        return meta
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            if key not in self.index:
+                return
+            meta = self._pop(key)
+        self._remove_file(self.body_path(key, meta))
+
+    def evict(self) -> None:
+        if self.max_size is None:
+            return
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.index:
+                    return
+                key = next(iter(self.index))
+                meta = self._pop(key)
+            self._remove_file(self.body_path(key, meta))
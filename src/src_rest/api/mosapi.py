@@ -1,10 +1,37 @@
+import io
 import json
+import time
 
-from typing import Union
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from requests import Response, Session
 from requests.adapters import HTTPAdapter, Retry
 
-from src_rest.api.utils import get_query
+from src_rest.api.cache import ResponseCache
+from src_rest.api.utils import (
+    AdaptiveRateLimiter,
+    get_query,
+    get_query_params,
+    iter_json_array,
+    parse_retry_after,
+)
+
+CHUNK_SIZE = 1 << 16
+
+
+def write_through(chunks: Iterable[bytes], file: BinaryIO) -> Iterator[bytes]:
+    for chunk in chunks:
+        file.write(chunk)
+        yield chunk
 
 
 class MosApi:
@@ -12,12 +39,15 @@ class MosApi:
 
     def __init__(
         self, api_key: str, n_retries: int = 10, backoff: int = 1,
+        pool_size: int = 10, host: str = "https://apidata.mos.ru",
+        rate: Optional[float] = None, cache: Optional[ResponseCache] = None,
     ) -> None:
         api_string = f"&api_key={api_key}"
-        object_string = "https://apidata.mos.ru/v1/{object_type}/{object_id}"
-        base_query = "/rows?$skip={skip}&$top={top}"
+        self.api_string = api_string
+        object_string = host + "/v1/{object_type}/{object_id}"
+        base_query = "/rows?$skip={skip}&$top={top}{params}"
         self.query = object_string + base_query + api_string
-        self.count_query = object_string + "/count?" + api_string
+        self.count_query = object_string + "/count?{params}" + api_string
         self.n_retries = n_retries
         self.backoff = backoff
         session = Session()
@@ -27,50 +57,208 @@ class MosApi:
             status_forcelist=[500, 502, 503, 504],
             raise_on_status=False,
         )
-        session.mount("https://", HTTPAdapter(max_retries=retries))
+        session.mount(
+            "https://", HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
+        )
         self.session = session
+        self.limiter = AdaptiveRateLimiter(rate) if rate is not None else None
+        self.cache = cache
 
-    def get_response_text(self, response: Response) -> str:
+    def request(
+        self,
+        query: str,
+        stream: bool = False,
+        headers: Optional[Dict[str, str]] = None,
+        **kwargs,
+    ) -> Response:
+        # 5xx are retried by the adapter, 429 is handled here to slow down
+        # every request made through this instance, not only the failed one
+        for attempt in range(self.n_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            response = get_query(
+                self.session, query, stream=stream, headers=headers, **kwargs
+            )
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if self.limiter is not None:
+                if response.status_code in (429, 503):
+                    self.limiter.on_throttle(retry_after)
+                elif response.ok:
+                    self.limiter.on_success()
+
+            if response.status_code != 429 or attempt == self.n_retries:
+                break
+            response.close()
+            if self.limiter is None:
+                if retry_after is None:
+                    retry_after = self.backoff * 2**attempt
+                time.sleep(retry_after)
+        return response
+
+    def check_response(self, response: Response) -> Response:
         if response.ok:
-            return response.text
+            return response
         else:
             raise ValueError(
                 f"Response not ok.\nText: {response.text}\nReason:{response.reason}"
             )
 
+    def get_response_text(self, response: Response) -> str:
+        return self.check_response(response).text
+
+    def iter_content(self, query: str, **kwargs) -> Iterator[bytes]:
+        """Response body in chunks, served from the cache if it is fresh
+        or revalidated by the server with 304"""
+        if self.cache is None:
+            with self.check_response(self.request(query, stream=True, **kwargs)) as r:
+                yield from r.iter_content(CHUNK_SIZE)
+            return
+
+        # Api key is not a part of the cache key, so it can be rotated
+        key = self.cache.key(query.format(**kwargs).replace(self.api_string, ""))
+        meta = self.cache.lookup(key)
+        # Opened up front, so that eviction by another thread does not remove it
+        body = self.cache.open_body(key, meta) if meta is not None else None
+        if body is None:
+            meta = None
+        try:
+            if meta is not None and body is not None and self.cache.is_fresh(meta):
+                self.cache.used(key, meta)
+                yield from self.cache.iter_body(body)
+                return
+
+            headers = self.cache.conditional_headers(meta) if meta is not None else None
+            response = self.request(query, stream=True, headers=headers, **kwargs)
+            if response.status_code == 304 and meta is not None and body is not None:
+                response.close()
+                self.cache.revalidated(key, meta)
+                yield from self.cache.iter_body(body)
+                return
+
+            with self.check_response(response):
+                yield from self.cache.store(
+                    key, response.headers, response.iter_content(CHUNK_SIZE)
+                )
+        finally:
+            if body is not None:
+                body.close()
+
     def get(
-        self, object_type: str, object_id: Union[str, int], skip: int, top: int
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        skip: int,
+        top: int,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
     ) -> Union[list, dict]:
 
-        response = get_query(
-            self.session,
+        content = self.iter_content(
+            self.query,
+            object_type=object_type,
+            object_id=object_id,
+            skip=skip,
+            top=top,
+            params=get_query_params(columns, filter),
+        )
+        # Bytes are parsed directly, without decoding them into a str first
+        return json.loads(b"".join(content))
+
+    def get_content(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        skip: int,
+        top: int,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
+    ) -> Tuple[bytes, int]:
+        """Raw page body and its number of rows, counted as it is downloaded"""
+        content = self.iter_content(
             self.query,
             object_type=object_type,
             object_id=object_id,
             skip=skip,
             top=top,
+            params=get_query_params(columns, filter),
         )
-        text = self.get_response_text(response)
-        return json.loads(text)
+        buffer = io.BytesIO()
+        rows = sum(1 for _ in iter_json_array(write_through(content, buffer)))
+        return buffer.getvalue(), rows
 
-    def count(self, object_type: str, object_id: Union[str, int]) -> int:
-        response = get_query(
-            self.session,
+    def iter_rows(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        skip: int,
+        top: int,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
+    ) -> Iterator[Any]:
+        """Rows of the page parsed one by one, while the page is being downloaded"""
+        content = self.iter_content(
+            self.query,
+            object_type=object_type,
+            object_id=object_id,
+            skip=skip,
+            top=top,
+            params=get_query_params(columns, filter),
+        )
+        yield from iter_json_array(content)
+
+    def dump(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        skip: int,
+        top: int,
+        filename: str,
+        columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
+    ) -> int:
+        """Writes raw page to filename as it is downloaded, returns number of rows"""
+        content = self.iter_content(
+            self.query,
+            object_type=object_type,
+            object_id=object_id,
+            skip=skip,
+            top=top,
+            params=get_query_params(columns, filter),
+        )
+        rows = 0
+        with open(filename, "wb") as file:
+            for _ in iter_json_array(write_through(content, file)):
+                rows += 1
+        return rows
+
+    def count(
+        self,
+        object_type: str,
+        object_id: Union[str, int],
+        filter: Optional[str] = None,
+    ) -> int:
+        content = self.iter_content(
             self.count_query,
             object_type=object_type,
             object_id=object_id,
+            params=get_query_params(None, filter),
         )
+        return int(b"".join(content))
 
-        text = self.get_response_text(response)
-        return int(text)
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Collection, Deque, Tuple, TypeVar
+
+PAGE = TypeVar("PAGE")
 
-import time
 
 class MosDataset:
 
     def __init__(
         self, api: MosApi, dataset_id: Union[str, int], step: int = 1000,
-        sleep: int=3,
+        sleep: float = 0, n_jobs: int = 1, columns: Optional[List[str]] = None,
+        filter: Optional[str] = None,
     ) -> None:
 
         self.api = api
@@ -78,23 +266,247 @@ class MosDataset:
         self.dataset_id = dataset_id
         self.object_type = "datasets"
         self.sleep = sleep
+        self.n_jobs = n_jobs
+        self.columns = columns
+        self.filter = filter
 
-    def load(self):
-        full_count = self.api.count(self.object_type, self.dataset_id)
-        i = 0
-        while True:
+    def get_page(self, i: int) -> Union[list, dict]:
+        if self.sleep:
             time.sleep(self.sleep)
-            print(f"Request {i}: {(i + 1) * self.step} / {full_count}")
-            result = self.api.get(
+        return self.api.get(
+            object_type=self.object_type,
+            object_id=self.dataset_id,
+            skip=i * self.step,
+            top=self.step,
+            columns=self.columns,
+            filter=self.filter,
+        )
+
+    def get_page_content(self, i: int) -> Tuple[bytes, int]:
+        if self.sleep:
+            time.sleep(self.sleep)
+        return self.api.get_content(
+            object_type=self.object_type,
+            object_id=self.dataset_id,
+            skip=i * self.step,
+            top=self.step,
+            columns=self.columns,
+            filter=self.filter,
+        )
+
+    def dump_page(
+        self,
+        i: int,
+        filename: str,
+        write: Optional[Callable[[str, Iterator[Any]], int]] = None,
+    ) -> int:
+        """Writes page to filename, raw or with write(filename, rows) if given"""
+        if self.sleep:
+            time.sleep(self.sleep)
+        if write is not None:
+            rows = self.api.iter_rows(
                 object_type=self.object_type,
                 object_id=self.dataset_id,
                 skip=i * self.step,
                 top=self.step,
+                columns=self.columns,
+                filter=self.filter,
             )
+            return write(filename, rows)
+        return self.api.dump(
+            object_type=self.object_type,
+            object_id=self.dataset_id,
+            skip=i * self.step,
+            top=self.step,
+            filename=filename,
+            columns=self.columns,
+            filter=self.filter,
+        )
 
-            yield result
+    def _load_sequential(
+        self,
+        fetch: Callable[[int], PAGE],
+        size: Callable[[PAGE], int],
+        full_count: int,
+        start: int = 0,
+        exclude: Collection[int] = (),
+        limit: Optional[int] = None,
+    ) -> Iterator[Tuple[int, PAGE]]:
+        i = start
+        while limit is None or i < limit:
+            if i in exclude:
+                # Page is already loaded, so rely on the count to stop
+                if (i + 1) * self.step >= full_count:
+                    break
+                i += 1
+                continue
 
-            if len(result) < self.step:
+            print(f"Request {i}: {(i + 1) * self.step} / {full_count}")
+            result = fetch(i)
+
+            yield i, result
+
+            if size(result) < self.step:
                 break
             i += 1
-            
+
+    def _load_concurrent(
+        self,
+        fetch: Callable[[int], PAGE],
+        size: Callable[[PAGE], int],
+        full_count: int,
+        exclude: Collection[int] = (),
+        limit: Optional[int] = None,
+    ) -> Iterator[Tuple[int, PAGE]]:
+        n_pages = max(1, -(-full_count // self.step))
+        if limit is not None:
+            n_pages = min(n_pages, limit)
+        pages = (i for i in range(n_pages) if i not in exclude)
+        pending: Deque[Tuple[int, Future]] = deque()
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            try:
+                # Keep at most 2 * n_jobs pages in flight, so a slow page
+                # does not make the finished ones pile up in memory
+                for i in islice(pages, 2 * self.n_jobs):
+                    pending.append((i, executor.submit(fetch, i)))
+
+                i = -1
+                while pending:
+                    i, future = pending.popleft()
+                    result = future.result()
+                    print(f"Request {i}: {(i + 1) * self.step} / {full_count}")
+                    yield i, result
+
+                    for j in islice(pages, 1):
+                        pending.append((j, executor.submit(fetch, j)))
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+        # Count may be stale if the dataset grew after the count request
+        if i == n_pages - 1 and size(result) == self.step and n_pages != limit:
+            yield from self._load_sequential(
+                fetch, size, full_count, n_pages, exclude, limit
+            )
+
+    def _load(
+        self,
+        fetch: Callable[[int], PAGE],
+        size: Callable[[PAGE], int],
+        exclude: Collection[int],
+        limit: Optional[int] = None,
+    ) -> Iterator[Tuple[int, PAGE]]:
+        full_count = self.api.count(self.object_type, self.dataset_id, self.filter)
+        if self.n_jobs > 1:
+            return self._load_concurrent(fetch, size, full_count, exclude, limit)
+        else:
+            return self._load_sequential(
+                fetch, size, full_count, exclude=exclude, limit=limit
+            )
+
+    def load_indexed(
+        self, exclude: Collection[int] = (), limit: Optional[int] = None
+    ) -> Iterator[Tuple[int, Union[list, dict]]]:
+        """Yields (page number, rows) of at most the first limit pages,
+        skipping pages from exclude"""
+        return self._load(self.get_page, len, exclude, limit)
+
+    def dump(
+        self,
+        filename: Callable[[int], str],
+        exclude: Collection[int] = (),
+        write: Optional[Callable[[str, Iterator[Any]], int]] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[Tuple[int, int]]:
+        """Streams pages to filename(page number) without parsing them into memory,
+        or with write(filename, rows) if given.
+        Yields (page number, number of rows) of at most the first limit pages,
+        skipping pages from exclude"""
+        return self._load(
+            lambda i: self.dump_page(i, filename(i), write), int, exclude, limit
+        )
+
+    def load_content(
+        self, exclude: Collection[int] = (), limit: Optional[int] = None
+    ) -> Iterator[Tuple[int, Tuple[bytes, int]]]:
+        """Yields (page number, (raw page, number of rows)) of at most the first
+        limit pages, skipping pages from exclude"""
+        return self._load(self.get_page_content, lambda x: x[1], exclude, limit)
+
+    def load(self) -> Iterator[Union[list, dict]]:
+        for _, result in self.load_indexed():
+            yield result
+
+
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Mapping, Set
+
+
+def dump_many(
+    datasets: List[MosDataset],
+    filename: Callable[[MosDataset, int], str],
+    exclude: Optional[Mapping[Union[str, int], Collection[int]]] = None,
+    n_jobs: int = 10,
+    write: Optional[Callable[[str, Iterator[Any]], int]] = None,
+    limit: Optional[int] = None,
+) -> Iterator[Tuple[MosDataset, int, int]]:
+    """Streams pages of several datasets to filename(dataset, page number)
+    with one pool of n_jobs workers, taking pages from datasets in turn,
+    at most the first limit pages of each dataset.
+    Yields (dataset, page number, number of rows) as pages complete"""
+    exclude = exclude if exclude is not None else {}
+    queues: Dict[int, Deque[int]] = {}
+    n_pages: Dict[int, int] = {}
+    for n, ds in enumerate(datasets):
+        full_count = ds.api.count(ds.object_type, ds.dataset_id, ds.filter)
+        n_pages[n] = max(1, -(-full_count // ds.step))
+        if limit is not None:
+            n_pages[n] = min(n_pages[n], limit)
+        skip = exclude.get(ds.dataset_id, ())
+        queues[n] = deque(i for i in range(n_pages[n]) if i not in skip)
+        print(f"Dataset {ds.dataset_id}: {full_count} rows, {len(queues[n])} pages")
+
+    order = deque(queues)
+
+    def next_page() -> Optional[Tuple[int, int]]:
+        # Round robin over datasets, which still have pages to load
+        for _ in range(len(order)):
+            n = order[0]
+            order.rotate(-1)
+            if queues[n]:
+                return n, queues[n].popleft()
+        return None
+
+    def fetch(n: int, i: int) -> int:
+        ds = datasets[n]
+        return ds.dump_page(i, filename(ds, i), write)
+
+    pending: Dict[Future, Tuple[int, int]] = {}
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        try:
+            while True:
+                while len(pending) < 2 * n_jobs:
+                    page = next_page()
+                    if page is None:
+                        break
+                    pending[executor.submit(fetch, *page)] = page
+                if not pending:
+                    break
+
+                done: Set[Future]
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    n, i = pending.pop(future)
+                    rows = future.result()
+                    ds = datasets[n]
+                    # Count may be stale if the dataset grew after the count request
+                    last = i == n_pages[n] - 1
+                    if last and rows == ds.step and n_pages[n] != limit:
+                        n_pages[n] += 1
+                        queues[n].append(n_pages[n] - 1)
+                    print(f"Dataset {ds.dataset_id}, request {i}: {rows} rows")
+                    yield ds, i, rows
+        finally:
+            for future in pending:
+                future.cancel()
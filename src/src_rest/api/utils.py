@@ -1,5 +1,185 @@
 from requests import Response, Session
+from typing import Dict, List, Optional
+from urllib.parse import quote
 
-def get_query(session: Session, query: str, **kwargs) -> Response:
+def get_query(
+    session: Session,
+    query: str,
+    *,
+    stream: bool = False,
+    headers: Optional[Dict[str, str]] = None,
+    **kwargs,
+) -> Response:
     query = query.format(**kwargs)
-    return session.get(query)
\ No newline at end of file
+    return session.get(query, stream=stream, headers=headers)
+
+
+def get_query_params(
+    columns: Optional[List[str]] = None, filter: Optional[str] = None
+) -> str:
+    """Column projection and filter expression as $select / $filter query params"""
+    params = ""
+    if columns:
+        params += "&$select=" + quote(",".join(columns), safe=",/")
+    if filter:
+        params += "&$filter=" + quote(filter, safe="/")
+    return params
+
+
+import datetime
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header value in seconds, either delta-seconds or http-date"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe token bucket, which rate is adapted AIMD-style:
+    additive increase on healthy responses, multiplicative decrease on throttling"""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 1,
+        min_rate: Optional[float] = None,
+        increase: Optional[float] = None,
+        decrease: float = 0.5,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError("rate should be positive")
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.increase = increase if increase is not None else rate / 20
+        self.decrease = decrease
+        self.burst = burst
+        self.tokens = burst
+        # Tokens accrue from this time on, which is in the future during a pause
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+            self.tokens -= 1
+            delay = max(0.0, -self.tokens / self.rate)
+            return max(0.0, self.updated - now) + delay
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after is not None:
+                # Callers queued behind the pause are spaced at the rate after it,
+                # instead of all waking at its end; one token is ready then
+                self.tokens = min(self.tokens, 1)
+                self.updated = max(self.updated, time.monotonic() + retry_after)
+
+
+import codecs
+import itertools
+import json
+
+from typing import Any, Iterable, Iterator
+
+WHITESPACE = " \t\n\r"
+
+
+def _skip_whitespace(buffer: str, pos: int) -> int:
+    while pos < len(buffer) and buffer[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def iter_json_array(chunks: Iterable[bytes], encoding: str = "utf-8") -> Iterator[Any]:
+    """Incrementally decodes items of a json array from byte chunks,
+    holding in memory only the current item and the unparsed tail of a chunk"""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buffer = ""
+    pos = 0
+    pieces: List[str] = []
+    n_pending = 0
+    # An incomplete item is decoded again only once the unparsed tail has doubled,
+    # so an item spanning many chunks is copied and decoded O(1) times amortized
+    wanted = 0
+    started = False
+    finished = False
+    expect_item = True
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        text = text_decoder.decode(b"" if final else chunk, final=final)
+        pieces.append(text)
+        n_pending += len(text)
+        if not final and len(buffer) - pos + n_pending < wanted:
+            continue
+        buffer = buffer[pos:] + "".join(pieces)
+        pos = 0
+        pieces = []
+        n_pending = 0
+        while not finished:
+            pos = _skip_whitespace(buffer, pos)
+            if pos == len(buffer):
+                break
+            elif not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Json array expected")
+                started = True
+                pos += 1
+            elif buffer[pos] == "]":
+                finished = True
+                pos += 1
+            elif buffer[pos] == "," and not expect_item:
+                expect_item = True
+                pos += 1
+            elif expect_item:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break
+                # Item is complete only when followed by a delimiter,
+                # e.g. number at the end of the chunk may continue in the next one
+                end = _skip_whitespace(buffer, end)
+                if end == len(buffer) or buffer[end] not in ",]":
+                    break
+                yield item
+                pos = end
+                expect_item = False
+            else:
+                raise ValueError(f"Unexpected {buffer[pos]!r} in json array")
+        wanted = 2 * (len(buffer) - pos)
+
+    if not finished or buffer[pos:].strip(WHITESPACE):
+        raise ValueError("Json array is incomplete or has trailing data")
@@ -1,11 +1,129 @@
 import click
-import json
+import glob
+import hashlib
 import os
 
-from typing import Union
+from functools import partial
+from typing import Any, Callable, Iterator, List, Optional, Set, Tuple, Union
 
+from src_rest.api.cache import ResponseCache
 from src_rest.api.mosapi import MosApi, MosDataset
-from src_rest.loaders.utils import check_paths
+from src_rest.api.utils import iter_json_array
+from src_rest.loaders.utils import (
+    CHUNK_FORMATS,
+    BackgroundWriter,
+    append_manifest,
+    check_paths,
+    chunk_files,
+    completed_chunks,
+    file_sha256,
+    read_manifest,
+    read_manifest_header,
+    reset_manifest,
+    write_chunk,
+)
+
+
+def _create_api(
+    api_key: str,
+    n_retries: int,
+    backoff: float,
+    rate: float,
+    n_jobs: int,
+    cache_dir: Optional[str],
+    cache_ttl: float,
+    cache_max_size: Optional[float],
+) -> MosApi:
+    if cache_dir is not None:
+        max_size = int(cache_max_size * 2**20) if cache_max_size is not None else None
+        cache: Optional[ResponseCache] = ResponseCache(cache_dir, cache_ttl, max_size)
+    else:
+        cache = None
+    return MosApi(
+        api_key,
+        n_retries=n_retries,
+        backoff=backoff,
+        pool_size=max(n_jobs, 10),
+        rate=rate,
+        cache=cache,
+    )
+
+
+def _prepare_output(
+    output: str,
+    step: int,
+    resume: bool,
+    format: str = "json",
+    columns: Optional[List[str]] = None,
+    filter: Optional[str] = None,
+) -> Set[int]:
+    # A finished load, or one started with other settings, is started over,
+    # since its chunks can not be completed by this load
+    header = {"step": step, "format": format, "columns": columns, "filter": filter}
+    previous = read_manifest_header(output) if resume else None
+    if previous is not None and previous != header:
+        print(f"Load in {output} was started with {previous}, starting over")
+        resume = False
+    elif resume and previous is None and not read_manifest(output):
+        resume = False
+
+    if resume:
+        completed = completed_chunks(output, step)
+        print(f"Resuming {output}, {len(completed)} chunks already loaded")
+    else:
+        completed = set()
+        reset_manifest(output)
+        # Chunks of a previous load, possibly in another format, would be read
+        # together with the new ones downstream
+        for filename in chunk_files(output):
+            if os.path.basename(filename).startswith("chunk_"):
+                os.remove(filename)
+    # Pages of an interrupted load, which never became chunks
+    for filename in glob.glob(os.path.join(output, "chunk_*.part")):
+        os.remove(filename)
+    if previous != header:
+        append_manifest(output, {"header": header})
+    return completed
+
+
+def _chunk_name(output: str, i: int, format: str = "json") -> str:
+    return os.path.join(output, f"chunk_{i}{CHUNK_FORMATS[format]}")
+
+
+def _part_name(output: str, i: int, format: str = "json") -> str:
+    # Page is written next to its chunk and renamed, once it is recorded
+    return _chunk_name(output, i, format) + ".part"
+
+
+def _chunk_writer(format: str) -> Optional[Callable[[str, Iterator[Any]], int]]:
+    # Raw json pages are written as downloaded, without parsing them
+    if format == "json":
+        return None
+    return partial(write_chunk, format=format)
+
+
+def _record_chunk(
+    output: str,
+    i: int,
+    step: int,
+    rows: int,
+    format: str = "json",
+    sha256: Optional[str] = None,
+) -> None:
+    os.replace(_part_name(output, i, format), _chunk_name(output, i, format))
+    if sha256 is None:
+        sha256 = file_sha256(_chunk_name(output, i, format))
+    append_manifest(
+        output,
+        {
+            "chunk": i,
+            "skip": i * step,
+            "top": step,
+            "rows": rows,
+            "file": os.path.basename(_chunk_name(output, i, format)),
+            "sha256": sha256,
+        },
+    )
 
 
 @click.command()
@@ -23,30 +141,301 @@ from src_rest.loaders.utils import check_paths
 @click.option(
     "--backoff", default=0.1, help="backoff when making request", type=click.FLOAT
 )
-@click.option("--sleep", default=3, help="Sleep between attempts", type=click.INT)
+@click.option(
+    "--rate", default=1.0, help="target number of requests per second", type=click.FLOAT
+)
 @click.option("--step", default=1000, help="Step size", type=click.INT)
 @click.option("--limit", default=None, help="limit requests number", type=click.INT)
+@click.option(
+    "--n_jobs", default=1, help="number of pages loaded concurrently", type=click.INT
+)
+@click.option(
+    "--resume",
+    help="Load only chunks missing from the manifest of an unfinished load",
+    is_flag=True,
+)
+@click.option(
+    "--cache_dir", default=None, help="Directory to cache responses", type=click.STRING
+)
+@click.option(
+    "--cache_ttl",
+    default=0,
+    help="Seconds before cached response is revalidated",
+    type=click.FLOAT,
+)
+@click.option(
+    "--cache_max_size",
+    default=None,
+    help="Cache size limit in megabytes",
+    type=click.FLOAT,
+)
+@click.option(
+    "--columns",
+    help="Columns of Cells to load, all by default",
+    multiple=True,
+    type=click.STRING,
+)
+@click.option(
+    "--filter",
+    default=None,
+    help="Filter expression, e.g. \"Cells/TypeObject eq 'бар'\"",
+    type=click.STRING,
+)
+@click.option(
+    "--format",
+    default="json",
+    help="Chunk format: json as returned by api, compressed json lines or parquet",
+    type=click.Choice(list(CHUNK_FORMATS)),
+)
+@click.option(
+    "--writer",
+    default="inline",
+    help="inline: stream pages to disk while fetching, "
+    "background: fetch pages to memory and write them on a separate thread",
+    type=click.Choice(["inline", "background"]),
+)
+@click.option(
+    "--queue_size",
+    default=8,
+    help="Max pages waiting for background writer",
+    type=click.INT,
+)
 def load_mosdata(
     dataset_id: str,
     output: str,
     api_key: str,
     n_retries: int,
     backoff: int,
-    sleep: int,
+    rate: float,
     step: int,
     limit: Union[int, None],
+    n_jobs: int,
+    resume: bool,
+    cache_dir: Optional[str],
+    cache_ttl: float,
+    cache_max_size: Optional[float],
+    columns: Tuple[str, ...],
+    filter: Optional[str],
+    format: str,
+    writer: str,
+    queue_size: int,
 ) -> None:
-    api = MosApi(api_key, n_retries=n_retries, backoff=backoff)
-    ds = MosDataset(api, dataset_id, sleep=sleep, step=step)
+    api = _create_api(
+        api_key, n_retries, backoff, rate, n_jobs, cache_dir, cache_ttl, cache_max_size
+    )
+    ds = MosDataset(
+        api,
+        dataset_id,
+        step=step,
+        n_jobs=n_jobs,
+        columns=list(columns) or None,
+        filter=filter,
+    )
     check_paths(input=None, output=output, is_output_dir=True)
-    for i, chunk in enumerate(ds.load()):
+    completed = _prepare_output(
+        output, step, resume, format, list(columns) or None, filter
+    )
+
+    if writer == "background":
+        _load_background(ds, output, step, limit, completed, queue_size, format)
+        return
+
+    pages = ds.dump(
+        lambda i: _part_name(output, i, format),
+        exclude=completed,
+        write=_chunk_writer(format),
+        limit=limit,
+    )
+    for i, rows in pages:
         print(f"Processing chunk {i}")
-        chunk_name = os.path.join(output, f"chunk_{i}.json")
-        with open(chunk_name, "w", encoding="utf-8") as file:
-            json.dump(chunk, file)
+        _record_chunk(output, i, step, rows, format)
 
-        if limit is not None and i + 1 == limit:
+        if limit is not None and i + 1 >= limit:
             break
+    else:
+        append_manifest(output, {"done": True})
+
+
+def _load_background(
+    ds: MosDataset,
+    output: str,
+    step: int,
+    limit: Optional[int],
+    completed: Set[int],
+    queue_size: int,
+    format: str,
+) -> None:
+    def write(page: Tuple[int, bytes, int]) -> None:
+        i, content, rows = page
+        filename = _part_name(output, i, format)
+        if format == "json":
+            with open(filename, "wb") as file:
+                file.write(content)
+            sha256: Optional[str] = hashlib.sha256(content).hexdigest()
+        else:
+            write_chunk(filename, iter_json_array([content]), format)
+            sha256 = None
+        _record_chunk(output, i, step, rows, format, sha256)
+
+    finished = True
+    with BackgroundWriter(write, queue_size) as chunk_writer:
+        for i, (content, rows) in ds.load_content(exclude=completed, limit=limit):
+            print(f"Processing chunk {i}")
+            chunk_writer.put((i, content, rows))
+
+            if limit is not None and i + 1 >= limit:
+                finished = False
+                break
+
+    # Marked done only after the writer flushed all chunks
+    if finished:
+        append_manifest(output, {"done": True})
+
+    stats = chunk_writer.stats()
+    print(
+        f"Chunks written: {stats['items']}, "
+        f"fetch blocked on writer: {stats['producer_blocked']:.2f}s, "
+        f"writer waiting for fetch: {stats['writer_blocked']:.2f}s, "
+        f"writing: {stats['writing']:.2f}s"
+    )
+
+
+from src_rest.api.mosapi import dump_many
+
+
+@click.command()
+@click.option(
+    "--dataset_id",
+    help="Dataset id to load, may be repeated",
+    type=click.STRING,
+    multiple=True,
+    required=1,
+)
+@click.option(
+    "--output",
+    help="Output path to load data, {dataset_id} is replaced with dataset id",
+    type=click.STRING,
+    required=1,
+)
+@click.option("--api_key", help="your api key", type=click.STRING, required=1)
+@click.option(
+    "--n_retries",
+    default=10,
+    help="number of retries when making requests",
+    type=click.INT,
+)
+@click.option(
+    "--backoff", default=0.1, help="backoff when making request", type=click.FLOAT
+)
+@click.option(
+    "--rate",
+    default=1.0,
+    help="target number of requests per second for all datasets",
+    type=click.FLOAT,
+)
+@click.option("--step", default=1000, help="Step size", type=click.INT)
+@click.option(
+    "--limit", default=None, help="Max pages of each dataset", type=click.INT
+)
+@click.option(
+    "--n_jobs",
+    default=4,
+    help="number of pages loaded concurrently for all datasets",
+    type=click.INT,
+)
+@click.option(
+    "--resume",
+    help="Load only chunks missing from the manifest of an unfinished load",
+    is_flag=True,
+)
+@click.option(
+    "--cache_dir", default=None, help="Directory to cache responses", type=click.STRING
+)
+@click.option(
+    "--cache_ttl",
+    default=0,
+    help="Seconds before cached response is revalidated",
+    type=click.FLOAT,
+)
+@click.option(
+    "--cache_max_size",
+    default=None,
+    help="Cache size limit in megabytes",
+    type=click.FLOAT,
+)
+@click.option(
+    "--columns",
+    help="Columns of Cells to load, all by default",
+    multiple=True,
+    type=click.STRING,
+)
+@click.option(
+    "--filter",
+    default=None,
+    help="Filter expression, e.g. \"Cells/TypeObject eq 'бар'\"",
+    type=click.STRING,
+)
+@click.option(
+    "--format",
+    default="json",
+    help="Chunk format: json as returned by api, compressed json lines or parquet",
+    type=click.Choice(list(CHUNK_FORMATS)),
+)
+def load_mosdata_many(
+    dataset_id: Tuple[str, ...],
+    output: str,
+    api_key: str,
+    n_retries: int,
+    backoff: int,
+    rate: float,
+    step: int,
+    limit: Optional[int],
+    n_jobs: int,
+    resume: bool,
+    cache_dir: Optional[str],
+    cache_ttl: float,
+    cache_max_size: Optional[float],
+    columns: Tuple[str, ...],
+    filter: Optional[str],
+    format: str,
+) -> None:
+    # Repeated ids would load the same dataset to the same output twice
+    dataset_id = tuple(dict.fromkeys(dataset_id))
+    if len(dataset_id) > 1 and "{dataset_id}" not in output:
+        raise ValueError("Output should contain {dataset_id} for several datasets")
+
+    api = _create_api(
+        api_key, n_retries, backoff, rate, n_jobs, cache_dir, cache_ttl, cache_max_size
+    )
+    datasets = [
+        MosDataset(
+            api, item, step=step, columns=list(columns) or None, filter=filter
+        )
+        for item in dataset_id
+    ]
+    outputs = {item: output.format(dataset_id=item) for item in dataset_id}
+    completed = {}
+    for item, item_output in outputs.items():
+        check_paths(input=None, output=item_output, is_output_dir=True)
+        completed[item] = _prepare_output(
+            item_output, step, resume, format, list(columns) or None, filter
+        )
+
+    pages = dump_many(
+        datasets,
+        lambda ds, i: _part_name(outputs[ds.dataset_id], i, format),
+        exclude=completed,
+        n_jobs=n_jobs,
+        write=_chunk_writer(format),
+        limit=limit,
+    )
+    for ds, i, rows in pages:
+        _record_chunk(outputs[ds.dataset_id], i, step, rows, format)
+
+    # Datasets loaded up to the limit may have more pages
+    if limit is None:
+        for item_output in outputs.values():
+            append_manifest(item_output, {"done": True})
 
 
 from pandas import read_csv, concat
@@ -1,13 +1,21 @@
 import click
+import os
+
 from typing import Optional
 
 from src_rest.scrapying.scrapers import MosRestCrawler
 from src_rest.loaders.utils import check_paths
+from src_rest.scrapying.cache import is_sqlite_cache
+from src_rest.scrapying.crawl_state import crawl_state_path
+from src_rest.scrapying.scheduler import HostScheduler
 
 
 @click.command()
 @click.option(
-    "--output", help="Output path to load data", type=click.STRING, required=True
+    "--output",
+    help="Output json files directory, sqlite file (.sqlite, .db) or shards (.shards)",
+    type=click.STRING,
+    required=True,
 )
 @click.option(
     "--user_agent", default="Chrome", help="default user-agent", type=click.STRING
@@ -28,6 +36,64 @@ from src_rest.loaders.utils import check_paths
 )
 @click.option("--timeout", default=10, help="Timeout for request", type=click.INT)
 @click.option("--limit", default=None, help="Timeout for request", type=click.INT)
+@click.option(
+    "--host_rate",
+    default=None,
+    help="Max requests per second to a host, lowered when the host throttles, "
+    "hosts are not limited by default",
+    type=click.FLOAT,
+)
+@click.option(
+    "--frontier",
+    help="Fetch every found pagination link concurrently, not page after page",
+    is_flag=True,
+)
+@click.option(
+    "--n_jobs", default=10, help="number of pages fetched in frontier mode", type=click.INT
+)
+@click.option(
+    "--parser",
+    default="html.parser",
+    help="BeautifulSoup parser backend: html.parser, lxml, html5lib",
+    type=click.STRING,
+)
+@click.option(
+    "--raw_dir",
+    default=None,
+    help="Directory to store compressed page bodies for reparse",
+    type=click.STRING,
+)
+@click.option(
+    "--ttl",
+    default=None,
+    help="With --cache, seconds cached pages are fresh for, "
+    "then they are revalidated with conditional requests",
+    type=click.FLOAT,
+)
+@click.option(
+    "--metrics",
+    default=None,
+    help="File to export scrape metrics to while scraping, "
+    "Prometheus text format for .prom, json otherwise",
+    type=click.STRING,
+)
+@click.option(
+    "--progress_interval",
+    default=5,
+    help="Seconds between progress lines",
+    type=click.FLOAT,
+)
+@click.option(
+    "--state",
+    default=None,
+    help="Crawl state file to resume from, .crawl_state.json of the output by default",
+    type=click.STRING,
+)
+@click.option(
+    "--restart",
+    help="Start the crawl over, discarding the saved crawl state",
+    is_flag=True,
+)
 def load_moscow_restaurants(
     output: str,
     user_agent: str,
@@ -36,9 +102,23 @@ def load_moscow_restaurants(
     backoff: int,
     timeout: int,
     limit: Optional[int],
+    host_rate: Optional[float],
+    frontier: bool,
+    n_jobs: int,
+    parser: str,
+    raw_dir: Optional[str],
+    ttl: Optional[float],
+    metrics: Optional[str],
+    progress_interval: float,
+    state: Optional[str],
+    restart: bool,
 ) -> None:
 
-    check_paths(input=None, output=output, is_output_dir=True)
+    check_paths(input=None, output=output, is_output_dir=not is_sqlite_cache(output))
+    if state is None:
+        state = crawl_state_path(output)
+    if restart and os.path.exists(state):
+        os.remove(state)
 
     crawler = MosRestCrawler(
         link="https://www.moscow-restaurants.ru/restaurants/",
@@ -49,6 +129,15 @@ def load_moscow_restaurants(
         backoff=backoff,
         timeout=timeout,
         limit=limit,
+        scheduler=HostScheduler(rate=host_rate) if host_rate is not None else None,
+        frontier=frontier,
+        n_jobs=n_jobs,
+        parser=parser,
+        raw_dir=raw_dir,
+        ttl=ttl,
+        state=state,
+        metrics_path=metrics,
+        progress_interval=progress_interval,
     )
     crawler.load_data()
 
@@ -61,7 +150,10 @@ from src_rest.scrapying.scrapers import MosRestScraper
 @click.command()
 @click.option("--input", help="Input data with links", type=click.STRING, required=True)
 @click.option(
-    "--output", help="Output path to load data", type=click.STRING, required=True
+    "--output",
+    help="Output json files directory, sqlite file (.sqlite, .db) or shards (.shards)",
+    type=click.STRING,
+    required=True,
 )
 @click.option(
     "--user_agent", default="Chrome", help="default user-agent", type=click.STRING
@@ -83,9 +175,75 @@ from src_rest.scrapying.scrapers import MosRestScraper
 @click.option("--timeout", default=10, help="Timeout for request", type=click.INT)
 @click.option("--limit", default=None, help="Timeout for request", type=click.INT)
 @click.option(
-    "--backend", default="threading", help="parallel backend", type=click.STRING
+    "--backend",
+    default="threading",
+    help="parallel backend: joblib backend name, asyncio "
+    "or pipeline of fetch threads and parse processes",
+    type=click.STRING,
+)
+@click.option(
+    "--n_jobs",
+    default=-1,
+    help="number of jobs, for asyncio number of requests in flight",
+    type=click.INT,
+)
+@click.option(
+    "--n_parsers",
+    default=-1,
+    help="With pipeline backend, number of parse processes, cpu count by default",
+    type=click.INT,
+)
+@click.option(
+    "--queue_size",
+    default=None,
+    help="With pipeline backend, pages fetched and waiting for a parser",
+    type=click.INT,
+)
+@click.option(
+    "--host_rate",
+    default=None,
+    help="Max requests per second to a host, lowered when the host throttles, "
+    "hosts are not limited by default",
+    type=click.FLOAT,
+)
+@click.option(
+    "--host_concurrency",
+    default=10,
+    help="With --host_rate, max concurrent requests to a host",
+    type=click.INT,
+)
+@click.option(
+    "--parser",
+    default="html.parser",
+    help="BeautifulSoup parser backend: html.parser, lxml, html5lib",
+    type=click.STRING,
+)
+@click.option(
+    "--raw_dir",
+    default=None,
+    help="Directory to store compressed page bodies for reparse",
+    type=click.STRING,
+)
+@click.option(
+    "--ttl",
+    default=None,
+    help="With --cache, seconds cached pages are fresh for, "
+    "then they are revalidated with conditional requests",
+    type=click.FLOAT,
+)
+@click.option(
+    "--metrics",
+    default=None,
+    help="File to export scrape metrics to while scraping, "
+    "Prometheus text format for .prom, json otherwise",
+    type=click.STRING,
+)
+@click.option(
+    "--progress_interval",
+    default=5,
+    help="Seconds between progress lines",
+    type=click.FLOAT,
 )
-@click.option("--n_jobs", default=-1, help="number of jobs", type=click.INT)
 def load_moscow_restaurants_detailed(
     input: str,
     output: str,
@@ -97,9 +255,18 @@ def load_moscow_restaurants_detailed(
     limit: Optional[int],
     backend: str,
     n_jobs: int,
+    n_parsers: int,
+    queue_size: Optional[int],
+    host_rate: Optional[float],
+    host_concurrency: int,
+    parser: str,
+    raw_dir: Optional[str],
+    ttl: Optional[float],
+    metrics: Optional[str],
+    progress_interval: float,
 ) -> None:
 
-    check_paths(input=input, output=output, is_output_dir=True)
+    check_paths(input=input, output=output, is_output_dir=not is_sqlite_cache(output))
 
     data = read_csv(input)
     links = data.link.values.tolist()
@@ -115,5 +282,168 @@ def load_moscow_restaurants_detailed(
         limit=limit,
         n_jobs=n_jobs,
         backend=backend,
+        n_parsers=n_parsers,
+        queue_size=queue_size,
+        scheduler=(
+            HostScheduler(host_concurrency, host_rate)
+            if host_rate is not None
+            else None
+        ),
+        parser=parser,
+        raw_dir=raw_dir,
+        ttl=ttl,
+        metrics_path=metrics,
+        progress_interval=progress_interval,
     )
     crawler.load_data()
+
+
+from collections import Counter
+from typing import Dict
+
+from joblib import Parallel, delayed
+
+from src_rest.scrapying.cache import evict_cache, migrate_cache, open_cache
+from src_rest.scrapying.scrapers import BaseScraper
+from src_rest.scrapying.utils import load_raw
+
+MOS_REST_LINK = "https://www.moscow-restaurants.ru/restaurants/"
+
+
+def _create_scraper(scraper: str, output: str, parser: str) -> BaseScraper:
+    if scraper == "moscow_restaurants":
+        return MosRestCrawler(link=MOS_REST_LINK, output=output, parser=parser)
+    elif scraper == "moscow_restaurants_detailed":
+        return MosRestScraper(links=[], output=output, parser=parser)
+    else:
+        raise ValueError(f"Unknown scraper {scraper}")
+
+
+def reparse_records(
+    batch: list, input: str, raw_dir: str, output: str, scraper: str, parser: str
+) -> Dict[str, int]:
+    """Parses stored pages of scraped records again, without fetching them"""
+    instance = _create_scraper(scraper, output, parser)
+    source = open_cache(input)
+    counts: Dict[str, int] = Counter()
+    records = []
+    for name, record in source.iter_batch(batch):
+        if not isinstance(record, dict):
+            raise TypeError("reparse supports only dict jsons")
+        text = load_raw(raw_dir, record["sha256"]) if record["ok"] else None
+        if text is not None:
+            record = instance.reparse(record, text)
+            counts["reparsed"] += 1
+        elif record["ok"]:
+            counts["missing"] += 1
+        else:
+            counts["not_ok"] += 1
+        records.append((name, record))
+    source.close()
+    instance.storage.dump_many(records)
+    instance.storage.close()
+    return counts
+
+
+def _check_cache_paths(input: str, output: str) -> None:
+    check_paths(input=input, output=output, is_output_dir=not is_sqlite_cache(output))
+
+
+@click.command()
+@click.option("--input", help="Scraped records path", type=click.STRING, required=True)
+@click.option(
+    "--raw_dir", help="Directory of stored page bodies", type=click.STRING, required=True
+)
+@click.option(
+    "--output",
+    help="Output path for reparsed records, may be the same as input",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "--scraper",
+    help="Scraper, which parses the pages",
+    type=click.Choice(["moscow_restaurants", "moscow_restaurants_detailed"]),
+    required=True,
+)
+@click.option(
+    "--parser",
+    default="html.parser",
+    help="BeautifulSoup parser backend: html.parser, lxml, html5lib",
+    type=click.STRING,
+)
+@click.option("--n_jobs", default=-1, help="number of processes", type=click.INT)
+def reparse_moscow_restaurants(
+    input: str, raw_dir: str, output: str, scraper: str, parser: str, n_jobs: int
+) -> None:
+    _check_cache_paths(input, output)
+    _check_cache_paths(raw_dir, output)
+
+    # Records are split into batches, so that each process creates its scraper once
+    source = open_cache(input)
+    batches = source.batches()
+    source.close()
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(reparse_records)(batch, input, raw_dir, output, scraper, parser)
+        for batch in batches
+    )
+
+    counts: Dict[str, int] = sum(map(Counter, results), Counter())
+    print(
+        f"Reparsed: {counts['reparsed']}, "
+        f"page not stored: {counts['missing']}, "
+        f"not ok responses: {counts['not_ok']}"
+    )
+
+
+@click.command()
+@click.option(
+    "--input",
+    help="Scraped records: json files directory, sqlite file or .shards directory",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "--output",
+    help="Destination: json files directory, sqlite file or .shards directory",
+    type=click.STRING,
+    required=True,
+)
+def migrate_scrape_cache(input: str, output: str) -> None:
+    _check_cache_paths(input, output)
+    source = open_cache(input)
+    destination = open_cache(output)
+    count = migrate_cache(source, destination)
+    source.close()
+    destination.close()
+    print(f"Migrated {count} records from {input} to {output}")
+
+
+@click.command()
+@click.option(
+    "--input",
+    help="Scrape cache: json files directory, sqlite file or .shards directory",
+    type=click.STRING,
+    required=True,
+)
+@click.option(
+    "--max_age",
+    default=None,
+    help="Remove records fetched more than max_age seconds ago",
+    type=click.FLOAT,
+)
+@click.option(
+    "--max_size",
+    default=None,
+    help="Remove oldest records until the cache takes at most max_size bytes",
+    type=click.INT,
+)
+def evict_scrape_cache(
+    input: str, max_age: Optional[float], max_size: Optional[int]
+) -> None:
+    if not os.path.exists(input):
+        raise FileNotFoundError(f"Input path {os.path.abspath(input)} not found")
+    cache = open_cache(input)
+    removed, kept = evict_cache(cache, max_age, max_size)
+    cache.close()
+    print(f"Removed {removed} records, kept {kept}")
@@ -25,3 +25,284 @@ def check_paths(input: Optional[str], output: str, is_output_dir: bool=False) ->
     if not os.path.exists(output_dirname):
         print(f"Warning: dirname {output_dirname}, creating it")
         safe_mkdir(output_dirname)
+
+
+import hashlib
+import json
+from typing import Dict, Iterator, Set
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _iter_manifest(output: str) -> Iterator[dict]:
+    path = os.path.join(output, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return
+
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            # Last line may be truncated if the load was killed mid-write
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def read_manifest(output: str) -> Dict[int, dict]:
+    """Chunks recorded in the manifest of the unfinished load, keyed by chunk number.
+    Manifest of a finished load is treated as empty, so a new load starts over"""
+    entries: Dict[int, dict] = {}
+    for entry in _iter_manifest(output):
+        if entry.get("done"):
+            entries = {}
+        elif "chunk" in entry:
+            entries[entry["chunk"]] = entry
+    return entries
+
+
+def read_manifest_header(output: str) -> Optional[dict]:
+    """Settings the unfinished load was started with, e.g. step and format,
+    None if it was started before they were recorded"""
+    header = None
+    for entry in _iter_manifest(output):
+        if entry.get("done"):
+            header = None
+        elif "header" in entry:
+            header = entry["header"]
+    return header
+
+
+def read_finished_header(output: str) -> Optional[dict]:
+    """Settings of the finished load, empty if it was started before they were
+    recorded, None if the load is not finished. Loads cut by a limit are not
+    marked finished, so a finished load has every page of the dataset"""
+    header: Optional[dict] = None
+    finished = False
+    for entry in _iter_manifest(output):
+        if entry.get("done"):
+            finished = True
+        elif "header" in entry:
+            header, finished = entry["header"], False
+        elif "chunk" in entry:
+            finished = False
+    if not finished:
+        return None
+    return header if header is not None else {}
+
+
+def completed_chunks(output: str, step: int) -> Set[int]:
+    completed = set()
+    for chunk, entry in read_manifest(output).items():
+        path = os.path.join(output, entry["file"])
+        if (
+            entry["top"] == step
+            and os.path.exists(path)
+            and file_sha256(path) == entry["sha256"]
+        ):
+            completed.add(chunk)
+    return completed
+
+
+def append_manifest(output: str, entry: dict) -> None:
+    path = os.path.join(output, MANIFEST_NAME)
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(entry) + "\n")
+
+
+def reset_manifest(output: str) -> None:
+    path = os.path.join(output, MANIFEST_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+import threading
+import time
+
+from queue import Queue
+from typing import Any, Callable
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """Writes items on a separate thread, fed through a bounded queue,
+    so that a producer is blocked only when the writer falls behind"""
+
+    def __init__(self, write: Callable[[Any], None], queue_size: int = 8) -> None:
+        self.write = write
+        self.queue: Queue = Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        self.put_blocked = 0.0
+        self.get_blocked = 0.0
+        self.write_time = 0.0
+        self.n_items = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.get_blocked += time.perf_counter() - start
+            if item is _STOP:
+                break
+            elif self.error is not None:
+                # Keep draining the queue, so the producer is never stuck on put
+                continue
+
+            start = time.perf_counter()
+            try:
+                self.write(item)
+                self.n_items += 1
+            except BaseException as e:
+                self.error = e
+            self.write_time += time.perf_counter() - start
+
+    def put(self, item: Any) -> None:
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put(item)
+        self.put_blocked += time.perf_counter() - start
+
+    def close(self) -> None:
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "items": self.n_items,
+            "producer_blocked": self.put_blocked,
+            "writer_blocked": self.get_blocked,
+            "writing": self.write_time,
+        }
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.queue.put(_STOP)
+            self.thread.join()
+
+
+import glob
+import gzip
+import re
+
+from typing import Iterable, Iterator, List
+
+CHUNK_FORMATS = {"json": ".json", "jsonl.gz": ".jsonl.gz", "parquet": ".parquet"}
+
+
+def chunk_format(filename: str) -> str:
+    for format, extension in CHUNK_FORMATS.items():
+        if filename.endswith(extension):
+            return format
+    raise ValueError(f"Unknown chunk format of {filename}")
+
+
+# Parquet schema metadata key with the columns stored as json text
+JSON_COLUMNS = "json_columns"
+
+
+def is_nested(value: Any) -> bool:
+    return isinstance(value, (dict, list))
+
+
+def write_chunk(filename: str, rows: Iterable[Any], format: str) -> int:
+    """Writes rows to filename in the given format, returns number of rows"""
+    n_rows = 0
+    if format == "jsonl.gz":
+        with gzip.open(filename, "wt", encoding="utf-8", compresslevel=6) as file:
+            for row in rows:
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+                n_rows += 1
+    elif format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+        data = list(rows)
+        n_rows = len(data)
+        # Nested values are stored as json text: as structs, dicts of a list
+        # would be unified to one set of keys, with None for missing ones
+        json_columns = sorted(
+            {key for row in data for key, value in row.items() if is_nested(value)}
+        )
+        data = [
+            {
+                key: json.dumps(value, ensure_ascii=False)
+                if key in json_columns and value is not None
+                else value
+                for key, value in row.items()
+            }
+            for row in data
+        ]
+        table = pyarrow.Table.from_pylist(
+            data, metadata={JSON_COLUMNS: json.dumps(json_columns)}
+        )
+        pyarrow.parquet.write_table(table, filename, compression="zstd")
+    elif format == "json":
+        data = list(rows)
+        n_rows = len(data)
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+    else:
+        raise ValueError(f"Unknown chunk format {format}")
+    return n_rows
+
+
+def iter_chunk(filename: str) -> Iterator[Any]:
+    """Rows of a chunk file; jsonl.gz and parquet chunks are read incrementally"""
+    format = chunk_format(filename)
+    if format == "jsonl.gz":
+        with gzip.open(filename, "rt", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    elif format == "parquet":
+        import pyarrow.parquet
+
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        metadata = parquet_file.schema_arrow.metadata or {}
+        json_columns = json.loads(metadata.get(JSON_COLUMNS.encode(), b"[]"))
+        for batch in parquet_file.iter_batches():
+            for row in batch.to_pylist():
+                for key in json_columns:
+                    if row[key] is not None:
+                        row[key] = json.loads(row[key])
+                yield row
+    else:
+        with open(filename, "r", encoding="utf-8") as file:
+            yield from json.load(file)
+
+
+def _natural_key(filename: str) -> list:
+    return [int(x) if x.isdigit() else x for x in re.split(r"(\d+)", filename)]
+
+
+def chunk_files(input: str) -> List[str]:
+    """Chunk files of any format in input folder, in chunk order"""
+    files = [
+        filename
+        for extension in CHUNK_FORMATS.values()
+        for filename in glob.glob(os.path.join(input, f"*{extension}"))
+    ]
+    return sorted(files, key=_natural_key)
+
+
+def iter_chunks(input: str) -> Iterator[Any]:
+    for filename in chunk_files(input):
+        yield from iter_chunk(filename)
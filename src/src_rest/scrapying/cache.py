@@ -0,0 +1,678 @@
+import atexit
+import datetime
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from abc import ABCMeta, abstractmethod
+from typing import (
+    Any,
+    BinaryIO,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
+
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+# Sqlite limits the number of host parameters of a statement
+BATCH_SIZE = 500
+# dttm of scraped records, local time
+DTTM_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def record_name(url: str) -> str:
+    sha256 = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return f"chunk_{sha256}.json"
+
+
+def dttm_age(dttm: Optional[str]) -> float:
+    """Seconds since dttm, records stored without it are the oldest"""
+    if dttm is None:
+        return float("inf")
+    delta = datetime.datetime.now() - datetime.datetime.strptime(dttm, DTTM_FORMAT)
+    return delta.total_seconds()
+
+
+def record_age(record: dict) -> float:
+    """Seconds since the record was fetched or revalidated"""
+    return dttm_age(record["dttm"])
+
+
+class ScrapeCache(metaclass=ABCMeta):
+    """Scraped records, addressed by the name derived from the requested url"""
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def load(self, name: str) -> Optional[dict]:
+        pass
+
+    def dump(self, name: str, data: dict) -> None:
+        self.dump_many([(name, data)])
+
+    @abstractmethod
+    def dump_many(self, items: Iterable[Tuple[str, dict]]) -> None:
+        pass
+
+    @abstractmethod
+    def existing(self, names: Iterable[str]) -> Set[str]:
+        """Names from the given, which have a stored record"""
+        pass
+
+    def index(self, names: Iterable[str]) -> Dict[str, dict]:
+        """ok and dttm of stored records from the given names, in one pass"""
+        result = {}
+        for name in self.existing(names):
+            record = self.load(name)
+            if record is not None:
+                result[name] = {"ok": record["ok"], "dttm": record.get("dttm")}
+        return result
+
+    @abstractmethod
+    def sizes(self) -> Dict[str, int]:
+        """Stored size of each record in bytes"""
+        pass
+
+    @abstractmethod
+    def remove(self, names: Iterable[str]) -> None:
+        pass
+
+    def get(self, url: str) -> Optional[dict]:
+        return self.load(record_name(url))
+
+    def put(self, url: str, data: dict) -> None:
+        self.dump(record_name(url), data)
+
+    def contains(self, urls: Iterable[str]) -> Set[str]:
+        """Urls from the given, which have a stored record"""
+        names = {record_name(url): url for url in urls}
+        return {names[name] for name in self.existing(names)}
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        for name in self.names():
+            data = self.load(name)
+            if data is not None:
+                yield name, data
+
+    def batches(self, n_batches: int = 64) -> List[list]:
+        """Parts of the cache to be read by separate jobs with iter_batch"""
+        names = self.names()
+        n_batches = max(1, min(len(names), n_batches))
+        return [names[i::n_batches] for i in range(n_batches)]
+
+    def iter_batch(self, batch: list) -> Iterator[Tuple[str, dict]]:
+        for name in batch:
+            data = self.load(name)
+            if data is not None:
+                yield name, data
+
+    def close(self) -> None:
+        """Finishes pending writes and releases resources,
+        the cache may still be used afterwards"""
+        pass
+
+
+def read_fields(
+    filename: str, fields: Collection[str], block_size: int = 4096
+) -> Dict[str, Any]:
+    """Top-level fields of the json object in the file, which is read and decoded
+    only up to the last of them, e.g. without the page data stored after them"""
+    decoder = json.JSONDecoder()
+    skip = json.decoder.WHITESPACE.match  # type: ignore
+    result: Dict[str, Any] = {}
+    with open(filename, "r", encoding="utf-8") as file:
+        buffer = file.read(block_size)
+        pos = skip(buffer, 0).end()
+        if buffer[pos : pos + 1] != "{":
+            raise ValueError(f"Json object expected in {filename}")
+        pos += 1
+        while len(result) < len(fields):
+            try:
+                pos = skip(buffer, pos).end()
+                if buffer[pos] == "}":
+                    break
+                key, end = decoder.raw_decode(buffer, pos)
+                end = skip(buffer, end).end()
+                if buffer[end] != ":":
+                    raise ValueError(f"Malformed json object in {filename}")
+                value, end = decoder.raw_decode(buffer, skip(buffer, end + 1).end())
+                end = skip(buffer, end).end()
+                # Value is complete only when followed by a delimiter
+                delimiter = buffer[end]
+            except (json.JSONDecodeError, IndexError):
+                # Value continues after the buffer, which is doubled
+                more = file.read(max(block_size, len(buffer)))
+                if not more:
+                    raise ValueError(f"Incomplete json object in {filename}")
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            if key in fields:
+                result[key] = value
+            if delimiter == "}":
+                break
+            pos = end + 1
+    return result
+
+
+class ChunkDirCache(ScrapeCache):
+    """Record per json file in a directory, the original layout of scraped data"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def names(self) -> List[str]:
+        return sorted(
+            os.path.basename(filename)
+            for filename in glob.glob(os.path.join(self.path, "*.json"))
+        )
+
+    def load(self, name: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.path, name), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def dump_many(self, items: Iterable[Tuple[str, dict]]) -> None:
+        for name, data in items:
+            with open(os.path.join(self.path, name), "w", encoding="utf-8") as file:
+                json.dump(data, file)
+
+    def existing(self, names: Iterable[str]) -> Set[str]:
+        # One directory listing instead of a stat call per name
+        stored = set(os.listdir(self.path)) if os.path.isdir(self.path) else set()
+        return stored.intersection(names)
+
+    def index(self, names: Iterable[str]) -> Dict[str, dict]:
+        # ok and dttm precede the page data, which is not read
+        result = {}
+        for name in self.existing(names):
+            try:
+                fields = read_fields(os.path.join(self.path, name), ("ok", "dttm"))
+            except FileNotFoundError:
+                continue
+            result[name] = {"ok": fields["ok"], "dttm": fields.get("dttm")}
+        return result
+
+    def sizes(self) -> Dict[str, int]:
+        return {
+            name: os.path.getsize(os.path.join(self.path, name))
+            for name in self.names()
+        }
+
+    def remove(self, names: Iterable[str]) -> None:
+        for name in names:
+            filename = os.path.join(self.path, name)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class SQLiteCache(ScrapeCache):
+    """All records in one sqlite file, indexed by name.
+    Each thread uses its own connection, writers are serialized by sqlite"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS records "
+                "(name TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID"
+            )
+
+    def __getstate__(self) -> dict:
+        # Connections are per process, when the cache is sent to joblib workers
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def names(self) -> List[str]:
+        cursor = self.connection().execute("SELECT name FROM records ORDER BY name")
+        return [name for name, in cursor]
+
+    def load(self, name: str) -> Optional[dict]:
+        row = (
+            self.connection()
+            .execute("SELECT data FROM records WHERE name = ?", (name,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row is not None else None
+
+    def dump_many(self, items: Iterable[Tuple[str, dict]]) -> None:
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO records (name, data) VALUES (?, ?)",
+                ((name, json.dumps(data)) for name, data in items),
+            )
+
+    def existing(self, names: Iterable[str]) -> Set[str]:
+        names = list(names)
+        result: Set[str] = set()
+        for i in range(0, len(names), BATCH_SIZE):
+            batch = names[i : i + BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            cursor = self.connection().execute(
+                f"SELECT name FROM records WHERE name IN ({placeholders})", batch
+            )
+            result.update(name for name, in cursor)
+        return result
+
+    def index(self, names: Iterable[str]) -> Dict[str, dict]:
+        # Fields are extracted by sqlite, records are not decoded
+        names = list(names)
+        result = {}
+        for i in range(0, len(names), BATCH_SIZE):
+            batch = names[i : i + BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            cursor = self.connection().execute(
+                "SELECT name, json_extract(data, '$.ok'), json_extract(data, '$.dttm') "
+                f"FROM records WHERE name IN ({placeholders})",
+                batch,
+            )
+            for name, ok, dttm in cursor:
+                result[name] = {"ok": bool(ok), "dttm": dttm}
+        return result
+
+    def sizes(self) -> Dict[str, int]:
+        cursor = self.connection().execute("SELECT name, length(data) FROM records")
+        return dict(cursor.fetchall())
+
+    def remove(self, names: Iterable[str]) -> None:
+        with self.connection() as connection:
+            connection.executemany(
+                "DELETE FROM records WHERE name = ?", ((name,) for name in names)
+            )
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        cursor = self.connection().execute(
+            "SELECT name, data FROM records ORDER BY name"
+        )
+        for name, data in cursor:
+            yield name, json.loads(data)
+
+    def close(self) -> None:
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+import gzip
+import re
+import zlib
+
+from src_rest.loaders.utils import BackgroundWriter
+
+SHARD_SUFFIX = ".shards"
+SHARD_PATTERN = re.compile(r"shard_(\d+)\.jsonl\.gz$")
+# Lines per gzip member of a shard, a record is loaded by decompressing its member
+MEMBER_SIZE = 64
+
+
+class ShardCache(ScrapeCache):
+    """Records appended to rotating gzipped json lines shards by one writer thread,
+    fed through a bounded queue. Records are never rewritten: the last one of
+    a name wins, removed names are marked with null records. Each finished shard
+    gets an index file, so that the cache is indexed without reading the shards.
+    Shards are written in small gzip members, and the index holds the offset
+    of the member of each record, so that loading it reads only the member"""
+
+    def __init__(self, path: str, shard_size: int = 1000, queue_size: int = 64) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.writer: Optional[BackgroundWriter] = None
+        self.file: Optional[gzip.GzipFile] = None
+        self.shard = ""
+        self.raw: Optional[BinaryIO] = None
+        self.shard_index: List[list] = []
+        self.member = 0
+        self.member_lines = 0
+        self.written: List[Tuple[str, Optional[dict]]] = []
+        # Records of the shard being written, it can not be read until closed
+        self.recent: Dict[str, Optional[dict]] = {}
+        self._entries: Optional[Dict[str, list]] = None
+
+    @staticmethod
+    def shard_number(shard: str) -> int:
+        return int(cast(Match, SHARD_PATTERN.match(shard)).group(1))
+
+    def shards(self) -> List[str]:
+        names = [name for name in os.listdir(self.path) if SHARD_PATTERN.match(name)]
+        return sorted(names, key=self.shard_number)
+
+    def index_path(self, shard: str) -> str:
+        return os.path.join(self.path, shard.replace(".jsonl.gz", ".index.json"))
+
+    def read_shard(self, shard: str) -> Iterator[Tuple[int, str, Optional[dict], int]]:
+        """Line number, name, record and size of the lines of a shard.
+        A shard cut by a crash is read up to the last complete line"""
+        filename = os.path.join(self.path, shard)
+        try:
+            with gzip.open(filename, "rt", encoding="utf-8") as file:
+                for i, line in enumerate(file):
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        return
+                    yield i, item["name"], item["record"], len(line.encode("utf-8"))
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            return
+
+    def entries(self) -> Dict[str, list]:
+        """[shard, line, ok, dttm, size, member offset, line in member]
+        of the current record of each name"""
+        with self.lock:
+            if self._entries is None:
+                entries: Dict[str, list] = {}
+                for shard in self.shards():
+                    index_path = self.index_path(shard)
+                    if os.path.exists(index_path):
+                        with open(index_path, "r", encoding="utf-8") as file:
+                            for name, *entry in json.load(file):
+                                if len(entry) == 4:
+                                    # Index of a shard of one gzip member
+                                    entry += [0, entry[0]]
+                                entries[name] = [shard, *entry]
+                    else:
+                        for i, name, record, size in self.read_shard(shard):
+                            entries[name] = self._entry(shard, i, record, size)
+                self._entries = {
+                    name: entry
+                    for name, entry in entries.items()
+                    if entry[2] is not None
+                }
+            return self._entries
+
+    @staticmethod
+    def _entry(
+        shard: str,
+        line: int,
+        record: Optional[dict],
+        size: int,
+        offset: int = 0,
+        skip: Optional[int] = None,
+    ) -> list:
+        skip = line if skip is None else skip
+        if record is None:
+            return [shard, line, None, None, size, offset, skip]
+        return [shard, line, record["ok"], record.get("dttm"), size, offset, skip]
+
+    def _close_shard(self) -> None:
+        if self.file is None:
+            return
+        self.file.close()
+        cast(BinaryIO, self.raw).close()
+        with open(self.index_path(self.shard), "w", encoding="utf-8") as file:
+            json.dump(self.shard_index, file)
+        with self.lock:
+            # Records of the closed shard are read from it from now on
+            if self._entries is not None:
+                for name, *entry in self.shard_index:
+                    if entry[1] is None:
+                        self._entries.pop(name, None)
+                    else:
+                        self._entries[name] = [self.shard, *entry]
+            for name, record in self.written:
+                if name in self.recent and self.recent[name] is record:
+                    del self.recent[name]
+        self.file = None
+
+    def _open_shard(self) -> None:
+        shards = self.shards()
+        number = self.shard_number(shards[-1]) + 1 if shards else 0
+        while True:
+            # Exclusive creation, other processes may write to the same cache
+            self.shard = f"shard_{number:05d}.jsonl.gz"
+            try:
+                self.raw = open(os.path.join(self.path, self.shard), "xb")
+                break
+            except FileExistsError:
+                number += 1
+        self._open_member()
+        self.shard_index = []
+        self.written = []
+
+    def _open_member(self) -> None:
+        self.member = cast(BinaryIO, self.raw).tell()
+        self.member_lines = 0
+        self.file = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6)
+
+    def _write(self, item: Tuple[str, Optional[dict]]) -> None:
+        name, record = item
+        if self.file is not None and len(self.shard_index) >= self.shard_size:
+            self._close_shard()
+        if self.file is None:
+            self._open_shard()
+        elif self.member_lines >= MEMBER_SIZE:
+            # Closing the member leaves the shard file open
+            cast(gzip.GzipFile, self.file).close()
+            self._open_member()
+        line = json.dumps({"name": name, "record": record}, ensure_ascii=False)
+        data = (line + "\n").encode("utf-8")
+        cast(gzip.GzipFile, self.file).write(data)
+        entry = self._entry(
+            self.shard,
+            len(self.shard_index),
+            record,
+            len(data),
+            self.member,
+            self.member_lines,
+        )
+        self.member_lines += 1
+        self.shard_index.append([name, *entry[1:]])
+        self.written.append((name, record))
+
+    def put_record(self, name: str, record: Optional[dict]) -> None:
+        with self.lock:
+            if self.writer is None:
+                self.writer = BackgroundWriter(self._write, self.queue_size)
+            writer = self.writer
+            # Visible to load before the writer gets to it
+            self.recent[name] = record
+        writer.put((name, record))
+
+    def dump_many(self, items: Iterable[Tuple[str, dict]]) -> None:
+        for name, data in items:
+            self.put_record(name, data)
+
+    def remove(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.put_record(name, None)
+
+    def names(self) -> List[str]:
+        self.close()
+        return sorted(self.entries())
+
+    def load(self, name: str) -> Optional[dict]:
+        with self.lock:
+            if name in self.recent:
+                return self.recent[name]
+        entry = self.entries().get(name)
+        if entry is None:
+            return None
+        shard, _, _, _, _, offset, skip = entry
+        try:
+            with open(os.path.join(self.path, shard), "rb") as raw:
+                raw.seek(offset)
+                with gzip.GzipFile(fileobj=raw, mode="rb") as file:
+                    # Preceding lines of the member are not decoded
+                    for i, line in enumerate(file):
+                        if i == skip:
+                            return json.loads(line)["record"]
+        except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError):
+            pass
+        return None
+
+    def existing(self, names: Iterable[str]) -> Set[str]:
+        entries = self.entries()
+        with self.lock:
+            recent = dict(self.recent)
+        # Names pending removal are absent, even though still in the index
+        return {
+            name
+            for name in names
+            if (recent[name] is not None if name in recent else name in entries)
+        }
+
+    def index(self, names: Iterable[str]) -> Dict[str, dict]:
+        entries = self.entries()
+        with self.lock:
+            recent = dict(self.recent)
+        result = {}
+        for name in names:
+            if name in recent:
+                record = recent[name]
+                if record is not None:
+                    result[name] = {"ok": record["ok"], "dttm": record.get("dttm")}
+            elif name in entries:
+                result[name] = {"ok": entries[name][2], "dttm": entries[name][3]}
+        return result
+
+    def sizes(self) -> Dict[str, int]:
+        self.close()
+        return {name: entry[4] for name, entry in self.entries().items()}
+
+    def batches(self, n_batches: int = 64) -> List[list]:
+        # Each shard is read sequentially by one job
+        self.close()
+        return [[shard] for shard in self.shards()]
+
+    def iter_batch(self, batch: list) -> Iterator[Tuple[str, dict]]:
+        entries = self.entries()
+        for shard in batch:
+            for i, name, record, _ in self.read_shard(shard):
+                entry = entries.get(name)
+                if record is not None and entry is not None and entry[:2] == [shard, i]:
+                    yield name, record
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        for batch in self.batches():
+            yield from self.iter_batch(batch)
+
+    def close(self) -> None:
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            self._close_shard()
+
+
+def is_sqlite_cache(path: str) -> bool:
+    return path.endswith(SQLITE_SUFFIXES)
+
+
+def file_identity(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return os.getpid(), stat.st_dev, stat.st_ino
+
+
+# Sqlite and shard caches opened by path, with the identity of their file,
+# so that calls given the same path share the connections and the shard writer
+_opened: Dict[str, Tuple[Optional[Tuple[int, int, int]], ScrapeCache]] = {}
+_opened_lock = threading.Lock()
+
+
+def close_opened_caches() -> None:
+    with _opened_lock:
+        caches = [cache for _, cache in _opened.values()]
+        _opened.clear()
+    for cache in caches:
+        cache.close()
+
+
+atexit.register(close_opened_caches)
+
+
+def open_cache(path: Union[str, ScrapeCache]) -> ScrapeCache:
+    """Cache backend by the path suffix: sqlite file for .sqlite/.db, json lines
+    shards for .shards, directory of json files otherwise.
+    A sqlite or shards cache is opened once per path and process"""
+    if isinstance(path, ScrapeCache):
+        return path
+    elif not is_sqlite_cache(path) and not path.rstrip("/").endswith(SHARD_SUFFIX):
+        return ChunkDirCache(path)
+
+    key = os.path.abspath(path)
+    with _opened_lock:
+        identity = file_identity(path)
+        opened = _opened.get(key)
+        # Unless the file was removed and created again meanwhile
+        if opened is not None and identity is not None and opened[0] == identity:
+            return opened[1]
+        cache: ScrapeCache = (
+            SQLiteCache(path) if is_sqlite_cache(path) else ShardCache(path)
+        )
+        _opened[key] = (file_identity(path), cache)
+        return cache
+
+
+def migrate_cache(
+    source: ScrapeCache, destination: ScrapeCache, batch_size: int = 1000
+) -> int:
+    """Copies all records, returns their number"""
+    batch: List[Tuple[str, dict]] = []
+    count = 0
+    for item in source.items():
+        batch.append(item)
+        if len(batch) == batch_size:
+            destination.dump_many(batch)
+            count += len(batch)
+            batch = []
+    destination.dump_many(batch)
+    return count + len(batch)
+
+
+def evict_cache(
+    cache: ScrapeCache,
+    max_age: Optional[float] = None,
+    max_size: Optional[int] = None,
+) -> Tuple[int, int]:
+    """Removes records older than max_age seconds, then the oldest ones
+    until the cache fits max_size bytes. Returns number of removed and kept records"""
+    sizes = cache.sizes()
+    # Ages are taken from the index of each backend, records are not loaded
+    ages = {name: dttm_age(entry["dttm"]) for name, entry in cache.index(sizes).items()}
+    names = sorted(ages, key=ages.__getitem__)
+    removed = []
+    if max_age is not None:
+        while names and ages[names[-1]] >= max_age:
+            removed.append(names.pop())
+    if max_size is not None:
+        size = sum(sizes[name] for name in names)
+        while names and size > max_size:
+            name = names.pop()
+            size -= sizes[name]
+            removed.append(name)
+    cache.remove(removed)
+    return len(removed), len(names)
@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from typing import Dict, Iterable, List, Optional
+
+from src_rest.scrapying.cache import is_sqlite_cache
+
+STATE_NAME = ".crawl_state.json"
+
+
+def crawl_state_path(output: str) -> str:
+    """Default state file of a crawl: inside the output directory,
+    next to the output file for sqlite caches"""
+    if is_sqlite_cache(output):
+        return output + STATE_NAME
+    return os.path.join(output, STATE_NAME)
+
+
+def link_key(link: str) -> str:
+    return link.rstrip("/")
+
+
+class CrawlState:
+    """Frontier of links to fetch and status codes of visited ones,
+    checkpointed to a json file at most every interval seconds.
+    Without path the state is kept in memory only"""
+
+    def __init__(self, path: Optional[str] = None, interval: float = 1) -> None:
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        # The first checkpoint is interval seconds after the start
+        self.saved_at = time.monotonic()
+        self.reset()
+
+    def reset(self, link: Optional[str] = None) -> None:
+        # Ordered like a list, with O(1) removal of visited links
+        self._frontier: Dict[str, None] = {link: None} if link is not None else {}
+        self.visited: Dict[str, Optional[int]] = {}
+        self.seen = {link_key(link)} if link is not None else set()
+
+    def restore(self) -> bool:
+        """Loads unfinished crawl, returns if there is one to resume"""
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        if not state["frontier"]:
+            return False
+        self._frontier = dict.fromkeys(state["frontier"])
+        self.visited = state["visited"]
+        self.seen = set(map(link_key, [*self.frontier, *self.visited]))
+        return True
+
+    @property
+    def frontier(self) -> List[str]:
+        """Links to fetch, in the order they were found"""
+        with self.lock:
+            return list(self._frontier)
+
+    def next_link(self) -> Optional[str]:
+        with self.lock:
+            return next(iter(self._frontier), None)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self.lock:
+            state = {"frontier": list(self._frontier), "visited": dict(self.visited)}
+            self.saved_at = time.monotonic()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(state, file)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def add(self, link: str) -> bool:
+        """Adds link to the frontier, unless it was already seen"""
+        with self.lock:
+            if link_key(link) in self.seen:
+                return False
+            self.seen.add(link_key(link))
+            self._frontier[link] = None
+            return True
+
+    def done(
+        self, link: str, status: Optional[int], links: Iterable[Optional[str]] = ()
+    ) -> List[str]:
+        """Marks link visited and adds links found on its page,
+        returns the new ones. Checkpoints if the interval has passed"""
+        with self.lock:
+            del self._frontier[link]
+            self.visited[link] = status
+        new = [found for found in links if found is not None and self.add(found)]
+        if time.monotonic() - self.saved_at >= self.interval or not self._frontier:
+            self.save()
+        return new
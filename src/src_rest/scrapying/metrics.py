@@ -0,0 +1,298 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from typing import Any, Dict, Optional, Sequence, cast
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PARSE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class Histogram:
+    """Counts of observations per bucket upper bound, as in Prometheus"""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> Dict[str, int]:
+        result = {}
+        total = 0
+        for bound, count in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            total += count
+            result[bound] = total
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"buckets": self.cumulative(), "sum": self.sum, "count": self.count}
+
+
+class StageStats:
+    """Time workers of a pipeline stage spend working and blocked on the next
+    stage. Utilization is busy time per worker per second since the stage started"""
+
+    def __init__(self, n_workers: int) -> None:
+        self.lock = threading.Lock()
+        self.n_workers = n_workers
+        self.started = time.monotonic()
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, busy: float = 0.0, blocked: float = 0.0, items: int = 1) -> None:
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.blocked += blocked
+
+    def utilization(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.busy / max(self.n_workers * elapsed, 1e-9)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "workers": self.n_workers,
+            "items": self.items,
+            "busy": self.busy,
+            "blocked": self.blocked,
+            "utilization": self.utilization(),
+        }
+
+    def summary(self, name: str) -> str:
+        return (
+            f"{name}: {self.n_workers} workers, {self.items} pages, "
+            f"{self.utilization():.0%} busy, {self.blocked:.2f}s blocked"
+        )
+
+
+class ScrapeMetrics:
+    """Thread-safe counters and histograms of a scrape, with a progress line
+    printed at most every progress_interval seconds"""
+
+    def __init__(
+        self, total: Optional[int] = None, progress_interval: float = 5
+    ) -> None:
+        self.lock = threading.Lock()
+        self.total = total
+        self.progress_interval = progress_interval
+        self.started = time.monotonic()
+        self.printed = self.started
+        self.pages = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.statuses: Counter = Counter()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.parse_time = Histogram(PARSE_BUCKETS)
+        self.stages: Dict[str, StageStats] = {}
+
+    def __getstate__(self) -> dict:
+        # Process workers of joblib count to their own copy
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def response(self, status: int, elapsed: float, size: int, retries: int) -> None:
+        with self.lock:
+            self.statuses[status] += 1
+            self.latency.observe(elapsed)
+            self.bytes += size
+            self.retries += retries
+
+    def parsed(self, elapsed: float) -> None:
+        with self.lock:
+            self.parse_time.observe(elapsed)
+
+    def failed(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+    def page(self, cache_hit: bool, n_pages: int = 1) -> None:
+        with self.lock:
+            self.pages += n_pages
+            if cache_hit:
+                self.cache_hits += n_pages
+            else:
+                self.cache_misses += n_pages
+        self.progress()
+
+    def stage(self, name: str, n_workers: int) -> StageStats:
+        """Stats of a pipeline stage, exported with the metrics"""
+        with self.lock:
+            self.stages[name] = StageStats(n_workers)
+            return self.stages[name]
+
+    def cache_hit_ratio(self) -> float:
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total else 0.0
+
+    def progress_line(self) -> str:
+        elapsed = time.monotonic() - self.started
+        total = f"/{self.total}" if self.total is not None else ""
+        not_ok = sum(count for status, count in self.statuses.items() if status >= 400)
+        rate = self.pages / max(elapsed, 1e-9)
+        return (
+            f"Pages: {self.pages}{total}, {rate:.1f} pages/s, "
+            f"cache hits: {self.cache_hit_ratio():.0%}, "
+            f"not ok: {not_ok}, errors: {self.errors}, "
+            f"p50 latency: {self.latency_quantile(0.5):.2f}s"
+        )
+
+    def progress(self, force: bool = False) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.printed < self.progress_interval:
+                return
+            self.printed = now
+            line = self.progress_line()
+        print(line, flush=True)
+
+    def latency_quantile(self, q: float) -> float:
+        """Upper bound of the bucket, which holds the q quantile of latency"""
+        if self.latency.count == 0:
+            return 0.0
+        rank = q * self.latency.count
+        cumulative = self.latency.cumulative().values()
+        for bound, count in zip(self.latency.buckets, cumulative):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "elapsed": time.monotonic() - self.started,
+                "pages": self.pages,
+                "total": self.total,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_ratio": self.cache_hit_ratio(),
+                "bytes": self.bytes,
+                "retries": self.retries,
+                "errors": self.errors,
+                "statuses": {str(key): value for key, value in self.statuses.items()},
+                "latency_seconds": self.latency.snapshot(),
+                "parse_seconds": self.parse_time.snapshot(),
+                "stages": {
+                    name: stage.snapshot() for name, stage in self.stages.items()
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "scraper") -> str:
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name: str, kind: str, help: str) -> None:
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        for name, help in [
+            ("pages", "Pages scraped or restored from cache"),
+            ("cache_hits", "Pages restored from cache"),
+            ("cache_misses", "Pages fetched"),
+            ("bytes", "Bytes of fetched page bodies"),
+            ("retries", "Retried requests"),
+            ("errors", "Pages failed with an exception"),
+        ]:
+            metric(f"{name}_total", "counter", help)
+            lines.append(f"{prefix}_{name}_total {snapshot[name]}")
+
+        metric("responses_total", "counter", "Responses by status code")
+        for status, count in sorted(snapshot["statuses"].items()):
+            lines.append(f'{prefix}_responses_total{{status="{status}"}} {count}')
+
+        for name, help in [
+            ("latency_seconds", "Request latency"),
+            ("parse_seconds", "Page parse time"),
+        ]:
+            metric(name, "histogram", help)
+            histogram = snapshot[name]
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{prefix}_{name}_sum {histogram['sum']}")
+            lines.append(f"{prefix}_{name}_count {histogram['count']}")
+
+        for name, kind, help in [
+            ("workers", "gauge", "Workers of a pipeline stage"),
+            ("busy", "counter", "Seconds workers of a pipeline stage were busy"),
+            ("blocked", "counter", "Seconds a stage was blocked on the next one"),
+            ("utilization", "gauge", "Busy share of the time of stage workers"),
+        ]:
+            if not snapshot["stages"]:
+                break
+            metric(f"stage_{name}", kind, help)
+            for stage, stats in snapshot["stages"].items():
+                lines.append(f'{prefix}_stage_{name}{{stage="{stage}"}} {stats[name]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Writes json snapshot, or Prometheus text format for .prom files"""
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot())
+        # Atomic, so that a collector never reads a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(text)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class MetricsExporter:
+    """Dumps metrics to path every interval seconds on a background thread,
+    and once more on exit"""
+
+    def __init__(
+        self, metrics: ScrapeMetrics, path: Optional[str], interval: float = 15
+    ) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(cast(str, self.path))
+
+    def __enter__(self) -> "MetricsExporter":
+        if self.path is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.path is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.metrics.dump(self.path)
+        self.metrics.progress(force=True)
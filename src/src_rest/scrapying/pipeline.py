@@ -0,0 +1,184 @@
+import multiprocessing
+import threading
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from queue import Empty, Full, Queue
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+from src_rest.scrapying.utils import (
+    JSON_TYPE,
+    dump_to_cache,
+    fetch_page,
+    parse_text,
+    restore_from_cache,
+)
+
+if TYPE_CHECKING:
+    from src_rest.scrapying.scrapers import BaseScraper
+
+# Attributes of the scraper, which parse workers do not need
+# and which do not pickle cheaply or at all
+WORKER_EXCLUDE = ("session", "storage", "scheduler", "links", "metrics", "stats")
+
+_worker_scraper: Any = None
+
+
+def _init_worker(cls: type, state: Dict[str, Any]) -> None:
+    global _worker_scraper
+    _worker_scraper = cls.__new__(cls)
+    _worker_scraper.__dict__.update(state)
+
+
+def _parse_in_worker(url: str, text: str) -> Tuple[JSON_TYPE, float]:
+    scraper = _worker_scraper
+    start = time.perf_counter()
+    data = parse_text(
+        text, url, scraper.parse_data, scraper.parser, scraper.parse_only
+    )
+    return data, time.perf_counter() - start
+
+
+class FetchParsePipeline:
+    """Fetches pages on n_fetchers threads and parses them on n_parsers processes,
+    so that parsing does not hold the GIL the fetch threads need. The stages are
+    connected by a queue of queue_size pages, and at most 2 * n_parsers pages
+    are parsed or waiting for a parser at a time"""
+
+    def __init__(
+        self,
+        scraper: "BaseScraper",
+        n_fetchers: int,
+        n_parsers: int,
+        queue_size: int,
+    ) -> None:
+        self.scraper = scraper
+        self.n_fetchers = n_fetchers
+        self.n_parsers = n_parsers
+        self.queue: Queue = Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.errors: List[BaseException] = []
+
+    def put(self, item: Any) -> float:
+        """Puts item unless stopped, returns time blocked on the full queue"""
+        start = time.perf_counter()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except Full:
+                continue
+        return time.perf_counter() - start
+
+    def fetch(self, link: str, cache: bool) -> None:
+        if self.stopped.is_set():
+            return
+        scraper = self.scraper
+        start = time.perf_counter()
+        try:
+            cached = restore_from_cache(scraper.storage, link) if cache else None
+            data, text = fetch_page(
+                scraper.session,
+                link,
+                scraper.timeout,
+                scraper.raw_dir,
+                cached,
+                scraper.metrics,
+            )
+        except BaseException as e:
+            scraper.metrics.failed()
+            self.errors.append(e)
+            self.stopped.set()
+            return
+        busy = time.perf_counter() - start
+
+        if text is None:
+            # Not modified or failed pages have nothing to parse
+            dump_to_cache(data, scraper.storage, link)
+            scraper.metrics.page(cache_hit=False)
+            blocked = 0.0
+        else:
+            blocked = self.put((link, data, text))
+        self.fetch_stats.add(busy, blocked)
+
+    def close(self, fetches: Iterable[Future]) -> None:
+        wait(fetches)
+        self.put(None)
+
+    def get(self) -> Any:
+        while not self.stopped.is_set():
+            try:
+                return self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return None
+
+    def collect(self, futures: Iterable[Future], pending: Dict[Future, tuple]) -> None:
+        scraper = self.scraper
+        for future in futures:
+            link, data = pending.pop(future)
+            try:
+                info, elapsed = future.result()
+            except BaseException:
+                scraper.metrics.failed()
+                raise
+            scraper.metrics.parsed(elapsed)
+            self.parse_stats.add(elapsed)
+            data["data"] = info
+            dump_to_cache(data, scraper.storage, link)
+            scraper.metrics.page(cache_hit=False)
+
+    def run(self, links: List[Tuple[str, bool]]) -> None:
+        """Scrapes links with the cache flag to scrape them with"""
+        scraper = self.scraper
+        state = {
+            key: value
+            for key, value in vars(scraper).items()
+            if key not in WORKER_EXCLUDE
+        }
+        self.fetch_stats = scraper.metrics.stage("fetch", self.n_fetchers)
+        self.parse_stats = scraper.metrics.stage("parse", self.n_parsers)
+        pending: Dict[Future, tuple] = {}
+
+        # Spawned, since forking a process with running threads may deadlock it
+        with ProcessPoolExecutor(
+            self.n_parsers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(type(scraper), state),
+        ) as parsers, ThreadPoolExecutor(self.n_fetchers) as fetchers:
+            fetches = [fetchers.submit(self.fetch, *item) for item in links]
+            closer = threading.Thread(target=self.close, args=(fetches,), daemon=True)
+            closer.start()
+            try:
+                while True:
+                    item = self.get()
+                    if item is None:
+                        break
+                    link, data, text = item
+                    if len(pending) >= 2 * self.n_parsers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        self.collect(done, pending)
+                    future = parsers.submit(_parse_in_worker, link, text)
+                    pending[future] = (link, data)
+                self.collect(list(pending), pending)
+            finally:
+                self.stopped.set()
+                for future in [*fetches, *pending]:
+                    future.cancel()
+            closer.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def summary(self) -> str:
+        return (
+            f"{self.fetch_stats.summary('Fetch')}\n"
+            f"{self.parse_stats.summary('Parse')}"
+        )
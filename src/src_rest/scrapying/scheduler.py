@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from src_rest.api.utils import AdaptiveRateLimiter
+
+
+class HostScheduler:
+    """Per-host budget of concurrent requests and requests per second.
+    Rate is decreased on throttling responses, Retry-After and server errors,
+    and recovered on healthy responses, see AdaptiveRateLimiter"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        rate: float = 5,
+        hosts: Optional[Dict[str, Tuple[int, float]]] = None,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.hosts = hosts if hosts is not None else {}
+        self._init_state()
+
+    def _init_state(self) -> None:
+        self.lock = threading.Lock()
+        self.semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self.async_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.limiters: Dict[str, AdaptiveRateLimiter] = {}
+
+    def __getstate__(self) -> dict:
+        # Budgets are per process, when the scheduler is sent to joblib workers
+        return {
+            "max_concurrency": self.max_concurrency,
+            "rate": self.rate,
+            "hosts": self.hosts,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._init_state()
+
+    def budget(self, host: str) -> Tuple[int, float]:
+        return self.hosts.get(host, (self.max_concurrency, self.rate))
+
+    def limiter(self, host: str) -> AdaptiveRateLimiter:
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = AdaptiveRateLimiter(self.budget(host)[1])
+            return self.limiters[host]
+
+    def wait(self, host: str) -> None:
+        self.limiter(host).acquire()
+
+    @contextmanager
+    def slot(self, host: str) -> Iterator[None]:
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.budget(host)[0]
+                )
+            semaphore = self.semaphores[host]
+        with semaphore:
+            self.wait(host)
+            yield
+
+    @asynccontextmanager
+    async def slot_async(self, host: str) -> AsyncIterator[None]:
+        with self.lock:
+            if host not in self.async_semaphores:
+                self.async_semaphores[host] = asyncio.Semaphore(self.budget(host)[0])
+            semaphore = self.async_semaphores[host]
+        async with semaphore:
+            await asyncio.sleep(self.limiter(host).reserve())
+            yield
+
+    def feedback(
+        self, host: str, status: Optional[int], retry_after: Optional[float] = None
+    ) -> None:
+        """Adapts host rate to the response status, None for a failed connection"""
+        limiter = self.limiter(host)
+        if status is None or status in (429, 503) or status >= 500:
+            limiter.on_throttle(retry_after)
+        else:
+            limiter.on_success()
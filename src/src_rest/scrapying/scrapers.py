@@ -1,9 +1,18 @@
 from abc import abstractmethod, ABCMeta
-from bs4 import BeautifulSoup
+from collections import deque
+from bs4 import BeautifulSoup, SoupStrainer
 
-from typing import Dict, Optional, List, cast
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional, List, Set, Tuple, cast
 
+from src_rest.scrapying.cache import open_cache
+from src_rest.scrapying.crawl_state import CrawlState
+from src_rest.scrapying.metrics import MetricsExporter, ScrapeMetrics
+from src_rest.scrapying.scheduler import HostScheduler
 from src_rest.scrapying.utils import (
+    ConnectionStats,
+    class_filter,
+    make_soup,
     get_base_url,
     get_session,
     dump_scrape_page,
@@ -11,6 +20,9 @@ from src_rest.scrapying.utils import (
 
 
 class BaseScraper(metaclass=ABCMeta):
+    # Subtrees parse_data reads, the rest of the page is not parsed
+    parse_only: Optional[SoupStrainer] = None
+
     def __init__(
         self,
         output: str,
@@ -20,6 +32,13 @@ class BaseScraper(metaclass=ABCMeta):
         backoff: int = 1,
         timeout: int = 10,
         limit: Optional[int] = None,
+        pool_size: int = 10,
+        scheduler: Optional[HostScheduler] = None,
+        parser: str = "html.parser",
+        raw_dir: Optional[str] = None,
+        ttl: Optional[float] = None,
+        metrics_path: Optional[str] = None,
+        progress_interval: float = 5,
     ) -> None:
         self.headers: Dict[str, str] = {}
 
@@ -27,11 +46,27 @@ class BaseScraper(metaclass=ABCMeta):
         self.backoff = backoff
         self.cache = cache
         self.output = output
+        # Opened once, so that a sqlite cache keeps its connections between pages
+        self.storage = open_cache(output)
         self.user_agent = user_agent
         self.timeout = timeout
-
+        self.scheduler = scheduler
+        self.parser = parser
+        self.raw_dir = raw_dir
+        # Seconds cached pages are fresh for, then they are revalidated
+        self.ttl = ttl
+        # Prometheus text (.prom) or json file, refreshed while scraping
+        self.metrics_path = metrics_path
+        self.metrics = ScrapeMetrics(progress_interval=progress_interval)
+
+        self.stats = ConnectionStats()
         self.session = get_session(
-            self.n_retries, self.backoff, user_agent=self.user_agent
+            self.n_retries,
+            self.backoff,
+            user_agent=self.user_agent,
+            pool_size=pool_size,
+            stats=self.stats,
+            scheduler=self.scheduler,
         )
         self.limit = limit
 
@@ -39,6 +74,22 @@ class BaseScraper(metaclass=ABCMeta):
     def parse_data(self, soup: BeautifulSoup) -> dict:
         pass
 
+    def parse_func(self, record: dict) -> Callable[[BeautifulSoup], dict]:
+        """Function, which parses data of the scraped record"""
+        return self.parse_data
+
+    def reparse(self, record: dict, text: str) -> dict:
+        """Record with data parsed again from the stored page text"""
+        func = self.parse_func(record)
+        try:
+            data = func(make_soup(text, self.parser, self.parse_only))
+        except Exception as e:
+            raise ValueError(
+                f"{func.__name__} failed on link {record['url']} "
+                f"with exception:\n{str(e)}"
+            )
+        return dict(record, data=data)
+
 
 class BaseCrawler(BaseScraper):
     def __init__(
@@ -51,20 +102,66 @@ class BaseCrawler(BaseScraper):
         backoff: int = 1,
         timeout: int = 10,
         limit: Optional[int] = None,
+        scheduler: Optional[HostScheduler] = None,
+        frontier: bool = False,
+        n_jobs: int = 10,
+        parser: str = "html.parser",
+        raw_dir: Optional[str] = None,
+        ttl: Optional[float] = None,
+        state: Optional[str] = None,
+        metrics_path: Optional[str] = None,
+        progress_interval: float = 5,
     ) -> None:
-        super().__init__(output, user_agent, cache, n_retries, backoff, timeout, limit)
+        super().__init__(
+            output,
+            user_agent,
+            cache,
+            n_retries,
+            backoff,
+            timeout,
+            limit,
+            pool_size=max(n_jobs, 10),
+            scheduler=scheduler,
+            parser=parser,
+            raw_dir=raw_dir,
+            ttl=ttl,
+            metrics_path=metrics_path,
+            progress_interval=progress_interval,
+        )
         self.base_url = get_base_url(link)
         self.link = link
+        self.frontier = frontier
+        self.n_jobs = n_jobs
+        # Checkpointed crawl state, to resume an interrupted crawl
+        self.state = CrawlState(state)
+        self.state.reset(link)
 
     @abstractmethod
     def get_next_link(self, soup: BeautifulSoup) -> Optional[str]:
         pass
 
+    def get_links(self, soup: BeautifulSoup) -> List[str]:
+        """All page links found on the page, to be crawled in frontier mode,
+        the next link by default"""
+        return [link for link in [self.get_next_link(soup)] if link is not None]
+
     def parse(self, soup: BeautifulSoup) -> dict:
         data = self.parse_data(soup)
         data["next_link"] = self.get_next_link(soup)
         return data
 
+    def parse_frontier(self, soup: BeautifulSoup) -> dict:
+        data = self.parse_data(soup)
+        data["links"] = self.get_links(soup)
+        return data
+
+    def parse_func(self, record: dict) -> Callable[[BeautifulSoup], dict]:
+        # next_link is found relative to the page link
+        self.link = record["url"]
+        if "links" in record["data"]:
+            return self.parse_frontier
+        return self.parse
+
     def get_data(self) -> None:
 
         data = cast(
@@ -74,31 +171,123 @@ class BaseCrawler(BaseScraper):
                 self.link,
                 self.timeout,
                 self.parse,
-                self.output,
+                self.storage,
                 self.cache,
                 return_data=True,
+                verbose=False,
+                parser=self.parser,
+                parse_only=self.parse_only,
+                raw_dir=self.raw_dir,
+                ttl=self.ttl,
+                metrics=self.metrics,
             ),
         )
+        link = cast(str, self.link)
         self.link = data["data"].get("next_link", None)
+        self.state.done(link, data["status_code"], [self.link])
 
     def load_data(self) -> None:
-        if self.link is None:
-            return
+        if self.state.restore():
+            print(
+                f"Resuming crawl: {len(self.state.frontier)} pages in frontier, "
+                f"{len(self.state.visited)} visited"
+            )
+        else:
+            self.state.reset(self.link)
+        try:
+            with MetricsExporter(self.metrics, self.metrics_path):
+                if self.frontier:
+                    self.load_frontier()
+                else:
+                    self.load_sequential()
+        finally:
+            self.state.save()
+            self.storage.close()
+        print(self.stats.summary())
+
+    def load_sequential(self) -> None:
         i = 0
-        while True:
-            print(f"Parsing data from {self.link}")
+        link = self.state.next_link()
+        while link is not None:
+            self.link = link
             self.get_data()
             i += 1
-            if self.link is None or (self.limit is not None and self.limit == i):
+            link = self.state.next_link()
+            if link is None or (self.limit is not None and self.limit == i):
                 print("Terminating!")
                 break
 
+    def load_frontier(self) -> None:
+        """Fetches n_jobs pages at a time from the frontier of page links found so far,
+        instead of following next_link one page after another"""
+        pending: Dict[Future, str] = {}
+        n_pages = 0
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+
+            def submit(link: str) -> None:
+                nonlocal n_pages
+                n_pages += 1
+                future = executor.submit(
+                    dump_scrape_page,
+                    self.session,
+                    link,
+                    self.timeout,
+                    self.parse_frontier,
+                    self.storage,
+                    self.cache,
+                    return_data=True,
+                    verbose=False,
+                    parser=self.parser,
+                    parse_only=self.parse_only,
+                    raw_dir=self.raw_dir,
+                    ttl=self.ttl,
+                    metrics=self.metrics,
+                )
+                pending[future] = link
+
+            # Frontier links not submitted yet, in the order they were found
+            queued = deque(self.state.frontier)
+
+            def fill() -> None:
+                # Links above the limit stay in the frontier for the next run
+                while queued and (self.limit is None or n_pages < self.limit):
+                    submit(queued.popleft())
+
+            try:
+                fill()
+                while pending:
+                    done: Set[Future]
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        link = pending.pop(future)
+                        result = cast(dict, future.result())
+                        page = result["data"]
+                        # Pages cached by the sequential crawl have only next_link
+                        links = page.get("links", [page.get("next_link")])
+                        queued.extend(
+                            self.state.done(link, result["status_code"], links)
+                        )
+                    fill()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        print("Terminating!")
+
 
 from urllib.parse import urljoin
 from bs4.element import Tag
 
 
 class MosRestCrawler(BaseCrawler):
+    parse_only = SoupStrainer(
+        ["ul", "div"],
+        class_=class_filter(
+            "l-restaurants", "l-restaurants-vertical", "restaurants_rating"
+        ),
+    )
+
     def parse_data(self, soup: BeautifulSoup) -> Dict[str, list]:
         rests_upper = soup.find("ul", class_="l-restaurants clearfix")
         rests_vertical = soup.find("ul", class_="l-restaurants-vertical clearfix")
@@ -112,7 +301,7 @@ class MosRestCrawler(BaseCrawler):
             cards1 = []
         return {"cards": list(map(str, cards0 + cards1))}
 
-    def get_next_link(self, soup: BeautifulSoup) -> Optional[str]:
+    def get_links(self, soup: BeautifulSoup) -> List[str]:
         parent = soup.find("div", class_="restaurants_rating clearfix")
         if isinstance(parent, Tag):
             pagination_item = parent.find(
@@ -121,13 +310,19 @@ class MosRestCrawler(BaseCrawler):
             if isinstance(pagination_item, Tag):
                 pagination = pagination_item.find_all("a")
             else:
-                return None
+                return []
         else:
-            return None
+            return []
 
+        return [
+            urljoin(self.base_url, path.attrs["href"])
+            for path in pagination
+            if "href" in path.attrs
+        ]
+
+    def get_next_link(self, soup: BeautifulSoup) -> Optional[str]:
         flag = False
-        for path in pagination:
-            url = urljoin(self.base_url, path.attrs["href"])
+        for url in self.get_links(soup):
             if flag:
                 return url
 
@@ -136,8 +331,19 @@ class MosRestCrawler(BaseCrawler):
         return None
 
 
+import asyncio
+import os
+
 from joblib import Parallel, delayed
 
+from src_rest.scrapying.cache import SHARD_SUFFIX, ShardCache, record_name
+from src_rest.scrapying.utils import (
+    dump_scrape_page_async,
+    get_session_async,
+    is_fresh,
+)
+from src_rest.scrapying.pipeline import FetchParsePipeline
+
 
 class BaseLinkScraper(BaseScraper):
     def __init__(
@@ -152,41 +358,187 @@ class BaseLinkScraper(BaseScraper):
         limit: Optional[int] = None,
         n_jobs: int = -1,
         backend: str = "threading",
+        scheduler: Optional[HostScheduler] = None,
+        parser: str = "html.parser",
+        raw_dir: Optional[str] = None,
+        ttl: Optional[float] = None,
+        metrics_path: Optional[str] = None,
+        progress_interval: float = 5,
+        n_parsers: int = -1,
+        queue_size: Optional[int] = None,
     ) -> None:
-        super().__init__(output, user_agent, cache, n_retries, backoff, timeout, limit)
-        self.links = links
         self.backend = backend
-        if backend == "threading" and n_jobs == -1:
+        if backend in ("threading", "pipeline") and n_jobs == -1:
             self.n_jobs = 30
+        elif backend == "asyncio" and n_jobs == -1:
+            self.n_jobs = 100
         else:
             self.n_jobs = n_jobs
+        # With pipeline backend, n_jobs threads fetch and n_parsers processes parse
+        self.n_parsers = n_parsers if n_parsers != -1 else os.cpu_count() or 1
+        self.queue_size = queue_size if queue_size is not None else 4 * self.n_parsers
+        # Every thread should be able to keep its connection alive
+        pool_size = max(self.n_jobs, 10)
+        super().__init__(
+            output,
+            user_agent,
+            cache,
+            n_retries,
+            backoff,
+            timeout,
+            limit,
+            pool_size,
+            scheduler,
+            parser,
+            raw_dir,
+            ttl,
+            metrics_path,
+            progress_interval,
+        )
+        self.links = links
+        # Records of a shard cache are written by a thread of this process,
+        # workers of process backends would lose theirs
+        if backend not in ("threading", "asyncio", "pipeline") and isinstance(
+            self.storage, ShardCache
+        ):
+            raise ValueError(
+                f"{backend} backend can not write to a {SHARD_SUFFIX} cache, "
+                "use threading, asyncio or pipeline backend"
+            )
 
         if limit is not None:
             self.links = self.links[:limit]
+        self.metrics.total = len(self.links)
+
+    def partition_links(self) -> Dict[str, List[str]]:
+        """Links by their state in the cache, from one index lookup instead of
+        a probe per link: fresh hits, stale entries to revalidate and misses"""
+        links: Dict[str, List[str]] = {"hits": [], "stale": [], "misses": []}
+        if not self.cache:
+            links["misses"] = list(self.links)
+            return links
+
+        index = self.storage.index(map(record_name, self.links))
+        for link in self.links:
+            entry = index.get(record_name(link))
+            if entry is None or not entry["ok"]:
+                links["misses"].append(link)
+            elif is_fresh(entry, self.ttl):
+                links["hits"].append(link)
+            else:
+                links["stale"].append(link)
+        print(
+            f"Cache hits: {len(links['hits'])}, misses: {len(links['misses'])}, "
+            f"stale: {len(links['stale'])}"
+        )
+        # Fresh hits are not restored at all, so they are counted here
+        self.metrics.page(cache_hit=True, n_pages=len(links["hits"]))
+        return links
+
+    def links_to_fetch(self) -> List[Tuple[str, bool]]:
+        """Misses and stale links, with the cache flag to scrape them with"""
+        links = self.partition_links()
+        # Only stale entries are restored, to revalidate them with conditional requests
+        fetch = [(link, False) for link in links["misses"]]
+        fetch += [(link, True) for link in links["stale"]]
+        return fetch
 
     def load_data(self) -> None:
+        try:
+            with MetricsExporter(self.metrics, self.metrics_path):
+                if self.backend == "asyncio":
+                    asyncio.run(self.load_data_async())
+                elif self.backend == "pipeline":
+                    self.load_data_pipeline()
+                else:
+                    self.load_data_parallel()
+        finally:
+            self.storage.close()
+        print(self.stats.summary())
 
+    def load_data_parallel(self) -> None:
+        fetch = self.links_to_fetch()
         result = map(
             delayed(
                 lambda x: dump_scrape_page(
                     self.session,
-                    x,
+                    x[0],
                     self.timeout,
                     self.parse_data,
-                    self.output,
-                    self.cache,
+                    self.storage,
+                    x[1],
+                    verbose=False,
+                    parser=self.parser,
+                    parse_only=self.parse_only,
+                    raw_dir=self.raw_dir,
+                    ttl=self.ttl,
+                    metrics=self.metrics,
                 )
             ),
-            self.links,
+            fetch,
         )
 
-        Parallel(n_jobs=self.n_jobs, backend=self.backend)(result)
+        if fetch:
+            Parallel(n_jobs=self.n_jobs, backend=self.backend)(result)
+
+    def load_data_pipeline(self) -> None:
+        """Fetches links on n_jobs threads and parses pages on n_parsers processes"""
+        fetch = self.links_to_fetch()
+        if fetch:
+            pipeline = FetchParsePipeline(
+                self, self.n_jobs, self.n_parsers, self.queue_size
+            )
+            pipeline.run(fetch)
+            print(pipeline.summary())
+
+    async def load_data_async(self) -> None:
+        """Fetches links concurrently from one event loop, by n_jobs tasks
+        taking the next link when done with theirs"""
+        fetch = self.links_to_fetch()
+        links = iter(fetch)
+
+        async with get_session_async(
+            self.n_jobs, self.timeout, self.user_agent, self.stats
+        ) as session:
+
+            async def load() -> None:
+                for link, cache in links:
+                    await dump_scrape_page_async(
+                        session,
+                        link,
+                        self.timeout,
+                        self.parse_data,
+                        self.storage,
+                        cache,
+                        verbose=False,
+                        n_retries=self.n_retries,
+                        backoff=self.backoff,
+                        scheduler=self.scheduler,
+                        parser=self.parser,
+                        parse_only=self.parse_only,
+                        raw_dir=self.raw_dir,
+                        ttl=self.ttl,
+                        metrics=self.metrics,
+                    )
+
+            n_tasks = min(self.n_jobs, len(fetch))
+            tasks = [asyncio.ensure_future(load()) for _ in range(n_tasks)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
 
 
 import re
 
 
 class MosRestScraper(BaseLinkScraper):
+    parse_only = SoupStrainer(
+        "div",
+        class_=class_filter("col_img", "data", "rest_stats", "item-review-col_right"),
+    )
+
     def parse_data(self, soup: BeautifulSoup) -> dict:
 
         pattern = "Placemark\\(\\[(\\d+\\.\\d+),\\ (\\d+.\\d+)\\]"
@@ -2,14 +2,14 @@ import datetime
 import hashlib
 import json
 import os
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from requests import Session, Response
 from requests.adapters import HTTPAdapter, Retry
 
 from urllib.parse import urlparse
 
-from typing import Dict, Any, Union, Optional, Callable, Tuple
+from typing import Dict, Any, Union, Optional, Callable, Tuple, Type, cast
 
 JSON_TYPE = Union[list, dict]
 
@@ -46,42 +46,298 @@ def load_json(filename: str) -> JSON_TYPE:
     return obj
 
 
-def restore_from_cache(input: str, url: str) -> Optional[dict]:
-    hash_url = f"chunk_{hash256(url)}.json"
-    filename = os.path.join(input, hash_url)
-    result = None
+from src_rest.scrapying.cache import ScrapeCache, open_cache, record_age
+
+CACHE_TYPE = Union[str, ScrapeCache]
+
+
+def restore_from_cache(input: CACHE_TYPE, url: str) -> Optional[dict]:
+    data = open_cache(input).get(url)
+    if data is None:
+        return None
+    elif not isinstance(data, dict):
+        raise TypeError("restore_from_cache supports only dict jsons")
+    elif data["ok"]:
+        return data
+    else:
+        return None
+
+
+def dump_to_cache(data: JSON_TYPE, output: CACHE_TYPE, url: str) -> None:
+    # Cache opened by path is shared with other calls, and closed at exit
+    open_cache(output).put(url, cast(dict, data))
+
+
+def is_fresh(record: dict, ttl: Optional[float]) -> bool:
+    """Cached record is fresh for ttl seconds, forever without ttl"""
+    return ttl is None or record_age(record) < ttl
+
+
+def conditional_headers(record: Optional[dict]) -> Dict[str, str]:
+    """Validators of the cached page, so that unchanged page is answered with 304"""
+    if record is None:
+        return {}
+    stored = {key.lower(): value for key, value in record["headers"].items()}
+    headers = {}
+    if "etag" in stored:
+        headers["If-None-Match"] = stored["etag"]
+    if "last-modified" in stored:
+        headers["If-Modified-Since"] = stored["last-modified"]
+    return headers
+
+
+def revalidated(record: dict, meta: Dict[str, Any]) -> dict:
+    """Cached record confirmed by 304 response, with its data kept"""
+    return dict(
+        record,
+        elapsed=meta["elapsed"],
+        dttm=meta["dttm"],
+        headers=dict(record["headers"], **meta["headers"]),
+    )
+
+
+import gzip
+import tempfile
+
+
+def raw_path(raw_dir: str, sha256: str) -> str:
+    return os.path.join(raw_dir, sha256[:2], f"{sha256}.html.gz")
+
+
+def dump_raw(raw_dir: str, text: str, sha256: str) -> None:
+    """Saves page body compressed, addressed by sha256 of its text,
+    so identical pages are stored once"""
+    filename = raw_path(raw_dir, sha256)
     if os.path.exists(filename):
-        data = load_json(filename)
-        if not isinstance(data, dict):
-            raise TypeError("restore_from_cache supports only dict jsons")
-        elif data["ok"]:
-            result = data
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(gzip.compress(text.encode("utf-8"), compresslevel=6))
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_raw(raw_dir: str, sha256: str) -> Optional[str]:
+    filename = raw_path(raw_dir, sha256)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as file:
+        return gzip.decompress(file.read()).decode("utf-8")
+
+
+import threading
+import time
+
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError
+
+
+class ConnectionStats:
+    """Thread-safe counters of requests, new connections and time spent connecting,
+    to check that keep-alive connections are reused"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.connect_time = 0.0
+
+    def __getstate__(self) -> dict:
+        # Process workers of joblib count to their own copy
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def requested(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def connected(self, elapsed: float) -> None:
+        with self.lock:
+            self.new_connections += 1
+            self.connect_time += elapsed
+
+    @property
+    def reused_connections(self) -> int:
+        return max(0, self.requests - self.new_connections)
+
+    def summary(self) -> str:
+        return (
+            f"Requests: {self.requests}, new connections: {self.new_connections}, "
+            f"reused connections: {self.reused_connections}, "
+            f"connect and handshake time: {self.connect_time:.2f}s"
+        )
+
+
+def _instrumented_pool(
+    pool_cls: Type[HTTPConnectionPool], stats: ConnectionStats
+) -> Type[HTTPConnectionPool]:
+    class Connection(pool_cls.ConnectionCls):  # type: ignore
+        def connect(self) -> None:
+            start = time.perf_counter()
+            super().connect()
+            stats.connected(time.perf_counter() - start)
+
+        def request(self, *args, **kwargs):
+            stats.requested()
+            return super().request(*args, **kwargs)
+
+    class Pool(pool_cls):  # type: ignore
+        ConnectionCls = Connection
+
+    return Pool
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter, which connections report to stats"""
+
+    def __init__(self, stats: Optional[ConnectionStats], **kwargs) -> None:
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        if self.stats is not None:
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": _instrumented_pool(HTTPConnectionPool, self.stats),
+                "https": _instrumented_pool(HTTPSConnectionPool, self.stats),
+            }
+
+    def __setstate__(self, state) -> None:
+        # stats is not pickled with the adapter, so joblib process workers
+        # count to their own stats
+        self.stats = ConnectionStats()
+        super().__setstate__(state)
+
+
+from src_rest.api.utils import parse_retry_after
+from src_rest.scrapying.scheduler import HostScheduler
+
+
+class ScheduledRetry(Retry):
+    """Retry, which reports failed attempts to scheduler
+    and waits for the host rate budget before the next attempt"""
+
+    def __init__(
+        self,
+        *args,
+        scheduler: Optional[HostScheduler] = None,
+        host: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.host = host
+
+    def new(self, **kwargs) -> "ScheduledRetry":
+        retry = cast(ScheduledRetry, super().new(**kwargs))
+        retry.scheduler = self.scheduler
+        retry.host = self.host
+        return retry
+
+    def increment(  # type: ignore
+        self,
+        method=None,
+        url=None,
+        response=None,
+        error=None,
+        _pool=None,
+        _stacktrace=None,
+    ) -> "ScheduledRetry":
+        try:
+            retry = cast(
+                ScheduledRetry,
+                super().increment(method, url, response, error, _pool, _stacktrace),
+            )
+        except MaxRetryError:
+            # Response of the last attempt is returned to ScheduledAdapter,
+            # which reports it, unless it is raised on
+            if response is None or self.raise_on_status:
+                self.feedback(_pool, response)
+            raise
+        self.feedback(_pool, response)
+        if _pool is not None:
+            retry.host = _pool.host
+        return retry
+
+    def feedback(self, pool, response) -> None:
+        """Reports a failed attempt, each attempt is reported once"""
+        if self.scheduler is None or pool is None:
+            return
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            self.scheduler.feedback(pool.host, response.status, retry_after)
         else:
-            result = None
-    else:
-        result = None
-    return result
+            self.scheduler.feedback(pool.host, None)
 
+    def sleep(self, response=None) -> None:
+        super().sleep(response)
+        if self.scheduler is not None and self.host is not None:
+            self.scheduler.wait(self.host)
 
-def dump_to_cache(data: JSON_TYPE, output: str, url: str) -> None:
-    hash_url = f"chunk_{hash256(url)}.json"
-    filename = os.path.join(output, hash_url)
-    dump_json(data, filename)
+
+class ScheduledAdapter(InstrumentedAdapter):
+    """HTTPAdapter, which sends every request within the host budget of scheduler"""
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["scheduler"]
+
+    def __init__(
+        self,
+        scheduler: HostScheduler,
+        stats: Optional[ConnectionStats] = None,
+        **kwargs,
+    ) -> None:
+        self.scheduler = scheduler
+        super().__init__(stats, **kwargs)
+
+    def send(self, request, *args, **kwargs) -> Response:  # type: ignore
+        host = cast(str, urlparse(request.url).hostname)
+        with self.scheduler.slot(host):
+            response = super().send(request, *args, **kwargs)
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        self.scheduler.feedback(host, response.status_code, retry_after)
+        return response
 
 
 def get_session(
     n_retries: int,
     backoff: int,
-    status_forcelist: list = [500, 502, 503, 504],
+    status_forcelist: Tuple[int, ...] = (500, 502, 503, 504),
     user_agent: Optional[str] = None,
+    pool_size: int = 10,
+    stats: Optional[ConnectionStats] = None,
+    scheduler: Optional[HostScheduler] = None,
 ) -> Session:
+    """Session with pool_size connections kept alive per host,
+    should be at least the number of threads using the session.
+    With scheduler every request, including retries, waits for the host budget"""
     session = Session()
-    retries = Retry(
+    retries = ScheduledRetry(
         total=n_retries,
         backoff_factor=backoff,
         status_forcelist=status_forcelist,
+        scheduler=scheduler,
     )
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+    for prefix in ("http://", "https://"):
+        if scheduler is not None:
+            adapter: HTTPAdapter = ScheduledAdapter(
+                scheduler, stats, max_retries=retries, pool_maxsize=pool_size
+            )
+        elif stats is not None:
+            adapter = InstrumentedAdapter(
+                stats, max_retries=retries, pool_maxsize=pool_size
+            )
+        else:
+            adapter = HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
+        session.mount(prefix, adapter)
 
     if user_agent is not None:
         session.headers.update({"User-Agent": user_agent})
@@ -94,28 +350,100 @@ def get_base_url(url: str) -> str:
     return f"{parsed.scheme}://{parsed.netloc}"
 
 
-def scrape_page(
-    session: Session,
+def class_filter(*classes: str) -> Callable[[Any], bool]:
+    """Matches tags with any of classes. Use it for SoupStrainer(class_=...) instead
+    of a list, since while parsing class attribute is still an unsplit string"""
+
+    def match(value: Any) -> bool:
+        if value is None:
+            return False
+        values = value.split() if isinstance(value, str) else value
+        return any(item in classes for item in values)
+
+    return match
+
+
+def make_soup(
+    text: str, parser: str = "html.parser", parse_only: Optional[SoupStrainer] = None
+) -> BeautifulSoup:
+    """Soup of the page, with only subtrees matching parse_only if given"""
+    return BeautifulSoup(text, parser, parse_only=parse_only)
+
+
+from src_rest.scrapying.metrics import ScrapeMetrics
+
+
+def parse_text(
+    text: str,
     url: str,
-    timeout: int,
     func: Callable[[BeautifulSoup], JSON_TYPE],
+    parser: str = "html.parser",
+    parse_only: Optional[SoupStrainer] = None,
+    metrics: Optional[ScrapeMetrics] = None,
 ) -> JSON_TYPE:
+    start = time.perf_counter()
+    try:
+        info = func(make_soup(text, parser, parse_only))
+    except Exception as e:
+        raise ValueError(
+            f"{func.__name__} failed on link {url} with exception:\n{str(e)}"
+        )
+    if metrics is not None:
+        metrics.parsed(time.perf_counter() - start)
+    return info
+
 
-    response = session.get(url, timeout=timeout)
+def fetch_page(
+    session: Session,
+    url: str,
+    timeout: int,
+    raw_dir: Optional[str] = None,
+    cached: Optional[dict] = None,
+    metrics: Optional[ScrapeMetrics] = None,
+) -> Tuple[dict, Optional[str]]:
+    """Record of the page without parsed data and the text to parse it from.
+    Text is None, when there is nothing to parse and the record is complete"""
+
+    headers = conditional_headers(cached)
+    response = session.get(url, timeout=timeout, headers=headers)
     meta = response_meta(response)
+    if metrics is not None:
+        retries = getattr(response.raw, "retries", None)
+        metrics.response(
+            response.status_code,
+            meta["elapsed"],
+            len(response.content),
+            len(retries.history) if isinstance(retries, Retry) else 0,
+        )
+    if cached is not None and response.status_code == 304:
+        return revalidated(cached, meta), None
     data = meta.copy()
 
+    if raw_dir is not None and response.ok:
+        dump_raw(raw_dir, response.text, meta["sha256"])
+
     if not response.ok:
         data["data"] = {}
-        return data
-    try:
-        info = func(BeautifulSoup(response.text, "html.parser"))
-        data["data"] = info
-        return data
-    except Exception as e:
-        raise ValueError(
-            f"{func.__name__} failed on link {url} with exception:\n{str(e)}"
-        )
+        return data, None
+    return data, response.text
+
+
+def scrape_page(
+    session: Session,
+    url: str,
+    timeout: int,
+    func: Callable[[BeautifulSoup], JSON_TYPE],
+    parser: str = "html.parser",
+    parse_only: Optional[SoupStrainer] = None,
+    raw_dir: Optional[str] = None,
+    cached: Optional[dict] = None,
+    metrics: Optional[ScrapeMetrics] = None,
+) -> JSON_TYPE:
+
+    data, text = fetch_page(session, url, timeout, raw_dir, cached, metrics)
+    if text is not None:
+        data["data"] = parse_text(text, url, func, parser, parse_only, metrics)
+    return data
 
 
 def dump_scrape_page(
@@ -123,28 +451,246 @@ def dump_scrape_page(
     url: str,
     timeout: int,
     func: Callable[[BeautifulSoup], JSON_TYPE],
-    output: str,
+    output: CACHE_TYPE,
     cache: bool = False,
     return_data: bool = False,
-    verbose: bool = True,
+    verbose: bool = False,
+    parser: str = "html.parser",
+    parse_only: Optional[SoupStrainer] = None,
+    raw_dir: Optional[str] = None,
+    ttl: Optional[float] = None,
+    metrics: Optional[ScrapeMetrics] = None,
 ) -> Optional[JSON_TYPE]:
 
-    if cache:
-        cached_data = restore_from_cache(output, url)
+    cached_data = restore_from_cache(output, url) if cache else None
 
-    if not cache or cached_data is None:
+    if cached_data is None or not is_fresh(cached_data, ttl):
         if verbose:
             print(f"Parsing data from {url}")
-        data = scrape_page(session, url, timeout, func)
+        try:
+            data = scrape_page(
+                session,
+                url,
+                timeout,
+                func,
+                parser,
+                parse_only,
+                raw_dir,
+                cached_data,
+                metrics,
+            )
+        except Exception:
+            if metrics is not None:
+                metrics.failed()
+            raise
         dump_to_cache(data, output, url)
-        if return_data:
-            return data
-        else:
-            return None
     else:
         if verbose:
             print(f"Restoring data from {url}")
-        if return_data:
-            return cached_data
-        else:
-            return None
+        data = cached_data
+
+    if metrics is not None:
+        metrics.page(cache_hit=data is cached_data)
+    if return_data:
+        return data
+    else:
+        return None
+
+
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout
+from aiohttp import TCPConnector, TraceConfig
+
+
+def connection_trace_config(stats: ConnectionStats) -> TraceConfig:
+    """Reports aiohttp requests and new connections to stats"""
+
+    async def on_request_start(session, context, params) -> None:
+        stats.requested()
+
+    async def on_connection_create_start(session, context, params) -> None:
+        context.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params) -> None:
+        stats.connected(time.perf_counter() - context.connect_start)
+
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def get_session_async(
+    limit: int,
+    timeout: float,
+    user_agent: Optional[str] = None,
+    stats: Optional[ConnectionStats] = None,
+) -> ClientSession:
+    """Aiohttp session with at most limit connections, to be created in a running loop"""
+    headers = {"User-Agent": user_agent} if user_agent is not None else None
+    trace_configs = [connection_trace_config(stats)] if stats is not None else None
+    return ClientSession(
+        connector=TCPConnector(limit=limit),
+        timeout=ClientTimeout(total=timeout),
+        headers=headers,
+        trace_configs=trace_configs,
+    )
+
+
+def response_meta_async(
+    response: ClientResponse, text: str, elapsed: float
+) -> Dict[str, Any]:
+
+    meta = {
+        "ok": response.ok,
+        "elapsed": elapsed,
+        "status_code": response.status,
+        "reason": response.reason,
+        "url": str(response.url),
+        "encoding": response.get_encoding(),
+        "headers": dict(response.headers),
+        "dttm": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "sha256": hash256(text),
+    }
+
+    return meta
+
+
+@asynccontextmanager
+async def _no_slot() -> AsyncIterator[None]:
+    yield
+
+
+async def scrape_page_async(
+    session: ClientSession,
+    url: str,
+    timeout: int,
+    func: Callable[[BeautifulSoup], JSON_TYPE],
+    n_retries: int = 10,
+    backoff: float = 1,
+    status_forcelist: Tuple[int, ...] = (500, 502, 503, 504),
+    scheduler: Optional[HostScheduler] = None,
+    parser: str = "html.parser",
+    parse_only: Optional[SoupStrainer] = None,
+    raw_dir: Optional[str] = None,
+    cached: Optional[dict] = None,
+    metrics: Optional[ScrapeMetrics] = None,
+) -> JSON_TYPE:
+    """Same as scrape_page, retrying failed requests like the session of get_session"""
+    host = cast(str, urlparse(url).hostname)
+    headers = conditional_headers(cached)
+    for attempt in range(n_retries + 1):
+        last_attempt = attempt == n_retries
+        retry_after = None
+        slot = scheduler.slot_async(host) if scheduler is not None else _no_slot()
+        async with slot:
+            start = time.monotonic()
+            try:
+                async with session.get(
+                    url, timeout=ClientTimeout(total=timeout), headers=headers
+                ) as response:
+                    text = await response.text()
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if scheduler is not None:
+                        scheduler.feedback(host, response.status, retry_after)
+                    if last_attempt or response.status not in status_forcelist:
+                        elapsed = time.monotonic() - start
+                        meta = response_meta_async(response, text, elapsed)
+                        size = len(await response.read())
+                        break
+            except (ClientError, asyncio.TimeoutError):
+                if scheduler is not None:
+                    scheduler.feedback(host, None)
+                if last_attempt:
+                    raise
+        # With scheduler, Retry-After pauses all requests to the host
+        if retry_after is not None and scheduler is None:
+            await asyncio.sleep(retry_after)
+        elif attempt > 0:
+            await asyncio.sleep(backoff * 2 ** (attempt - 1))
+
+    if metrics is not None:
+        metrics.response(meta["status_code"], meta["elapsed"], size, attempt)
+    if cached is not None and meta["status_code"] == 304:
+        return revalidated(cached, meta)
+    data = meta.copy()
+
+    # Blocking work runs on the default executor, not to stall other requests
+    loop = asyncio.get_running_loop()
+    if raw_dir is not None and meta["ok"]:
+        await loop.run_in_executor(None, dump_raw, raw_dir, text, meta["sha256"])
+
+    if not meta["ok"]:
+        data["data"] = {}
+        return data
+    data["data"] = await loop.run_in_executor(
+        None, parse_text, text, url, func, parser, parse_only, metrics
+    )
+    return data
+
+
+async def dump_scrape_page_async(
+    session: ClientSession,
+    url: str,
+    timeout: int,
+    func: Callable[[BeautifulSoup], JSON_TYPE],
+    output: CACHE_TYPE,
+    cache: bool = False,
+    return_data: bool = False,
+    verbose: bool = False,
+    n_retries: int = 10,
+    backoff: float = 1,
+    scheduler: Optional[HostScheduler] = None,
+    parser: str = "html.parser",
+    parse_only: Optional[SoupStrainer] = None,
+    raw_dir: Optional[str] = None,
+    ttl: Optional[float] = None,
+    metrics: Optional[ScrapeMetrics] = None,
+) -> Optional[JSON_TYPE]:
+    """Same as dump_scrape_page, on an aiohttp session"""
+    loop = asyncio.get_running_loop()
+    cached_data = (
+        await loop.run_in_executor(None, restore_from_cache, output, url)
+        if cache
+        else None
+    )
+
+    if cached_data is None or not is_fresh(cached_data, ttl):
+        if verbose:
+            print(f"Parsing data from {url}")
+        try:
+            data = await scrape_page_async(
+                session,
+                url,
+                timeout,
+                func,
+                n_retries=n_retries,
+                backoff=backoff,
+                scheduler=scheduler,
+                parser=parser,
+                parse_only=parse_only,
+                raw_dir=raw_dir,
+                cached=cached_data,
+                metrics=metrics,
+            )
+        except Exception:
+            if metrics is not None:
+                metrics.failed()
+            raise
+        await loop.run_in_executor(None, dump_to_cache, data, output, url)
+    else:
+        if verbose:
+            print(f"Restoring data from {url}")
+        data = cached_data
+
+    if metrics is not None:
+        metrics.page(cache_hit=data is cached_data)
+    if return_data:
+        return data
+    else:
+        return None
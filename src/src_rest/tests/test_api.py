@@ -24,9 +24,11 @@ def test_get_query():
         result = get_query(session, query)
 
 
+import os
 import requests_mock
 import json
 from src_rest.api.mosapi import MosApi
+from src_rest.loaders.utils import safe_mkdir
 
 TEST_CONF_API = {
     'n_retries': 1,
@@ -76,6 +78,241 @@ class TestMosApi:
             assert len(data) == 4
             assert data[0] == "d"
 
+    def test_api_throttled(self):
+        api = MosApi("123", rate=100, **TEST_CONF_API)
+        url = "https://apidata.mos.ru/v1/object/96/rows?$skip=3&$top=4&api_key=123"
+        with requests_mock.Mocker() as m:
+            m.get(
+                url,
+                [
+                    {"status_code": 429, "headers": {"Retry-After": "0"}},
+                    {"text": json.dumps(self.data[3:7])},
+                ],
+            )
+            data = api.get("object", "96", 3, 4)
+
+            assert data[0] == "d"
+            assert m.call_count == 2
+            assert api.limiter.rate < 100
+
+            m.get(url, status_code=429, headers={"Retry-After": "0"})
+            with pytest.raises(ValueError):
+                api.get("object", "96", 3, 4)
+
+    def test_api_stream(self):
+        api = MosApi("123", **TEST_CONF_API)
+        rows = [{"global_id": i, "Cells": {"Name": "ё" * i}} for i in range(50)]
+        raw = json.dumps(rows, ensure_ascii=False).encode("utf-8")
+        with requests_mock.Mocker() as m:
+            m.get(
+                "https://apidata.mos.ru/v1/object/96/rows?$skip=0&$top=50&api_key=123",
+                content=raw,
+            )
+            assert list(api.iter_rows("object", "96", 0, 50)) == rows
+
+            safe_mkdir("./test_api_stream")
+            try:
+                n_rows = api.dump(
+                    "object", "96", 0, 50, "./test_api_stream/chunk_0.json"
+                )
+                with open("./test_api_stream/chunk_0.json", "rb") as file:
+                    assert file.read() == raw
+            finally:
+                os.system("rm -rf ./test_api_stream")
+            assert n_rows == 50
+
+
+import glob
+
+from joblib import Parallel, delayed
+from typing import cast
+
+from src_rest.api.cache import ResponseCache
+
+
+class TestResponseCache:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        self.url = "https://apidata.mos.ru/v1/datasets/96/rows?$skip=0&$top=2&api_key={}"
+        self.count_url = "https://apidata.mos.ru/v1/datasets/96/count?&api_key={}"
+        yield
+        os.system("rm -rf ./test_api_cache")
+
+    def test_revalidation(self):
+        cache = ResponseCache("./test_api_cache")
+        api = MosApi("123", cache=cache, **TEST_CONF_API)
+
+        with requests_mock.Mocker() as m:
+            m.get(self.url.format("123"), json=["a", "b"], headers={"ETag": '"v1"'})
+            m.get(self.count_url.format("123"), text="2")
+            assert api.get("datasets", "96", 0, 2) == ["a", "b"]
+            assert api.count("datasets", "96") == 2
+
+            m.get(self.url.format("123"), status_code=304)
+            assert api.get("datasets", "96", 0, 2) == ["a", "b"]
+            assert m.last_request.headers["If-None-Match"] == '"v1"'
+
+            m.get(self.url.format("123"), json=["c"], headers={"ETag": '"v2"'})
+            assert api.get("datasets", "96", 0, 2) == ["c"]
+            assert m.call_count == 4
+
+        # Api key is not a part of the cache key
+        api = MosApi("321", cache=ResponseCache("./test_api_cache", ttl=60))
+        with requests_mock.Mocker() as m:
+            assert api.get("datasets", "96", 0, 2) == ["c"]
+            assert api.count("datasets", "96") == 2
+            assert m.call_count == 0
+
+    def test_eviction(self):
+        cache = ResponseCache("./test_api_cache", max_size=20)
+        api = MosApi("123", cache=cache, **TEST_CONF_API)
+        with requests_mock.Mocker() as m:
+            for skip in range(3):
+                url = self.url.format("123").replace("skip=0", f"skip={skip}")
+                m.get(url, text="[" + ",".join(["1"] * 4) + "]")
+                api.get("datasets", "96", skip, 2)
+
+        assert cache.size <= 20
+        assert len(cache.entries()) == 2
+        assert ResponseCache("./test_api_cache").size == cache.size
+
+    def test_lru(self):
+        cache = ResponseCache("./test_api_cache", ttl=60, max_size=30)
+        for key in "abc":
+            list(cache.store(key, {}, [b"0123456789"]))
+        meta_path = cache.meta_path("a")
+        mtime = os.path.getmtime(meta_path)
+        # A hit reorders the index, without writing the meta file
+        cache.used("a", cast(dict, cache.lookup("a")))
+        assert os.path.getmtime(meta_path) == mtime
+        list(cache.store("d", {}, [b"0123456789"]))
+        assert set(cache.entries()) == {"a", "c", "d"}
+
+        # Stored again, the entry gets a new body and the old one is removed
+        list(cache.store("a", {}, [b"01234"]))
+        assert len(glob.glob("./test_api_cache/*.body")) == 3
+        assert cache.size == 25
+
+        # Bodies and temporary files of interrupted stores are removed
+        for name in ["x.0.body", "tmp0.tmp"]:
+            open(os.path.join("./test_api_cache", name), "wb").close()
+        reopened = ResponseCache("./test_api_cache")
+        assert reopened.entries() == cache.entries()
+        assert len(os.listdir("./test_api_cache")) == 6
+
+    def test_threads(self):
+        cache = ResponseCache("./test_api_cache", max_size=500)
+        Parallel(n_jobs=8, backend="threading")(
+            delayed(lambda i: list(cache.store(str(i % 40), {}, [b"x" * 10])))(i)
+            for i in range(400)
+        )
+        assert cache.size == 400
+        assert len(cache.entries()) == 40
+        assert len(glob.glob("./test_api_cache/*.body")) == 40
+        assert ResponseCache("./test_api_cache").size == 400
+
+    def test_api_projection(self):
+        api = MosApi("123", **TEST_CONF_API)
+        with requests_mock.Mocker() as m:
+            m.get(
+                "https://apidata.mos.ru/v1/object/96/rows?$skip=0&$top=2"
+                "&$select=Name,Address&$filter=Cells/TypeObject%20eq%20%27%D0%B1%D0%B0%D1%80%27"
+                "&api_key=123",
+                json=[{"Cells": {"Name": "A", "Address": "B"}}],
+            )
+            m.get(
+                "https://apidata.mos.ru/v1/object/96/count?"
+                "&$filter=Cells/TypeObject%20eq%20%27%D0%B1%D0%B0%D1%80%27&api_key=123",
+                text="1",
+            )
+            data = api.get(
+                "object",
+                "96",
+                0,
+                2,
+                columns=["Name", "Address"],
+                filter="Cells/TypeObject eq 'бар'",
+            )
+            assert data[0]["Cells"] == {"Name": "A", "Address": "B"}
+            assert api.count("object", "96", filter="Cells/TypeObject eq 'бар'") == 1
+
+
+import time
+
+from src_rest.api.utils import AdaptiveRateLimiter, parse_retry_after
+from src_rest.api.utils import iter_json_array
+
+
+class TestRateLimiter:
+    def test_parse_retry_after(self):
+        assert parse_retry_after(None) is None
+        assert parse_retry_after("3") == 3
+        assert parse_retry_after("-3") == 0
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+        assert parse_retry_after("soon") is None
+
+    def test_rate(self):
+        limiter = AdaptiveRateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        assert time.monotonic() - start >= 0.09
+
+        with pytest.raises(ValueError):
+            AdaptiveRateLimiter(0)
+
+    def test_aimd(self):
+        limiter = AdaptiveRateLimiter(10, increase=1)
+        limiter.on_throttle()
+        assert limiter.rate == 5
+        for _ in range(10):
+            limiter.on_throttle()
+        assert limiter.rate == limiter.min_rate
+        for _ in range(20):
+            limiter.on_success()
+        assert limiter.rate == 10
+
+    def test_iter_json_array(self):
+        data = [{"a": [1, {"b": "ё,]"}]}, 1, 2.5, None, [], 12345, 1e5, True]
+        raw = json.dumps(data, ensure_ascii=False, indent=1).encode("utf-8")
+        for size in range(1, 20):
+            chunks = [raw[i: i + size] for i in range(0, len(raw), size)]
+            assert list(iter_json_array(chunks)) == data
+
+        assert list(iter_json_array([b" [ ] "])) == []
+        for broken in [b"[1", b"[1,", b"[1 2]", b"[1] 2", b"", b'{"a": 1}']:
+            with pytest.raises(ValueError):
+                list(iter_json_array([broken]))
+
+    def test_iter_json_array_long_item(self, monkeypatch):
+        data = [{"text": "ё" * 100000}, 1]
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        chunks = [raw[i: i + 16] for i in range(0, len(raw), 16)]
+        calls = []
+        raw_decode = json.JSONDecoder.raw_decode
+
+        def counted(self, *args, **kwargs):
+            calls.append(args)
+            return raw_decode(self, *args, **kwargs)
+
+        monkeypatch.setattr(json.JSONDecoder, "raw_decode", counted)
+        assert list(iter_json_array(chunks)) == data
+        # Not once per chunk of the item
+        assert len(calls) < 50
+
+    def test_retry_after_pause(self):
+        limiter = AdaptiveRateLimiter(1000)
+        limiter.on_throttle(0.5)
+        assert limiter.reserve() > 0.4
+
+        # Callers queued behind the pause are spaced at the rate, not bursting
+        limiter = AdaptiveRateLimiter(20)
+        limiter.on_throttle(0.5)
+        delays = [limiter.reserve() for _ in range(4)]
+        assert delays[0] == pytest.approx(0.5, abs=0.05)
+        for before, after in zip(delays, delays[1:]):
+            assert after - before == pytest.approx(1 / 10, abs=0.01)
+
 
 from typing import Union, Dict, Any
 from src_rest.api.mosapi import MosDataset
@@ -96,13 +333,16 @@ class MosApiMocker:
         self.data["1"] = ["A", "B"]
 
     def get(
-        self, object_type: str, object_id: Union[str, int], skip: int, top: int
+        self, object_type: str, object_id: Union[str, int], skip: int, top: int,
+        columns=None, filter=None,
     ) -> Union[list, dict]:
         if object_id not in self.data:
             raise ValueError("Text: Page not found")
         return self.data[object_id][skip: skip + top]
 
-    def count(self, object_type: str, object_id: Union[str, int]) -> int:
+    def count(
+        self, object_type: str, object_id: Union[str, int], filter=None
+    ) -> int:
         if object_id not in self.data:
             raise ValueError("Text: Page not found")
         return len(self.data[object_id])
@@ -135,4 +375,166 @@ class TestMosDataset:
             data.extend(item)
         
         assert len(data) == len(self.api.data['1'])
-        assert str(data) == str(self.api.data["1"])
\ No newline at end of file
+        assert str(data) == str(self.api.data["1"])
+
+    def test_load_data_concurrent(self):
+        ds = MosDataset(self.api, '0', step=300, n_jobs=4, **TEST_CONF_DATASET)
+        pages = list(ds.load_indexed())
+
+        assert [i for i, _ in pages] == list(range(len(pages)))
+        data = []
+        for _, item in pages:
+            data.extend(item)
+        assert data == self.api.data["0"]
+
+        ds = MosDataset(self.api, '1', n_jobs=4, **TEST_CONF_DATASET)
+        assert list(ds.load()) == [["A", "B"]]
+
+        ds = MosDataset(self.api, '0', step=1000, n_jobs=4, **TEST_CONF_DATASET)
+        data = []
+        for item in ds.load():
+            data.extend(item)
+        assert data == self.api.data["0"]
+
+    def test_load_data_concurrent_stale_count(self):
+        class StaleCountMocker(MosApiMocker):
+            def count(self, object_type, object_id, filter=None):
+                return 4000
+
+        ds = MosDataset(
+            StaleCountMocker('123'), '0', step=1000, n_jobs=3, **TEST_CONF_DATASET
+        )
+        data = []
+        for item in ds.load():
+            data.extend(item)
+        assert data == list(range(10000))
+
+    def test_no_object_concurrent(self):
+        ds = MosDataset(self.api, '34', n_jobs=2, **TEST_CONF_DATASET)
+        with pytest.raises(ValueError):
+            list(ds.load())
+
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src_rest.api.async_mosapi import AsyncMosApi, AsyncMosDataset
+
+
+def create_stub_app(data: Dict[str, list], calls: Dict[str, int]) -> web.Application:
+    async def rows(request: web.Request) -> web.Response:
+        calls["rows"] += 1
+        if request.query["api_key"] == "fail" and calls["rows"] % 2 == 1:
+            return web.Response(status=503, text="Try later")
+        if request.query["api_key"] == "busy" and calls["rows"] % 2 == 1:
+            return web.Response(
+                status=502, text="Bad gateway", headers={"Retry-After": "0.3"}
+            )
+        if request.query["api_key"] == "slow":
+            await asyncio.sleep(1)
+        object_id = request.match_info["object_id"]
+        if object_id not in data:
+            return web.Response(status=404, text="Page not found")
+        skip = int(request.query["$skip"])
+        top = int(request.query["$top"])
+        return web.json_response(data[object_id][skip: skip + top])
+
+    async def count(request: web.Request) -> web.Response:
+        object_id = request.match_info["object_id"]
+        if object_id not in data:
+            return web.Response(status=404, text="Page not found")
+        return web.Response(text=str(len(data[object_id])))
+
+    app = web.Application()
+    app.router.add_get("/v1/{object_type}/{object_id}/rows", rows)
+    app.router.add_get("/v1/{object_type}/{object_id}/count", count)
+    return app
+
+
+class TestAsyncMosApi:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        self.data = {"0": list(range(2500)), "1": ["A", "B"]}
+        self.calls = {"rows": 0}
+
+    def run_with_server(self, coroutine_func):
+        async def runner():
+            server = TestServer(create_stub_app(self.data, self.calls))
+            await server.start_server()
+            try:
+                return await coroutine_func(str(server.make_url("")))
+            finally:
+                await server.close()
+
+        return asyncio.run(runner())
+
+    def test_get_count(self):
+        async def run(host):
+            async with AsyncMosApi("123", host=host) as api:
+                return (
+                    await api.get("datasets", "0", 3, 4),
+                    await api.count("datasets", "0"),
+                )
+
+        rows, count = self.run_with_server(run)
+        assert rows == [3, 4, 5, 6]
+        assert count == 2500
+
+    def test_not_found(self):
+        async def run(host):
+            async with AsyncMosApi("123", host=host, n_retries=1) as api:
+                await api.get("datasets", "34", 0, 10)
+
+        with pytest.raises(ValueError) as e:
+            self.run_with_server(run)
+        assert "Page not found" in str(e.value)
+
+    def test_retries(self):
+        async def run(host):
+            async with AsyncMosApi("fail", host=host, backoff=0.01) as api:
+                return await api.get("datasets", "1", 0, 10)
+
+        assert self.run_with_server(run) == ["A", "B"]
+        assert self.calls["rows"] == 2
+
+    def test_retry_after_5xx(self):
+        async def run(host):
+            async with AsyncMosApi("busy", host=host, backoff=0, rate=1000) as api:
+                start = time.monotonic()
+                rows = await api.get("datasets", "1", 0, 10)
+                return rows, time.monotonic() - start
+
+        rows, elapsed = self.run_with_server(run)
+        assert rows == ["A", "B"]
+        assert elapsed >= 0.3
+
+    def test_timeout(self):
+        async def run(host):
+            async with AsyncMosApi(
+                "slow", host=host, n_retries=0, timeout=0.1
+            ) as api:
+                await api.get("datasets", "1", 0, 10)
+
+        with pytest.raises(asyncio.TimeoutError):
+            self.run_with_server(run)
+
+    def test_load_datasets(self):
+        async def load(ds):
+            data = []
+            async for i, item in ds.load_indexed():
+                data.append((i, item))
+            return data
+
+        async def run(host):
+            async with AsyncMosApi("123", host=host, limit=3) as api:
+                return await asyncio.gather(
+                    load(AsyncMosDataset(api, "0", step=300, n_jobs=3)),
+                    load(AsyncMosDataset(api, "1", step=300, n_jobs=3)),
+                )
+
+        pages0, pages1 = self.run_with_server(run)
+        assert [i for i, _ in pages0] == list(range(len(pages0)))
+        assert sum((item for _, item in pages0), []) == self.data["0"]
+        assert pages1 == [(0, ["A", "B"])]
@@ -30,3 +30,371 @@ class TestUtils:
 
         with pytest.raises(FileNotFoundError):
             check_paths("./test_path/", "./test_path/path4/path5/data.json")
+
+
+import json
+import re
+import requests_mock
+
+from click.testing import CliRunner
+from urllib.parse import parse_qs, urlparse
+
+
+class TestLoadMosdata:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        os.mkdir("./test_mosdata")
+        self.data = list(range(5))
+        yield
+        os.system("rm -rf ./test_mosdata")
+
+    def mock_api(self, m):
+        def rows(request, context):
+            query = parse_qs(urlparse(request.url).query)
+            skip = int(query["$skip"][0])
+            top = int(query["$top"][0])
+            return self.data[skip: skip + top]
+
+        m.get(re.compile("datasets/1/count"), text=str(len(self.data)))
+        m.get(re.compile("datasets/1/rows"), json=rows)
+
+    def load(self, *args):
+        runner = CliRunner()
+        result = runner.invoke(
+            load_mosdata,
+            [
+                "--dataset_id", "1",
+                "--api_key", "123",
+                "--output", "./test_mosdata/raw",
+                "--step", "2",
+                "--rate", "1000",
+                *args,
+            ],
+        )
+        assert result.exit_code == 0, result.output
+
+    def rows_calls(self, m):
+        return len([r for r in m.request_history if "/rows" in r.url])
+
+    def test_manifest(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--limit", "2")
+
+        manifest = read_manifest("./test_mosdata/raw")
+        assert sorted(manifest) == [0, 1]
+        assert manifest[1]["skip"] == 2
+        assert manifest[1]["rows"] == 2
+        assert manifest[1]["sha256"] == file_sha256("./test_mosdata/raw/chunk_1.json")
+        assert read_finished_header("./test_mosdata/raw") is None
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--resume")
+            assert self.rows_calls(m) == 1
+
+        with open("./test_mosdata/raw/chunk_2.json", "r", encoding="utf-8") as file:
+            assert json.load(file) == [4]
+        assert read_manifest("./test_mosdata/raw") == {}
+        assert read_finished_header("./test_mosdata/raw")["step"] == 2
+
+        # Finished load is not resumed, but started over
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--resume")
+            assert self.rows_calls(m) == 3
+
+    def test_resume_settings(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--limit", "2", "--format", "jsonl.gz", "--columns", "Name")
+        assert read_manifest_header("./test_mosdata/raw") == {
+            "step": 2,
+            "format": "jsonl.gz",
+            "columns": ["Name"],
+            "filter": None,
+        }
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--resume", "--format", "jsonl.gz", "--columns", "Name")
+            assert self.rows_calls(m) == 1
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data
+
+        # Chunks of another format or projection are not resumed, but loaded over
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--limit", "2", "--resume", "--format", "jsonl.gz")
+            assert self.rows_calls(m) == 2
+        assert read_manifest_header("./test_mosdata/raw")["columns"] is None
+        assert sorted(read_manifest("./test_mosdata/raw")) == [0, 1]
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data[:4]
+
+    def test_resume_format_change(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load()
+            self.load("--resume", "--format", "jsonl.gz")
+            assert self.rows_calls(m) == 6
+
+        assert sorted(os.listdir("./test_mosdata/raw")) == [
+            "chunk_0.jsonl.gz",
+            "chunk_1.jsonl.gz",
+            "chunk_2.jsonl.gz",
+            "manifest.jsonl",
+        ]
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data
+
+    def test_resume_shrunken(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load()
+            self.data = list(range(3))
+            self.load("--resume")
+
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data
+        assert not os.path.exists("./test_mosdata/raw/chunk_2.json")
+
+    def test_resume_corrupted(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--limit", "2")
+
+        with open("./test_mosdata/raw/chunk_0.json", "w", encoding="utf-8") as file:
+            file.write("[0,")
+
+        assert completed_chunks("./test_mosdata/raw", 2) == {1}
+        assert completed_chunks("./test_mosdata/raw", 3) == set()
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--resume", "--n_jobs", "2")
+            assert self.rows_calls(m) == 2
+
+        with open("./test_mosdata/raw/chunk_0.json", "r", encoding="utf-8") as file:
+            assert json.load(file) == [0, 1]
+
+    def test_limit_concurrent(self):
+        self.data = list(range(20))
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--limit", "1", "--n_jobs", "4")
+            assert self.rows_calls(m) == 1
+
+        assert sorted(os.listdir("./test_mosdata/raw")) == [
+            "chunk_0.json",
+            "manifest.jsonl",
+        ]
+
+    def test_failed_page(self):
+        def rows(request, context):
+            skip = int(parse_qs(urlparse(request.url).query)["$skip"][0])
+            # Page is cut off in the middle of the response
+            return "[2, 3" if skip == 2 else json.dumps(self.data[skip: skip + 2])
+
+        with requests_mock.Mocker() as m:
+            m.get(re.compile("datasets/1/count"), text=str(len(self.data)))
+            m.get(re.compile("datasets/1/rows"), text=rows)
+            result = CliRunner().invoke(
+                load_mosdata,
+                [
+                    "--dataset_id", "1",
+                    "--api_key", "123",
+                    "--output", "./test_mosdata/raw",
+                    "--step", "2",
+                ],
+            )
+            assert result.exception is not None
+
+        assert not os.path.exists("./test_mosdata/raw/chunk_1.json")
+        assert sorted(read_manifest("./test_mosdata/raw")) == [0]
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--resume")
+            assert self.rows_calls(m) == 2
+        assert sorted(os.listdir("./test_mosdata/raw")) == [
+            "chunk_0.json",
+            "chunk_1.json",
+            "chunk_2.json",
+            "manifest.jsonl",
+        ]
+
+    def test_background_writer(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--writer", "background", "--queue_size", "1", "--n_jobs", "2")
+
+        for i, expected in enumerate([[0, 1], [2, 3], [4]]):
+            filename = f"./test_mosdata/raw/chunk_{i}.json"
+            with open(filename, "r", encoding="utf-8") as file:
+                assert json.load(file) == expected
+        # Done marker is written after all chunks, so nothing is left to resume
+        assert read_manifest("./test_mosdata/raw") == {}
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--writer", "background", "--limit", "1")
+        manifest = read_manifest("./test_mosdata/raw")
+        assert manifest[0]["sha256"] == file_sha256("./test_mosdata/raw/chunk_0.json")
+        assert manifest[0]["rows"] == 2
+
+    def test_format(self):
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load()
+        assert os.path.exists("./test_mosdata/raw/chunk_0.json")
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--format", "jsonl.gz", "--n_jobs", "2")
+
+        # Chunks of the previous load are removed
+        assert chunk_files("./test_mosdata/raw") == [
+            f"./test_mosdata/raw/chunk_{i}.jsonl.gz" for i in range(3)
+        ]
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data
+
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--format", "jsonl.gz", "--writer", "background", "--limit", "1")
+        manifest = read_manifest("./test_mosdata/raw")
+        assert manifest[0]["file"] == "chunk_0.jsonl.gz"
+        assert manifest[0]["rows"] == 2
+        assert completed_chunks("./test_mosdata/raw", 2) == {0}
+
+    def test_parquet_format(self):
+        # Cells differ between rows, as they do between datasets
+        self.data = [
+            {"Number": i, "global_id": i, "Cells": {f"field_{i % 2}": [{"a": i}]}}
+            for i in range(5)
+        ]
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            self.load("--format", "parquet", "--n_jobs", "2")
+
+        assert chunk_files("./test_mosdata/raw") == [
+            f"./test_mosdata/raw/chunk_{i}.parquet" for i in range(3)
+        ]
+        assert list(iter_chunks("./test_mosdata/raw")) == self.data
+
+
+class TestBackgroundWriter:
+    def test_write(self):
+        written = []
+        with BackgroundWriter(written.append, queue_size=2) as writer:
+            for i in range(10):
+                writer.put(i)
+        assert written == list(range(10))
+        assert writer.stats()["items"] == 10
+
+    def test_error(self):
+        def write(item):
+            raise OSError("disk full")
+
+        writer = BackgroundWriter(write, queue_size=1)
+        writer.put(1)
+        with pytest.raises(OSError):
+            for i in range(10):
+                writer.put(i)
+            writer.close()
+
+
+class TestLoadMosdataMany:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        os.mkdir("./test_mosdata_many")
+        self.data = {"1": list(range(5)), "2": list(range(100, 109))}
+        yield
+        os.system("rm -rf ./test_mosdata_many")
+
+    def mock_api(self, m):
+        def rows(request, context):
+            dataset_id = re.search("datasets/(\\d+)/rows", request.url).group(1)
+            query = parse_qs(urlparse(request.url).query)
+            skip = int(query["$skip"][0])
+            top = int(query["$top"][0])
+            return self.data[dataset_id][skip: skip + top]
+
+        def count(request, context):
+            dataset_id = re.search("datasets/(\\d+)/count", request.url).group(1)
+            return str(len(self.data[dataset_id]))
+
+        m.get(re.compile("datasets/\\d+/count"), text=count)
+        m.get(re.compile("datasets/\\d+/rows"), json=rows)
+
+    def test_load_many(self):
+        runner = CliRunner()
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            result = runner.invoke(
+                load_mosdata_many,
+                [
+                    "--dataset_id", "1",
+                    "--dataset_id", "2",
+                    "--api_key", "123",
+                    "--output", "./test_mosdata_many/ds{dataset_id}",
+                    "--step", "2",
+                    "--rate", "1000",
+                    "--n_jobs", "1",
+                ],
+            )
+            assert result.exit_code == 0, result.output
+
+            datasets = [
+                re.search("datasets/(\\d+)/rows", r.url).group(1)
+                for r in m.request_history
+                if "/rows" in r.url
+            ]
+            # Pages are taken from datasets in turn
+            assert datasets[:6] == ["1", "2", "1", "2", "1", "2"]
+
+        for dataset_id, data in self.data.items():
+            output = f"./test_mosdata_many/ds{dataset_id}"
+            manifest = read_manifest(output)
+            assert manifest == {}
+            loaded = []
+            for i in range(len(os.listdir(output)) - 1):
+                with open(f"{output}/chunk_{i}.json", "r", encoding="utf-8") as file:
+                    loaded.extend(json.load(file))
+            assert loaded == data
+
+    def test_options(self):
+        runner = CliRunner()
+        with requests_mock.Mocker() as m:
+            self.mock_api(m)
+            result = runner.invoke(
+                load_mosdata_many,
+                [
+                    "--dataset_id", "2",
+                    "--dataset_id", "2",
+                    "--api_key", "123",
+                    "--output", "./test_mosdata_many/ds",
+                    "--step", "2",
+                    "--limit", "3",
+                    "--columns", "Name",
+                    "--filter", "Cells/Name eq 'x'",
+                    "--rate", "1000",
+                ],
+            )
+            assert result.exit_code == 0, result.output
+            rows = [r.url for r in m.request_history if "/rows" in r.url]
+
+        # Repeated dataset is loaded once, up to the limit
+        assert len(rows) == 3
+        assert all("$select=Name" in url and "$filter=" in url for url in rows)
+        # Not marked done, so the rest is loaded on resume
+        assert sorted(read_manifest("./test_mosdata_many/ds")) == [0, 1, 2]
+
+    def test_output_template(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            load_mosdata_many,
+            [
+                "--dataset_id", "1",
+                "--dataset_id", "2",
+                "--api_key", "123",
+                "--output", "./test_mosdata_many/ds",
+            ],
+        )
+        assert isinstance(result.exception, ValueError)
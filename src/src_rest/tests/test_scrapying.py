@@ -205,7 +205,7 @@ class TestUtils:
             assert data["data"]["heading"] == "My First Heading"
             assert data["data"]["paragraph"] == "My first paragraph."
 
-    def test_dump_scrape_page(self):
+    def test_dump_scrape_page(self, capsys):
         sample_html = """<!DOCTYPE html>
         <html>
         <body>
@@ -241,6 +241,8 @@ class TestUtils:
             assert data["ok"]
             assert data["data"]["heading"] == "My First Heading"
             assert data["data"]["paragraph"] == "My first paragraph."
+            # Pages are not reported one by one, unless verbose
+            assert capsys.readouterr().out == ""
 
             dump_scrape_page(
                 session,
@@ -249,7 +251,9 @@ class TestUtils:
                 parse,
                 "./test_sc_utils/",
                 False,
+                verbose=True,
             )
+            assert "Parsing data from" in capsys.readouterr().out
             data = restore_from_cache(
                 "./test_sc_utils/", "https://mocker-website.org/mock"
             )
@@ -616,3 +620,1419 @@ class TestMosRestCrawler:
 
         next_page = crawler.get_next_link(soup)
         assert next_page == "https://website.org/restaurants/?curPos=7"
+
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, unused_port
+
+
+def create_pages_app(stats: dict) -> web.Application:
+    async def page(request: web.Request) -> web.Response:
+        i = request.match_info["i"]
+        stats["calls"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            if i == "flaky" and stats["calls"] % 2 == 1:
+                return web.Response(status=503, text="Try later")
+            if i == "slow":
+                await asyncio.sleep(2)
+            await asyncio.sleep(0.01)
+            etag = f'"page-{i}"'
+            if request.headers.get("If-None-Match") == etag:
+                stats["not_modified"] = stats.get("not_modified", 0) + 1
+                return web.Response(status=304, headers={"ETag": etag})
+            return web.Response(
+                text=f"<html><body><h1>Page {i}</h1></body></html>",
+                content_type="text/html",
+                headers={"ETag": etag},
+            )
+        finally:
+            stats["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_get("/page/{i}", page)
+    return app
+
+
+class TestAsyncLinkScraper:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./async_scrapers_tmp")
+        self.stats = {"calls": 0, "in_flight": 0, "max_in_flight": 0}
+        # Same port for every run, so that cached links match
+        self.port = unused_port()
+
+        class SimpleScraper(BaseLinkScraper):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"heading": cast(Tag, soup.find("h1")).text}
+
+        self.scraper_class = SimpleScraper
+
+        yield
+
+        os.system("rm -rf ./async_scrapers_tmp")
+
+    def scrape(self, pages, **kwargs):
+        async def runner():
+            server = TestServer(create_pages_app(self.stats), port=self.port)
+            await server.start_server()
+            try:
+                links = [str(server.make_url(f"/page/{i}")) for i in pages]
+                scraper = self.scraper_class(
+                    links,
+                    output="./async_scrapers_tmp",
+                    backend="asyncio",
+                    backoff=0,
+                    **kwargs,
+                )
+                await scraper.load_data_async()
+                return links
+            finally:
+                await server.close()
+
+        return asyncio.run(runner())
+
+    def test_load_data(self):
+        links = self.scrape(range(50), n_jobs=8)
+
+        assert self.stats["calls"] == 50
+        assert 1 < self.stats["max_in_flight"] <= 8
+        data = restore_from_cache("./async_scrapers_tmp", links[7])
+        assert data["data"]["heading"] == "Page 7"
+        assert data["status_code"] == 200
+        assert data["sha256"] == hash256("<html><body><h1>Page 7</h1></body></html>")
+
+        # Cached pages are restored, not fetched again
+        self.scrape(range(50), n_jobs=8)
+        assert self.stats["calls"] == 50
+
+        self.scrape(range(50), n_jobs=8, cache=False)
+        assert self.stats["calls"] == 100
+
+    def test_retry_timeout(self):
+        links = self.scrape(["flaky"])
+        assert self.stats["calls"] == 2
+        assert restore_from_cache("./async_scrapers_tmp", links[0])["ok"]
+
+        with pytest.raises(asyncio.TimeoutError):
+            self.scrape(["slow"], timeout=1, n_retries=0)
+
+    def test_revalidate(self, capsys):
+        links = self.scrape(range(5))
+        self.scrape(range(7), ttl=3600)
+        assert self.stats["calls"] == 7
+        assert "Cache hits: 5, misses: 2, stale: 0" in capsys.readouterr().out
+
+        self.scrape(range(5), ttl=0)
+        assert self.stats["calls"] == 12
+        assert self.stats["not_modified"] == 5
+        assert "Cache hits: 0, misses: 0, stale: 5" in capsys.readouterr().out
+        data = restore_from_cache("./async_scrapers_tmp", links[3])
+        assert data["data"]["heading"] == "Page 3"
+        assert data["status_code"] == 200
+        assert data["sha256"] == hash256("<html><body><h1>Page 3</h1></body></html>")
+
+    def test_n_jobs(self):
+        scraper = self.scraper_class(["link"], "some_path", backend="asyncio")
+        assert scraper.n_jobs == 100
+
+    def test_executor(self):
+        threads = set()
+
+        class ThreadScraper(self.scraper_class):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                threads.add(threading.get_ident())
+                return super().parse_data(soup)
+
+        self.scraper_class = ThreadScraper
+        self.scrape(range(20), n_jobs=4)
+        assert self.stats["max_in_flight"] <= 4
+        # Pages are parsed off the thread of the event loop
+        assert threads and threading.get_ident() not in threads
+
+
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"<html><body><h1>Page</h1></body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConnectionStats:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./pool_scrapers_tmp")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+        class SimpleScraper(BaseLinkScraper):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"heading": cast(Tag, soup.find("h1")).text}
+
+        self.scraper_class = SimpleScraper
+
+        yield
+
+        self.server.shutdown()
+        self.server.server_close()
+        os.system("rm -rf ./pool_scrapers_tmp")
+
+    def test_session_stats(self):
+        stats = ConnectionStats()
+        session = get_session(1, 1, stats=stats)
+        for _ in range(5):
+            assert session.get(f"{self.url}/page").ok
+
+        assert stats.requests == 5
+        assert stats.new_connections == 1
+        assert stats.reused_connections == 4
+        assert stats.connect_time > 0
+
+    def test_loky(self):
+        # Scrapers with their stats and metrics are sent to process workers
+        links = [f"{self.url}/page/{i}" for i in range(5)]
+        scraper = self.scraper_class(
+            links, "./pool_scrapers_tmp", backend="loky", n_jobs=2
+        )
+        scraper.load_data()
+        assert open_cache("./pool_scrapers_tmp").contains(links) == set(links)
+
+    def test_pool_size(self, caplog):
+        links = [f"{self.url}/page/{i}" for i in range(200)]
+        scraper = self.scraper_class(
+            links, "./pool_scrapers_tmp", backend="threading", n_jobs=20
+        )
+        assert scraper.session.get_adapter(self.url)._pool_maxsize == 20
+
+        with caplog.at_level(logging.WARNING, logger="urllib3"):
+            scraper.load_data()
+        assert "Connection pool is full" not in caplog.text
+
+        assert scraper.stats.requests == 200
+        assert scraper.stats.new_connections <= 20
+        assert scraper.stats.reused_connections >= 180
+
+    def test_async_stats(self):
+        links = [f"{self.url}/page/{i}" for i in range(30)]
+        scraper = self.scraper_class(
+            links, "./pool_scrapers_tmp", backend="asyncio", n_jobs=5
+        )
+        scraper.load_data()
+
+        assert scraper.stats.requests == 30
+        assert 1 <= scraper.stats.new_connections <= 5
+        assert scraper.stats.reused_connections >= 25
+
+
+import time
+
+from src_rest.scrapying.scheduler import HostScheduler
+
+
+class ThrottlingHandler(KeepAliveHandler):
+    lock = threading.Lock()
+    stats = {"calls": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def do_GET(self):
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.stats["in_flight"]
+            )
+            first_call = self.stats["calls"] == 1
+        time.sleep(0.02)
+        # Request is done before the response is sent, so that the client
+        # may start a next one only after it
+        with self.lock:
+            self.stats["in_flight"] -= 1
+
+        if self.path == "/throttle" and first_call:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            super().do_GET()
+
+
+class TestHostScheduler:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./scheduler_tmp")
+        ThrottlingHandler.stats.update(calls=0, in_flight=0, max_in_flight=0)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+        class SimpleScraper(BaseLinkScraper):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"heading": cast(Tag, soup.find("h1")).text}
+
+        self.scraper_class = SimpleScraper
+
+        yield
+
+        self.server.shutdown()
+        self.server.server_close()
+        os.system("rm -rf ./scheduler_tmp")
+
+    def test_feedback(self):
+        scheduler = HostScheduler(rate=10, hosts={"slow.org": (1, 1)})
+        assert scheduler.budget("slow.org") == (1, 1)
+        assert scheduler.budget("fast.org") == (10, 10)
+
+        scheduler.feedback("fast.org", 500)
+        scheduler.feedback("fast.org", None)
+        assert scheduler.limiter("fast.org").rate == 2.5
+        scheduler.feedback("fast.org", 404)
+        assert scheduler.limiter("fast.org").rate == 3
+        assert scheduler.limiter("slow.org").rate == 1
+
+    def test_concurrency(self):
+        links = [f"{self.url}/page/{i}" for i in range(40)]
+        scraper = self.scraper_class(
+            links,
+            "./scheduler_tmp",
+            n_jobs=20,
+            scheduler=HostScheduler(max_concurrency=3, rate=1000),
+        )
+        scraper.load_data()
+
+        assert ThrottlingHandler.stats["calls"] == 40
+        assert ThrottlingHandler.stats["max_in_flight"] <= 3
+
+    def test_rate(self):
+        session = get_session(1, 0, scheduler=HostScheduler(rate=20))
+        start = time.monotonic()
+        for i in range(10):
+            assert session.get(f"{self.url}/page/{i}").ok
+        assert time.monotonic() - start >= 0.4
+
+    def test_retry_after(self):
+        scheduler = HostScheduler(rate=100)
+        session = get_session(2, 0, scheduler=scheduler)
+        start = time.monotonic()
+        assert session.get(f"{self.url}/throttle").ok
+
+        assert ThrottlingHandler.stats["calls"] == 2
+        assert time.monotonic() - start >= 1
+        assert scheduler.limiter("127.0.0.1").rate < 100
+
+    def test_feedback_once(self):
+        scheduler = HostScheduler(rate=1000)
+        statuses = []
+        feedback = scheduler.feedback
+        scheduler.feedback = lambda host, status, retry_after=None: (
+            statuses.append(status),
+            feedback(host, status, retry_after),
+        )
+        session = get_session(1, 0, scheduler=scheduler)
+        assert session.get(f"{self.url}/throttle").ok
+        assert statuses == [503, 200]
+
+        # Last response is returned, not raised on
+        ThrottlingHandler.stats.update(calls=0)
+        statuses.clear()
+        adapter = session.get_adapter(self.url)
+        adapter.max_retries = adapter.max_retries.new(total=0, raise_on_status=False)
+        assert session.get(f"{self.url}/throttle").status_code == 503
+        assert statuses == [503]
+
+    def test_async(self):
+        links = [f"{self.url}/page/{i}" for i in range(30)]
+        scraper = self.scraper_class(
+            links,
+            "./scheduler_tmp",
+            backend="asyncio",
+            scheduler=HostScheduler(max_concurrency=4, rate=1000),
+        )
+        scraper.load_data()
+
+        assert ThrottlingHandler.stats["calls"] == 30
+        assert ThrottlingHandler.stats["max_in_flight"] <= 4
+
+        ThrottlingHandler.stats.update(calls=0)
+        scraper = self.scraper_class(
+            [f"{self.url}/throttle"],
+            "./scheduler_tmp",
+            backend="asyncio",
+            backoff=0,
+            scheduler=HostScheduler(rate=100),
+        )
+        start = time.monotonic()
+        scraper.load_data()
+        assert time.monotonic() - start >= 1
+
+
+def pagination_html(i: int, n_pages: int) -> str:
+    links = "".join(
+        f'<li><a href="/restaurants/?curPos={j * 7}">{j}</a></li>'
+        for j in range(max(0, i - 2), min(n_pages, i + 4))
+    )
+    return f"""<html><body>
+    <ul class="l-restaurants clearfix"><span class="vcard">card {i}</span></ul>
+    <div class="restaurants_rating clearfix"><ul class="l-links clearfix">{links}</ul></div>
+    </body></html>"""
+
+
+class TestFrontierCrawler:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./frontier_tmp")
+        self.base = "https://www.moscow-restaurants.ru/restaurants/"
+        self.n_pages = 12
+
+        yield
+
+        os.system("rm -rf ./frontier_tmp")
+
+    def mock_pages(self, m):
+        m.get(self.base, text=pagination_html(0, self.n_pages))
+        for i in range(self.n_pages):
+            m.get(f"{self.base}?curPos={i * 7}", text=pagination_html(i, self.n_pages))
+
+    def test_get_links(self):
+        crawler = MosRestCrawler(self.base, output="./frontier_tmp")
+        soup = BeautifulSoup(pagination_html(3, self.n_pages), "html.parser")
+        links = crawler.get_links(soup)
+        assert links[0] == f"{self.base}?curPos=7"
+        assert len(links) == 6
+
+        crawler.link = f"{self.base}?curPos=21"
+        assert crawler.get_next_link(soup) == f"{self.base}?curPos=28"
+
+    def test_load_frontier(self):
+        crawler = MosRestCrawler(
+            self.base, output="./frontier_tmp", frontier=True, n_jobs=4
+        )
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            crawler.load_data()
+            urls = [request.url for request in m.request_history]
+
+        # Start page and curPos=0 are the same page under different links
+        assert len(urls) == self.n_pages + 1
+        assert len(set(urls)) == len(urls)
+        data = restore_from_cache("./frontier_tmp", f"{self.base}?curPos=77")
+        assert data["data"]["cards"] == ['<span class="vcard">card 11</span>']
+        assert len(data["data"]["links"]) == 3
+
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            crawler.load_data()
+            assert m.call_count == 0
+
+    def test_frontier_limit(self):
+        crawler = MosRestCrawler(
+            self.base, output="./frontier_tmp", frontier=True, limit=5, cache=False
+        )
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            crawler.load_data()
+            assert m.call_count == 5
+
+    def test_frontier_next_link(self):
+        base = self.base
+
+        class SimpleCrawler(BaseCrawler):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"card": soup.find("span", class_="vcard").text}
+
+            def get_next_link(self, soup: BeautifulSoup) -> Optional[str]:
+                i = int(soup.find("span", class_="vcard").text.split()[1])
+                return f"{base}?curPos={(i + 1) * 7}" if i < 2 else None
+
+        # Crawler without get_links follows its next link in frontier mode
+        crawler = SimpleCrawler(self.base, output="./frontier_tmp", frontier=True)
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            crawler.load_data()
+            assert m.call_count == 3
+
+        data = restore_from_cache("./frontier_tmp", f"{self.base}?curPos=14")
+        assert data["data"]["card"] == "card 2"
+        assert data["data"]["links"] == []
+
+
+DETAILS_HTML = """<html><head><script>var a = 1;</script></head><body>
+<ul class="menu"><li><a href="/">Main</a></li></ul>
+<div class="col col_img"><script type="text/javascript">
+map.add(new ymaps.Placemark([55.75, 37.61]));</script></div>
+<div class="data"><div class="row average_check">1500 руб.</div>
+<meta itemprop="openingHours" content="Mo-Su 12:00-00:00">
+<meta itemprop="streetAddress" content="ул. Тверская, д. 1">
+<meta itemprop="addressLocality" content="Москва"></div>
+<div class="rest_stats"><div class="title">Кухня</div>
+<div class="stars"><i class="i-star orange"></i><i class="i-star orange"></i></div></div>
+<div class="item-review-col_right"><div class="data-text">\r\n Вкусно </div></div>
+<div class="footer"><div class="data-text">Не отзыв</div></div>
+</body></html>"""
+
+
+class TestParseOnly:
+    def test_class_filter(self):
+        match = class_filter("col_img", "data")
+        assert match("col col_img")
+        assert match(["data"])
+        assert not match("data-text")
+        assert not match(None)
+
+    @pytest.mark.parametrize("parser", ["html.parser", "lxml"])
+    def test_mosrest_scraper(self, parser):
+        scraper = MosRestScraper(["link"], "some_path", parser=parser)
+        full = scraper.parse_data(make_soup(DETAILS_HTML, parser))
+        strained = scraper.parse_data(
+            make_soup(DETAILS_HTML, parser, scraper.parse_only)
+        )
+        assert strained == full
+        assert strained["x_coord"] == 37.61
+        assert strained["review"] == "Вкусно"
+        assert "menu" not in str(make_soup(DETAILS_HTML, parser, scraper.parse_only))
+
+    def test_mosrest_crawler(self):
+        base = "https://www.moscow-restaurants.ru/restaurants/"
+        crawler = MosRestCrawler(base, output="some_path")
+        html = pagination_html(2, 10)
+        full = make_soup(html, "html.parser")
+        strained = make_soup(html, "html.parser", crawler.parse_only)
+        assert crawler.parse_data(strained) == crawler.parse_data(full)
+        assert crawler.get_links(strained) == crawler.get_links(full)
+
+    def test_scrape_page_parser(self):
+        url = "https://www.sample-html-website.org/page"
+        with requests_mock.Mocker() as m:
+            m.get(url, text=DETAILS_HTML)
+            data = scrape_page(
+                requests.Session(),
+                url,
+                10,
+                lambda soup: {"divs": len(soup.find_all("div"))},
+                parser="lxml",
+                parse_only=SoupStrainer("div", class_=class_filter("rest_stats")),
+            )
+        assert data["data"]["divs"] == 3
+
+
+from click.testing import CliRunner
+
+from src_rest.loaders.data_loaders_scrapy import reparse_moscow_restaurants
+
+
+class TestRawStore:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./raw_store_tmp")
+        safe_mkdir("./raw_store_tmp/records")
+        self.raw_dir = "./raw_store_tmp/raw"
+        self.url = "https://www.moscow-restaurants.ru/restaurants/cafe1"
+
+        yield
+
+        os.system("rm -rf ./raw_store_tmp")
+
+    def reparse(self, scraper, output="./raw_store_tmp/reparsed"):
+        runner = CliRunner()
+        result = runner.invoke(
+            reparse_moscow_restaurants,
+            [
+                "--input", "./raw_store_tmp/records",
+                "--raw_dir", self.raw_dir,
+                "--output", output,
+                "--scraper", scraper,
+                "--n_jobs", "2",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    def test_dump_load_raw(self):
+        text = "<html>Привет</html>"
+        dump_raw(self.raw_dir, text, hash256(text))
+        dump_raw(self.raw_dir, text, hash256(text))
+        assert load_raw(self.raw_dir, hash256(text)) == text
+        assert os.listdir(self.raw_dir) == [hash256(text)[:2]]
+        assert load_raw(self.raw_dir, hash256("other")) is None
+
+    def test_reparse_details(self):
+        url_missing = self.url + "_missing"
+        with requests_mock.Mocker() as m:
+            m.get(self.url, text=DETAILS_HTML)
+            m.get(url_missing, text=DETAILS_HTML.replace("1500", "2000"))
+            m.get(self.url + "_404", text="Not found", status_code=404)
+            scraper = MosRestScraper(
+                [self.url, url_missing, self.url + "_404"],
+                "./raw_store_tmp/records",
+                raw_dir=self.raw_dir,
+            )
+            scraper.load_data()
+
+        record = restore_from_cache("./raw_store_tmp/records", self.url)
+        assert load_raw(self.raw_dir, record["sha256"]) == DETAILS_HTML
+        os.remove(raw_path(self.raw_dir, hash256(DETAILS_HTML.replace("1500", "2000"))))
+
+        # Records parsed by an older parser
+        filename = f"./raw_store_tmp/records/chunk_{hash256(self.url)}.json"
+        dump_json(dict(record, data={"x_coord": None}), filename)
+
+        with requests_mock.Mocker() as m:
+            output = self.reparse("moscow_restaurants_detailed")
+            assert m.call_count == 0
+        assert "Reparsed: 1, page not stored: 1, not ok responses: 1" in output
+
+        reparsed = restore_from_cache("./raw_store_tmp/reparsed", self.url)
+        assert reparsed == record
+        assert reparsed["data"]["x_coord"] == 37.61
+        assert len(os.listdir("./raw_store_tmp/reparsed")) == 3
+
+    def test_reparse_crawler(self):
+        base = "https://www.moscow-restaurants.ru/restaurants/"
+        with requests_mock.Mocker() as m:
+            for i in range(4):
+                m.get(f"{base}?curPos={i * 7}", text=pagination_html(i, 4))
+            crawler = MosRestCrawler(
+                f"{base}?curPos=7", "./raw_store_tmp/records", raw_dir=self.raw_dir
+            )
+            crawler.load_data()
+
+        self.reparse("moscow_restaurants", output="./raw_store_tmp/records")
+        for i in range(1, 4):
+            record = restore_from_cache("./raw_store_tmp/records", f"{base}?curPos={i * 7}")
+            assert record["data"]["cards"] == [f'<span class="vcard">card {i}</span>']
+            expected = f"{base}?curPos={(i + 1) * 7}" if i < 3 else None
+            assert record["data"]["next_link"] == expected
+
+
+from src_rest.scrapying.cache import (
+    ChunkDirCache,
+    ScrapeCache,
+    SQLiteCache,
+    ShardCache,
+    migrate_cache,
+    open_cache,
+    read_fields,
+    record_name,
+)
+from joblib import Parallel, delayed
+from pandas import read_csv
+
+from src_rest.loaders.data_loaders_scrapy import migrate_scrape_cache
+from src_rest.transformers.transform_mos_rest import process_mos_rest_detailed
+
+
+class TestScrapeCache:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./scrape_cache_tmp")
+        safe_mkdir("./scrape_cache_tmp/chunks")
+        self.urls = [f"https://www.moscow-restaurants.ru/restaurants/{i}" for i in range(5)]
+
+        yield
+
+        os.system("rm -rf ./scrape_cache_tmp")
+
+    @pytest.mark.parametrize(
+        "path, backend",
+        [
+            ("./scrape_cache_tmp/chunks", ChunkDirCache),
+            ("./scrape_cache_tmp/cache.sqlite", SQLiteCache),
+            ("./scrape_cache_tmp/data.shards", ShardCache),
+        ],
+    )
+    def test_backend(self, path, backend):
+        cache = open_cache(path)
+        assert isinstance(cache, backend)
+
+        for i, url in enumerate(self.urls[:3]):
+            dump_to_cache({"ok": i != 2, "url": url, "data": {"i": i}}, cache, url)
+        dump_to_cache({"ok": True, "url": self.urls[0], "data": {"i": 10}}, path, self.urls[0])
+
+        assert restore_from_cache(path, self.urls[0])["data"] == {"i": 10}
+        assert restore_from_cache(cache, self.urls[1])["data"] == {"i": 1}
+        # Not ok responses are stored, but are not restored
+        assert restore_from_cache(cache, self.urls[2]) is None
+        assert restore_from_cache(cache, self.urls[3]) is None
+
+        assert cache.contains(self.urls) == set(self.urls[:3])
+        assert cache.names() == sorted(record_name(url) for url in self.urls[:3])
+        assert len(list(cache.items())) == 3
+        cache.close()
+
+    def test_incomplete_backend(self):
+        class NamesCache(ScrapeCache):
+            def names(self):
+                return []
+
+        with pytest.raises(TypeError):
+            NamesCache()
+
+    @pytest.mark.parametrize(
+        "path", ["./scrape_cache_tmp/cache.sqlite", "./scrape_cache_tmp/data.shards"]
+    )
+    def test_opened_once(self, path):
+        for i, url in enumerate(self.urls):
+            dump_to_cache({"ok": True, "url": url, "data": {"i": i}}, path, url)
+            assert restore_from_cache(path, url)["data"] == {"i": i}
+        cache = open_cache(path)
+        assert open_cache(path) is cache
+        cache.close()
+        if isinstance(cache, ShardCache):
+            assert len(cache.shards()) == 1
+
+        # Removed and created again, the path is opened anew
+        os.system(f"rm -rf {path}")
+        assert open_cache(path) is not cache
+        assert restore_from_cache(path, self.urls[0]) is None
+
+    def test_sqlite_threads(self):
+        cache = SQLiteCache("./scrape_cache_tmp/cache.db")
+        urls = [f"https://www.moscow-restaurants.ru/{i}" for i in range(200)]
+        Parallel(n_jobs=8, backend="threading")(
+            delayed(cache.put)(url, {"ok": True, "url": url}) for url in urls
+        )
+        assert cache.contains(urls) == set(urls)
+        # Cache is sent to processes by path, each opens its own connection
+        assert Parallel(n_jobs=2)(delayed(len)(c.names()) for c in [cache, cache]) == [
+            200,
+            200,
+        ]
+
+    @pytest.mark.parametrize(
+        "path", ["./scrape_cache_tmp/cache.sqlite", "./scrape_cache_tmp/data.shards"]
+    )
+    def test_scraper(self, path):
+        with requests_mock.Mocker() as m:
+            for url in self.urls:
+                m.get(url, text=DETAILS_HTML)
+            scraper = MosRestScraper(self.urls, path)
+            scraper.load_data()
+            assert m.call_count == 5
+            scraper = MosRestScraper(self.urls, path)
+            scraper.load_data()
+            assert m.call_count == 5
+
+        record = restore_from_cache(path, self.urls[0])
+        assert record["data"]["x_coord"] == 37.61
+
+        runner = CliRunner()
+        result = runner.invoke(
+            process_mos_rest_detailed,
+            [
+                "--input", path,
+                "--output", "./scrape_cache_tmp/details.csv",
+                "--n_jobs", "2",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        df = read_csv("./scrape_cache_tmp/details.csv")
+        assert sorted(df.url) == sorted(self.urls)
+
+    def test_migrate(self):
+        chunks = ChunkDirCache("./scrape_cache_tmp/chunks")
+        for i, url in enumerate(self.urls):
+            chunks.put(url, {"ok": True, "url": url, "data": {"i": i}})
+
+        runner = CliRunner()
+        result = runner.invoke(
+            migrate_scrape_cache,
+            [
+                "--input", "./scrape_cache_tmp/chunks",
+                "--output", "./scrape_cache_tmp/migrated/cache.sqlite",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "Migrated 5 records" in result.output
+
+        migrated = open_cache("./scrape_cache_tmp/migrated/cache.sqlite")
+        assert dict(migrated.items()) == dict(chunks.items())
+        assert migrate_cache(migrated, ChunkDirCache("./scrape_cache_tmp/chunks")) == 5
+        assert len(os.listdir("./scrape_cache_tmp/chunks")) == 5
+
+
+
+from src_rest.scrapying.cache import DTTM_FORMAT, evict_cache, record_age
+from src_rest.loaders.data_loaders_scrapy import evict_scrape_cache
+
+
+class TestCacheFreshness:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./cache_freshness_tmp")
+        self.url = "https://www.moscow-restaurants.ru/restaurants/cafe1"
+
+        yield
+
+        os.system("rm -rf ./cache_freshness_tmp")
+
+    def record(self, age: float, i: int = 0) -> dict:
+        dttm = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        return {
+            "ok": True,
+            "url": f"{self.url}/{i}",
+            "headers": {"ETag": '"v1"', "Last-Modified": "Mon, 01 Aug 2022 00:00:00 GMT"},
+            "dttm": dttm.strftime(DTTM_FORMAT),
+            "sha256": "sha",
+            "data": {"i": i},
+        }
+
+    def test_revalidate(self):
+        dump_to_cache(self.record(600), "./cache_freshness_tmp", self.url)
+        session = get_session(0, 0)
+        func = lambda soup: {"i": soup.find("h1").text}
+
+        with requests_mock.Mocker() as m:
+            m.get(self.url, status_code=304, headers={"ETag": '"v2"'})
+            data = dump_scrape_page(
+                session, self.url, 1, func, "./cache_freshness_tmp", True,
+                return_data=True, ttl=3600,
+            )
+            assert m.call_count == 0
+            assert data["data"] == {"i": 0}
+
+            data = dump_scrape_page(
+                session, self.url, 1, func, "./cache_freshness_tmp", True,
+                return_data=True, ttl=60,
+            )
+            assert m.call_count == 1
+            assert m.last_request.headers["If-None-Match"] == '"v1"'
+            assert m.last_request.headers["If-Modified-Since"] == (
+                "Mon, 01 Aug 2022 00:00:00 GMT"
+            )
+
+        # Not modified page keeps its data, and is fresh again
+        assert data["data"] == {"i": 0}
+        assert data["headers"]["ETag"] == '"v2"'
+        stored = restore_from_cache("./cache_freshness_tmp", self.url)
+        assert stored == data
+        assert record_age(stored) < 60
+
+        with requests_mock.Mocker() as m:
+            m.get(self.url, text="<h1>changed</h1>", headers={"ETag": '"v3"'})
+            data = dump_scrape_page(
+                session, self.url, 1, func, "./cache_freshness_tmp", True,
+                return_data=True, ttl=0,
+            )
+            assert m.last_request.headers["If-None-Match"] == '"v2"'
+        assert data["data"] == {"i": "changed"}
+        assert data["sha256"] == hash256("<h1>changed</h1>")
+
+    @pytest.mark.parametrize(
+        "path",
+        [
+            "./cache_freshness_tmp",
+            "./cache_freshness_tmp/cache.sqlite",
+            "./cache_freshness_tmp/data.shards",
+        ],
+    )
+    def test_evict(self, path, monkeypatch):
+        cache = open_cache(path)
+        for i in range(10):
+            cache.put(f"{self.url}/{i}", self.record(i * 100, i))
+        size = sum(cache.sizes().values())
+
+        # Ages are read from the index of the backend, records are not loaded
+        def not_loaded(*args):
+            raise AssertionError("record loaded")
+
+        monkeypatch.setattr(cache, "load", not_loaded)
+        monkeypatch.setattr(cache, "items", not_loaded)
+        assert evict_cache(cache, max_age=750) == (2, 8)
+        assert evict_cache(cache, max_size=size // 2) == (3, 5)
+        monkeypatch.undo()
+        assert sorted(record["data"]["i"] for _, record in cache.items()) == [
+            0, 1, 2, 3, 4
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(evict_scrape_cache, ["--input", path, "--max_age", "150"])
+        assert result.exit_code == 0, result.output
+        assert "Removed 3 records, kept 2" in result.output
+        assert cache.contains([f"{self.url}/{i}" for i in range(10)]) == {
+            f"{self.url}/0",
+            f"{self.url}/1",
+        }
+
+
+class TestCachedLinkIndex:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./cached_links_tmp")
+        self.links = [f"https://www.moscow-restaurants.ru/restaurants/{i}" for i in range(5)]
+
+        class SimpleScraper(BaseLinkScraper):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"heading": cast(Tag, soup.find("h1")).text}
+
+        self.scraper_class = SimpleScraper
+
+        yield
+
+        os.system("rm -rf ./cached_links_tmp")
+
+    def record(self, link: str, ok: bool = True, age: float = 0) -> dict:
+        dttm = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        return {
+            "ok": ok,
+            "url": link,
+            "headers": {"ETag": '"v1"'},
+            "dttm": dttm.strftime(DTTM_FORMAT),
+            "sha256": "sha",
+            "data": {"heading": "cached"},
+        }
+
+    @pytest.mark.parametrize(
+        "path", ["./cached_links_tmp", "./cached_links_tmp/cache.sqlite"]
+    )
+    def test_partition(self, path):
+        cache = open_cache(path)
+        cache.put(self.links[0], self.record(self.links[0]))
+        cache.put(self.links[1], self.record(self.links[1], ok=False))
+        cache.put(self.links[2], self.record(self.links[2], age=7200))
+
+        index = cache.index(map(record_name, self.links))
+        assert {name: entry["ok"] for name, entry in index.items()} == {
+            record_name(self.links[0]): True,
+            record_name(self.links[1]): False,
+            record_name(self.links[2]): True,
+        }
+        assert index[record_name(self.links[2])]["dttm"] == (
+            cache.get(self.links[2])["dttm"]
+        )
+
+        scraper = self.scraper_class(self.links, path, ttl=3600, n_jobs=2)
+        assert scraper.partition_links() == {
+            "hits": self.links[:1],
+            "stale": self.links[2:3],
+            "misses": [self.links[1], *self.links[3:]],
+        }
+
+    def test_chunk_index(self):
+        cache = ChunkDirCache("./cached_links_tmp")
+        record = dict(self.record(self.links[0]), data={"text": "x" * 100000})
+        cache.put(self.links[0], record)
+        filename = os.path.join("./cached_links_tmp", record_name(self.links[0]))
+        with open(filename, "r", encoding="utf-8") as file:
+            text = file.read()
+
+        # Page data after ok and dttm is not read
+        with open(filename, "w", encoding="utf-8") as file:
+            file.write(text[: text.index('"data"') + 20])
+        assert cache.index([record_name(self.links[0])]) == {
+            record_name(self.links[0]): {"ok": True, "dttm": record["dttm"]}
+        }
+
+        assert read_fields(filename, ["url", "headers"], block_size=8) == {
+            "url": self.links[0],
+            "headers": {"ETag": '"v1"'},
+        }
+
+    @pytest.mark.parametrize(
+        "path", ["./cached_links_tmp", "./cached_links_tmp/cache.sqlite"]
+    )
+    def test_load_data(self, path, capsys):
+        cache = open_cache(path)
+        cache.put(self.links[0], self.record(self.links[0]))
+        cache.put(self.links[1], self.record(self.links[1], ok=False))
+        cache.put(self.links[2], self.record(self.links[2], age=7200))
+
+        with requests_mock.Mocker() as m:
+            for link in self.links:
+                m.get(link, text="<h1>fetched</h1>", headers={"ETag": '"v2"'})
+            scraper = self.scraper_class(self.links, path, ttl=3600, n_jobs=2)
+            scraper.load_data()
+            assert m.call_count == 4
+            revalidated = [r for r in m.request_history if r.url == self.links[2]]
+            assert revalidated[0].headers["If-None-Match"] == '"v1"'
+            assert "Cache hits: 1, misses: 3, stale: 1" in capsys.readouterr().out
+
+            # Everything is fresh now, nothing is dispatched
+            scraper = self.scraper_class(self.links, path, ttl=3600, n_jobs=2)
+            scraper.load_data()
+            assert m.call_count == 4
+            assert "Cache hits: 5, misses: 0, stale: 0" in capsys.readouterr().out
+
+        assert restore_from_cache(path, self.links[0])["data"]["heading"] == "cached"
+        assert restore_from_cache(path, self.links[2])["data"]["heading"] == "fetched"
+
+
+from src_rest.scrapying.crawl_state import CrawlState, crawl_state_path
+from src_rest.loaders.data_loaders_scrapy import load_moscow_restaurants
+
+
+class TestCrawlState:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./crawl_state_tmp")
+        self.base = "https://www.moscow-restaurants.ru/restaurants/"
+        self.start = f"{self.base}?curPos=0"
+        self.state = "./crawl_state_tmp/.crawl_state.json"
+        self.n_pages = 12
+
+        yield
+
+        os.system("rm -rf ./crawl_state_tmp")
+
+    def mock_pages(self, m, failing=None):
+        for i in range(self.n_pages):
+            url = f"{self.base}?curPos={i * 7}"
+            if i == failing:
+                m.get(url, exc=requests.exceptions.ConnectionError)
+            else:
+                m.get(url, text=pagination_html(i, self.n_pages))
+
+    def crawler(self, **kwargs):
+        return MosRestCrawler(
+            self.start, output="./crawl_state_tmp", state=self.state, **kwargs
+        )
+
+    def test_state(self):
+        assert crawl_state_path("./data") == "./data/.crawl_state.json"
+        assert crawl_state_path("./data.sqlite") == "./data.sqlite.crawl_state.json"
+
+        state = CrawlState(self.state, interval=3600)
+        state.reset("a")
+        assert state.done("a", 200, ["b/", "c", None, "a/"]) == ["b/", "c"]
+        assert state.done("b/", 404, ["b", "d"]) == ["d"]
+        # Checkpoint interval has not passed
+        assert not os.path.exists(self.state)
+        state.save()
+
+        restored = CrawlState(self.state)
+        assert restored.restore()
+        assert restored.frontier == ["c", "d"]
+        assert restored.visited == {"a": 200, "b/": 404}
+        assert not restored.add("b")
+
+        # Links are visited out of order, the frontier keeps the order found
+        assert restored.add("e")
+        restored.done("d", 200)
+        assert restored.frontier == ["c", "e"]
+        assert restored.next_link() == "c"
+        restored.done("c", 200)
+        restored.done("e", 200)
+        assert not CrawlState(self.state).restore()
+
+    def test_resume_sequential(self):
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m, failing=5)
+            with pytest.raises(requests.exceptions.ConnectionError):
+                self.crawler().load_data()
+            assert m.call_count == 6
+
+        state = load_json(self.state)
+        assert state["frontier"] == [f"{self.base}?curPos=35"]
+        assert len(state["visited"]) == 5
+
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            self.crawler(limit=3).load_data()
+            self.crawler().load_data()
+            urls = [request.url for request in m.request_history]
+
+        # Resumed from the failed page, visited pages are not requested or probed
+        assert urls == [f"{self.base}?curPos={i * 7}" for i in range(5, self.n_pages)]
+        assert load_json(self.state)["frontier"] == []
+        assert len(load_json(self.state)["visited"]) == self.n_pages
+
+    def test_resume_frontier(self):
+        with requests_mock.Mocker() as m:
+            self.mock_pages(m)
+            self.crawler(frontier=True, limit=5, n_jobs=2, cache=False).load_data()
+            assert m.call_count == 5
+            self.crawler(frontier=True, n_jobs=4, cache=False).load_data()
+            urls = [request.url for request in m.request_history]
+
+        assert sorted(urls) == sorted(
+            f"{self.base}?curPos={i * 7}" for i in range(self.n_pages)
+        )
+
+    def test_restart(self):
+        runner = CliRunner()
+        args = ["--output", "./crawl_state_tmp", "--host_rate", "100", "--limit", "2"]
+        with requests_mock.Mocker() as m:
+            start_page = pagination_html(0, self.n_pages)
+            m.get(self.base, text=start_page.replace("?curPos=0", ""))
+            self.mock_pages(m)
+            result = runner.invoke(load_moscow_restaurants, args)
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(load_moscow_restaurants, args)
+            assert "Resuming crawl: 1 pages in frontier, 2 visited" in result.output
+            result = runner.invoke(load_moscow_restaurants, [*args, "--restart"])
+            assert "Resuming" not in result.output
+            urls = [request.url for request in m.request_history]
+
+        assert urls == [
+            self.base,
+            f"{self.base}?curPos=7",
+            f"{self.base}?curPos=14",
+            f"{self.base}?curPos=21",
+            self.base,
+            f"{self.base}?curPos=7",
+        ]
+
+
+
+import glob
+import gzip
+import json
+
+
+class TestShardCache:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        self.path = "./shard_cache_tmp/data.shards"
+        self.urls = [f"https://www.moscow-restaurants.ru/restaurants/{i}" for i in range(10)]
+
+        yield
+
+        os.system("rm -rf ./shard_cache_tmp")
+
+    def record(self, i: int) -> dict:
+        return {"ok": True, "url": self.urls[i], "dttm": "2022-09-09 20:24:22", "i": i}
+
+    def test_rotation(self):
+        cache = ShardCache(self.path, shard_size=3, queue_size=2)
+        for i in range(10):
+            cache.put(self.urls[i], self.record(i))
+        # Records are visible before the writer gets to them
+        assert cache.get(self.urls[9]) == self.record(9)
+        cache.close()
+
+        assert cache.shards() == [f"shard_{i:05d}.jsonl.gz" for i in range(4)]
+        assert len(glob.glob(os.path.join(self.path, "*.index.json"))) == 4
+        # Shards are plain json lines
+        with gzip.open(os.path.join(self.path, "shard_00001.jsonl.gz"), "rt") as file:
+            lines = [json.loads(line) for line in file]
+        assert [line["record"]["i"] for line in lines] == [3, 4, 5]
+
+        # Later records win, removed ones are gone, old shards are not rewritten
+        cache.put(self.urls[0], dict(self.record(0), i=100))
+        cache.remove([record_name(self.urls[1])])
+        cache.close()
+        assert len(cache.shards()) == 5
+
+        reopened = ShardCache(self.path)
+        assert reopened.get(self.urls[0])["i"] == 100
+        assert reopened.get(self.urls[1]) is None
+        assert reopened.contains(self.urls) == set(self.urls) - {self.urls[1]}
+        items = dict(reopened.items())
+        assert len(items) == 9
+        assert items[record_name(self.urls[0])]["i"] == 100
+        assert [len(batch) for batch in reopened.batches()] == [1] * 5
+
+    def test_crash(self):
+        cache = ShardCache(self.path, shard_size=4)
+        for i in range(6):
+            cache.put(self.urls[i], self.record(i))
+        cache.close()
+
+        # Shard cut by a crash, before its index was written
+        shard = os.path.join(self.path, "shard_00001.jsonl.gz")
+        os.remove(os.path.join(self.path, "shard_00001.index.json"))
+        with open(shard, "rb") as file:
+            data = file.read()
+        with open(shard, "wb") as file:
+            file.write(data[: len(data) // 2])
+
+        reopened = ShardCache(self.path)
+        assert reopened.contains(self.urls) == set(self.urls[:4])
+        assert reopened.get(self.urls[2]) == self.record(2)
+
+        # New records go to a new shard
+        reopened.put(self.urls[7], self.record(7))
+        reopened.close()
+        assert reopened.shards()[-1] == "shard_00002.jsonl.gz"
+        assert ShardCache(self.path).get(self.urls[7]) == self.record(7)
+
+    def test_threads(self):
+        cache = ShardCache(self.path, shard_size=50, queue_size=4)
+        urls = [f"https://www.moscow-restaurants.ru/{i}" for i in range(500)]
+        Parallel(n_jobs=8, backend="threading")(
+            delayed(cache.put)(url, {"ok": True, "url": url, "dttm": ""}) for url in urls
+        )
+        cache.close()
+        assert len(cache.shards()) == 10
+        assert ShardCache(self.path).contains(urls) == set(urls)
+
+    def test_members(self):
+        cache = ShardCache(self.path, shard_size=200)
+        urls = [f"https://www.moscow-restaurants.ru/{i}" for i in range(300)]
+        for i, url in enumerate(urls):
+            cache.put(url, {"ok": True, "url": url, "dttm": "", "i": i})
+        cache.close()
+
+        reopened = ShardCache(self.path)
+        entries = reopened.entries()
+        # Records are loaded from their gzip member
+        assert entries[record_name(urls[150])][5:] == [
+            entries[record_name(urls[128])][5],
+            22,
+        ]
+        assert entries[record_name(urls[150])][5] > 0
+        assert reopened.get(urls[150])["i"] == 150
+        assert reopened.get(urls[250])["i"] == 250
+        assert len(dict(reopened.items())) == 300
+
+        # Rotation adds the closed shard to the loaded index
+        reopened.shard_size = 2
+        for url in urls[:3]:
+            reopened.put(url, {"ok": False, "url": url, "dttm": ""})
+        reopened.close()
+        assert reopened._entries is not None
+        assert reopened.index([record_name(urls[0])])[record_name(urls[0])]["ok"] is False
+        assert reopened.entries() == ShardCache(self.path).entries()
+
+    def test_pending_removal(self):
+        cache = ShardCache(self.path)
+        cache.put(self.urls[0], self.record(0))
+        cache.put(self.urls[1], self.record(1))
+        cache.close()
+        cache.remove([record_name(self.urls[0])])
+        # Removed before the writer gets to it
+        assert cache.contains(self.urls[:2]) == {self.urls[1]}
+        assert set(cache.index(map(record_name, self.urls[:2]))) == {
+            record_name(self.urls[1])
+        }
+        cache.close()
+        assert cache.contains(self.urls[:2]) == {self.urls[1]}
+
+    def test_process_backend(self):
+        with pytest.raises(ValueError):
+            MosRestScraper(self.urls, self.path, backend="loky")
+
+
+from src_rest.scrapying.metrics import Histogram, ScrapeMetrics
+
+
+class TestScrapeMetrics:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./metrics_tmp")
+        safe_mkdir("./metrics_tmp/cache")
+
+        class SimpleScraper(BaseLinkScraper):
+            def parse_data(self, soup: BeautifulSoup) -> dict:
+                return {"heading": cast(Tag, soup.find("h1")).text}
+
+        self.scraper_class = SimpleScraper
+
+        yield
+
+        os.system("rm -rf ./metrics_tmp")
+
+    def test_histogram(self):
+        histogram = Histogram([0.1, 1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+        assert histogram.cumulative() == {"0.1": 2, "1": 3, "+Inf": 4}
+        assert histogram.sum == pytest.approx(2.65)
+
+        metrics = ScrapeMetrics(total=4)
+        metrics.response(200, 0.2, 100, 0)
+        metrics.response(200, 0.3, 50, 2)
+        metrics.response(404, 0.4, 10, 0)
+        metrics.page(cache_hit=True, n_pages=2)
+        assert metrics.cache_hit_ratio() == 1
+        assert metrics.latency_quantile(0.5) == 0.5
+
+        text = metrics.to_prometheus()
+        assert "scraper_bytes_total 160" in text
+        assert "scraper_retries_total 2" in text
+        assert 'scraper_responses_total{status="404"} 1' in text
+        assert 'scraper_latency_seconds_bucket{le="0.25"} 1' in text
+        assert "scraper_latency_seconds_count 3" in text
+        assert "Pages: 2/4" in metrics.progress_line()
+
+    def test_progress_rate_limited(self, capsys):
+        metrics = ScrapeMetrics(progress_interval=3600)
+        for _ in range(100):
+            metrics.page(cache_hit=False)
+        assert capsys.readouterr().out == ""
+        metrics.progress(force=True)
+        assert "Pages: 100," in capsys.readouterr().out
+
+    @pytest.mark.parametrize("path", ["metrics.json", "metrics.prom"])
+    def test_scraper(self, path, capsys):
+        path = os.path.join("./metrics_tmp", path)
+        links = [f"https://www.moscow-restaurants.ru/{i}" for i in range(10)]
+        with requests_mock.Mocker() as m:
+            for i, link in enumerate(links):
+                m.get(
+                    link,
+                    text=f"<html><body><h1>Page {i}</h1></body></html>",
+                    status_code=404 if i == 9 else 200,
+                )
+            scraper = self.scraper_class(
+                links[:6], "./metrics_tmp/cache", metrics_path=path
+            )
+            scraper.load_data()
+            scraper = self.scraper_class(links, "./metrics_tmp/cache", metrics_path=path)
+            scraper.load_data()
+
+        # One progress line per run, instead of a line per page
+        assert "Parsing data from" not in capsys.readouterr().out
+        with open(path) as file:
+            text = file.read()
+        if path.endswith(".json"):
+            snapshot = json.loads(text)
+            assert snapshot["pages"] == 10
+            assert snapshot["cache_hits"] == 6
+            assert snapshot["statuses"] == {"200": 3, "404": 1}
+            assert snapshot["parse_seconds"]["count"] == 3
+            assert snapshot["bytes"] > 0
+        else:
+            assert "scraper_cache_hits_total 6" in text
+            assert 'scraper_responses_total{status="404"} 1' in text
+
+    def test_async(self):
+        stats = {"calls": 0, "in_flight": 0, "max_in_flight": 0}
+
+        async def runner():
+            server = TestServer(create_pages_app(stats))
+            await server.start_server()
+            try:
+                links = [str(server.make_url(f"/page/{i}")) for i in [1, 2, "flaky"]]
+                scraper = self.scraper_class(
+                    links, "./metrics_tmp/cache", backend="asyncio", backoff=0
+                )
+                await scraper.load_data_async()
+                return scraper.metrics
+            finally:
+                await server.close()
+
+        metrics = asyncio.run(runner())
+        assert metrics.pages == 3
+        assert metrics.retries == 1
+        assert metrics.latency.count == 3
+        assert metrics.statuses == {200: 3}
+
+
+DETAIL_PAGE = """<html><body><div class="col col_img"><script type="text/javascript">
+myMap.geoObjects.add(new ymaps.Placemark([55.{i:04d}, 37.{i:04d}]));</script></div>
+<div class="data"><div class="row average_check">{i} руб.</div>
+<meta itemprop="streetAddress" content="ул. Тверская, д. {i}"></div>
+<div class="item-review-col_right"><div class="data-text">Отзыв {i}</div></div>
+</body></html>"""
+
+
+class DetailHandler(KeepAliveHandler):
+    def do_GET(self):
+        i = self.path.rsplit("/", 1)[-1]
+        if i == "missing":
+            status, body = 404, "Not found"
+        elif i == "broken":
+            status, body = 200, "<html><body></body></html>"
+        else:
+            status, body = 200, DETAIL_PAGE.format(i=int(i))
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestPipeline:
+    @pytest.fixture(autouse=True)
+    def init_data(self):
+        safe_mkdir("./pipeline_tmp")
+        safe_mkdir("./pipeline_tmp/pipeline")
+        safe_mkdir("./pipeline_tmp/threading")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DetailHandler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+        yield
+
+        self.server.shutdown()
+        self.server.server_close()
+        os.system("rm -rf ./pipeline_tmp")
+
+    def test_pipeline(self, capsys):
+        links = [f"{self.url}/rest/{i}" for i in range(30)] + [f"{self.url}/missing"]
+        for backend in ["pipeline", "threading"]:
+            scraper = MosRestScraper(
+                links,
+                f"./pipeline_tmp/{backend}",
+                backend=backend,
+                n_jobs=4,
+                n_parsers=2,
+                queue_size=2,
+            )
+            scraper.load_data()
+
+        assert "Fetch: 4 workers, 31 pages" in capsys.readouterr().out
+        # Only the pipeline has stages
+        assert scraper.metrics.snapshot()["stages"] == {}
+        assert MosRestScraper(links, "./pipeline_tmp").n_parsers == os.cpu_count()
+
+        pipeline = dict(open_cache("./pipeline_tmp/pipeline").items())
+        threading_ = dict(open_cache("./pipeline_tmp/threading").items())
+        assert len(pipeline) == 31
+        for name, record in pipeline.items():
+            assert record["data"] == threading_[name]["data"]
+        data = restore_from_cache("./pipeline_tmp/pipeline", links[7])
+        assert data["data"]["x_coord"] == 37.0007
+        assert data["data"]["review"] == "Отзыв 7"
+        assert pipeline[record_name(links[-1])]["status_code"] == 404
+
+        # Cached pages are not fetched again
+        scraper = MosRestScraper(links, "./pipeline_tmp/pipeline", backend="pipeline")
+        scraper.load_data()
+        assert scraper.metrics.cache_hits == 30
+
+    def test_stage_metrics(self):
+        links = [f"{self.url}/rest/{i}" for i in range(10)]
+        scraper = MosRestScraper(
+            links, "./pipeline_tmp/pipeline", backend="pipeline", n_jobs=3, n_parsers=1
+        )
+        scraper.load_data()
+        stages = scraper.metrics.snapshot()["stages"]
+        assert stages["fetch"]["workers"] == 3
+        assert stages["fetch"]["items"] == 10
+        assert stages["parse"]["items"] == 10
+        assert 0 < stages["parse"]["utilization"] <= 1
+        assert scraper.metrics.parse_time.count == 10
+        assert 'scraper_stage_workers{stage="parse"} 1' in scraper.metrics.to_prometheus()
+
+    def test_errors(self):
+        links = [f"{self.url}/rest/{i}" for i in range(10)] + [f"{self.url}/broken"]
+        scraper = MosRestScraper(
+            links, "./pipeline_tmp/pipeline", backend="pipeline", n_parsers=1
+        )
+        with pytest.raises(ValueError, match="parse_data failed"):
+            scraper.load_data()
+        assert scraper.metrics.errors == 1
+
+        scraper = MosRestScraper(
+            [f"http://127.0.0.1:{unused_port()}/rest/1"],
+            "./pipeline_tmp/pipeline",
+            backend="pipeline",
+            n_retries=0,
+        )
+        with pytest.raises(requests.exceptions.ConnectionError):
+            scraper.load_data()
@@ -156,6 +156,12 @@ class TestConcatData:
 from pandas import read_csv
 from ast import literal_eval
 from src_rest.transformers.transform_mosdata import *
+from src_rest.loaders.utils import (
+    append_manifest,
+    iter_chunk,
+    reset_manifest,
+    write_chunk,
+)
 
 
 class TestTransformMosdata:
@@ -212,6 +218,134 @@ class TestTransformMosdata:
         assert df["x_coord"][0] == 0
         assert df["PublicPhone"].apply(literal_eval)[0][1] == "2"
 
+    def test_process_mosdata_chunks(self):
+        safe_mkdir("./test_record/raw")
+        records = [dict(self.record, global_id=str(i), Number=i) for i in range(12)]
+        write_chunk("./test_record/raw/chunk_10.jsonl.gz", records[6:], "jsonl.gz")
+        write_chunk("./test_record/raw/chunk_2.json", records[3:6], "json")
+        write_chunk("./test_record/raw/chunk_0.jsonl.gz", records[:3], "jsonl.gz")
+
+        runner = CliRunner()
+        result = runner.invoke(
+            process_mosdata,
+            ["--input", "./test_record/raw", "--output", "./test_record/output.csv"],
+        )
+        assert result.exit_code == 0, result.output
+
+        df = read_csv("./test_record/output.csv")
+        assert df["Number"].tolist() == list(range(12))
+        assert df["y_coord"][11] == 1
+
+    def test_parquet_chunk(self):
+        pytest.importorskip("pyarrow")
+        filename = "./test_record/chunk_0.parquet"
+        assert write_chunk(filename, [self.record, self.record], "parquet") == 2
+        rows = list(iter_chunk(filename))
+        assert rows == [self.record, self.record]
+        assert process_record(rows[0])["PublicPhone"][1] == "2"
+
+    def test_process_record_projected(self):
+        record = {"Number": 0, "global_id": "12233", "Cells": {"a": 1}}
+        result = process_record(record)
+
+        assert result["a"] == 1
+        assert result["x_coord"] is None
+        assert "PublicPhone" not in result
+
+    def test_select_delta(self):
+        records = [
+            {"global_id": 1, "Number": 1},
+            {"global_id": 2, "Number": 5},
+            {"global_id": 3, "Number": 6},
+        ]
+        index = update_index({}, [{"global_id": 1, "Number": 1}])
+        index = update_index(index, [{"global_id": 2, "Number": 2}])
+        index = update_index(index, [{"global_id": 4, "Number": 4}])
+        assert index == {"1": 1, "2": 2, "4": 4}
+
+        delta = select_delta(records, index)
+        assert [item["global_id"] for item in delta["records"]] == [2, 3]
+        assert delta["removed"] == ["4"]
+
+    def test_select_delta_versions(self):
+        records = [
+            {"global_id": 1, "Number": 2},
+            {"global_id": 1, "Number": 4},
+            {"global_id": 1, "Number": 3},
+            {"global_id": 2, "Number": 1},
+        ]
+        delta = select_delta(records, {"2": 1})
+        assert delta["records"] == [{"global_id": 1, "Number": 4}]
+
+        staged = DataFrame([process_record(dict(self.record, global_id="1"))])
+        delta = select_delta(
+            [dict(self.record, global_id="1", Number=i) for i in [3, 5, 4]],
+            {"1": 0},
+        )
+        merged = merge_delta(staged, delta)
+        assert merged.global_id.astype(str).tolist() == ["1"]
+        assert merged.Number.tolist() == [5]
+
+    def test_mosdata_delta(self):
+        record = dict(self.record, Number=1)
+        new_record = dict(self.record, global_id="555", Number=2)
+        safe_mkdir("./test_record/raw")
+        with open("./test_record/raw/chunk_0.json", "w", encoding="utf-8") as file:
+            json.dump([record, new_record], file)
+        with open("./test_record/index.json", "w", encoding="utf-8") as file:
+            json.dump({"12233": 0, "777": 3}, file)
+
+        def run_delta():
+            return CliRunner().invoke(
+                mosdata_delta,
+                [
+                    "--input", "./test_record/raw",
+                    "--index", "./test_record/index.json",
+                    "--output", "./test_record/delta.json",
+                    "--output_index", "./test_record/index_new.json",
+                ],
+            )
+
+        # Records not loaded yet would be taken as removed
+        header = {"step": 2, "format": "json", "columns": None, "filter": None}
+        append_manifest("./test_record/raw", {"header": header})
+        assert isinstance(run_delta().exception, ValueError)
+
+        reset_manifest("./test_record/raw")
+        append_manifest("./test_record/raw", {"header": dict(header, filter="x")})
+        append_manifest("./test_record/raw", {"done": True})
+        assert isinstance(run_delta().exception, ValueError)
+
+        reset_manifest("./test_record/raw")
+        append_manifest("./test_record/raw", {"header": header})
+        append_manifest("./test_record/raw", {"done": True})
+        result = run_delta()
+        assert result.exit_code == 0, result.output
+
+        with open("./test_record/index_new.json", "r", encoding="utf-8") as file:
+            assert json.load(file) == {"12233": 1, "555": 2}
+
+        staged = DataFrame(
+            [
+                process_record(self.record),
+                process_record(dict(self.record, global_id="777")),
+            ]
+        )
+        staged.to_csv("./test_record/staged.csv", index=None)
+
+        result = CliRunner().invoke(
+            merge_mosdata_delta,
+            [
+                "--input", "./test_record/staged.csv",
+                "--delta", "./test_record/delta.json",
+                "--output", "./test_record/merged.csv",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+
+        df = read_csv("./test_record/merged.csv")
+        assert sorted(zip(df.global_id, df.Number)) == [(555, 2), (12233, 1)]
+
 
 from numpy import array
 from pandas import Series
@@ -8,7 +8,7 @@ from typing import Any, List
 
 from pandas import DataFrame, concat, read_csv
 
-from src_rest.loaders.utils import check_paths
+from src_rest.loaders.utils import check_paths, chunk_files, chunk_format, iter_chunk
 
 import logging
 
@@ -31,14 +31,14 @@ def concat_data(input: str, is_list: bool, output: str, format: str) -> None:
     check_paths(input, output)
 
     data: List[Any] = []
-    for filename in glob.glob(os.path.join(input, "*.json")):
-        with open(filename, "r", encoding="utf-8") as file:
-            chunk = json.load(file)
-
+    for filename in chunk_files(input):
         if is_list:
-            data.extend(chunk)
+            data.extend(iter_chunk(filename))
+        elif chunk_format(filename) == "json":
+            with open(filename, "r", encoding="utf-8") as file:
+                data.append(json.load(file))
         else:
-            data.append(chunk)
+            raise ValueError(f"{filename} is a list of records, use --is_list")
 
     if format == "json":
         with open(output, "w", encoding="utf-8") as file:
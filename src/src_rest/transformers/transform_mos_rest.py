@@ -163,8 +163,6 @@ def parse_details(data: dict, fname: str) -> List[ParsedDetails]:
 
 
 import click
-import glob
-import os
 
 from itertools import chain
 
@@ -173,12 +171,17 @@ from urllib.parse import urljoin
 
 from pandas import DataFrame
 
-from src_rest.transformers.utils import load_process_json
+from src_rest.transformers.utils import cache_batches, load_process_records
 from src_rest.loaders.utils import check_paths
 
 
 @click.command()
-@click.option("--input", help="input data folder", type=click.STRING, required=True)
+@click.option(
+    "--input",
+    help="input data folder, sqlite file or json lines shards of a scrape cache",
+    type=click.STRING,
+    required=True,
+)
 @click.option(
     "--output", help="desitnation file to save data", required=True, type=click.STRING
 )
@@ -190,8 +193,8 @@ from src_rest.loaders.utils import check_paths
 )
 def process_mos_rest(input: str, output: str, n_jobs=-1) -> None:
     check_paths(input, output)
-    files = glob.glob(os.path.join(input, "*.json"))
-    result = map(delayed(lambda x: load_process_json(x, parse_data)), files)
+    batches = cache_batches(input)
+    result = map(delayed(lambda x: load_process_records(input, x, parse_data)), batches)
     result = Parallel(n_jobs=n_jobs)(result)
     df = DataFrame(chain(*result), columns=list(ParsedData.__annotations__.keys()))
     base_url = "https://www.moscow-restaurants.ru/"
@@ -201,7 +204,12 @@ def process_mos_rest(input: str, output: str, n_jobs=-1) -> None:
 
 
 @click.command()
-@click.option("--input", help="input data folder", type=click.STRING, required=True)
+@click.option(
+    "--input",
+    help="input data folder, sqlite file or json lines shards of a scrape cache",
+    type=click.STRING,
+    required=True,
+)
 @click.option(
     "--output", help="desitnation file to save data", required=True, type=click.STRING
 )
@@ -213,8 +221,10 @@ def process_mos_rest(input: str, output: str, n_jobs=-1) -> None:
 )
 def process_mos_rest_detailed(input: str, output: str, n_jobs=-1) -> None:
     check_paths(input, output)
-    files = glob.glob(os.path.join(input, "*.json"))
-    result = map(delayed(lambda x: load_process_json(x, parse_details)), files)
+    batches = cache_batches(input)
+    result = map(
+        delayed(lambda x: load_process_records(input, x, parse_details)), batches
+    )
     result = Parallel(n_jobs=n_jobs)(result)
     df = DataFrame(chain(*result), columns=list(ParsedDetails.__annotations__.keys()))
     df.to_csv(output, index=None)
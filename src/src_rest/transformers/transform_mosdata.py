@@ -1,37 +1,152 @@
 import json
+import os
 import click
-from pandas import DataFrame, NA, read_csv, Series
+from pandas import DataFrame, NA, concat, read_csv, Series
 
-from src_rest.loaders.utils import check_paths
+from src_rest.loaders.utils import check_paths, iter_chunks, read_finished_header
+from typing import Dict, Iterable
 
 
 def process_record(item: dict) -> dict:
 
     result = {"global_id": item["global_id"], "Number": item["Number"]}
     result.update(item["Cells"])
-    result["x_coord"] = result["geoData"]["coordinates"][0]
-    result["y_coord"] = result["geoData"]["coordinates"][1]
-    result["PublicPhone"] = list(
-        map(lambda x: list(x.values())[0], result["PublicPhone"])
-    )
-    del result["geoData"]
+    # geoData and PublicPhone may be projected out by the loader
+    geo_data = result.pop("geoData", None)
+    if geo_data is not None:
+        result["x_coord"] = geo_data["coordinates"][0]
+        result["y_coord"] = geo_data["coordinates"][1]
+    else:
+        result["x_coord"] = None
+        result["y_coord"] = None
+    if "PublicPhone" in result:
+        result["PublicPhone"] = list(
+            map(lambda x: list(x.values())[0], result["PublicPhone"])
+        )
     return result
 
 
 @click.command()
-@click.option("--input", help="Input data path", type=click.STRING, required=True)
+@click.option(
+    "--input",
+    help="Input data path, json file or folder of raw chunks",
+    type=click.STRING,
+    required=True,
+)
 @click.option("--output", help="Output data path", type=click.STRING, required=True)
 def process_mosdata(input: str, output: str) -> None:
-    with open(input, "r", encoding="utf-8") as file:
-        data = json.load(file)
-
     check_paths(input, output)
 
+    if os.path.isdir(input):
+        # Chunks are read one by one, only processed records are kept in memory
+        data: Iterable[dict] = iter_chunks(input)
+    else:
+        with open(input, "r", encoding="utf-8") as file:
+            data = json.load(file)
+
     data_expanded = DataFrame(list(map(process_record, data)))
     data_expanded = data_expanded.replace([None], NA)
     data_expanded.to_csv(output, index=None)
 
 
+INDEX_TYPE = Dict[str, int]
+
+
+def update_index(index: INDEX_TYPE, records: Iterable[dict]) -> INDEX_TYPE:
+    for item in records:
+        key = str(item["global_id"])
+        index[key] = max(index.get(key, item["Number"]), item["Number"])
+    return index
+
+
+def select_delta(records: Iterable[dict], index: INDEX_TYPE) -> Dict[str, list]:
+    """Records, which are new or have greater Number than in index,
+    the latest one per global_id, and global_ids from index not found in records"""
+    changed: Dict[str, dict] = {}
+    seen = set()
+    for item in records:
+        key = str(item["global_id"])
+        seen.add(key)
+        if key in index and item["Number"] <= index[key]:
+            continue
+        if key not in changed or item["Number"] > changed[key]["Number"]:
+            changed[key] = item
+    removed = [key for key in index if key not in seen]
+    return {"records": list(changed.values()), "removed": removed}
+
+
+@click.command()
+@click.option(
+    "--input", help="Input raw chunks folder", type=click.STRING, required=True
+)
+@click.option(
+    "--index",
+    help="global_id -> Number index of previous snapshot, may not exist",
+    type=click.STRING,
+    required=True,
+)
+@click.option("--output", help="Output delta path", type=click.STRING, required=True)
+@click.option(
+    "--output_index", help="Output index path", type=click.STRING, required=True
+)
+def mosdata_delta(input: str, index: str, output: str, output_index: str) -> None:
+    check_paths(input, output)
+    check_paths(input, output_index)
+
+    # Records missing from a partial or filtered load would be taken as removed
+    header = read_finished_header(input)
+    if header is None or header.get("filter") is not None:
+        raise ValueError(
+            f"Load in {input} is not finished or is filtered, "
+            "delta needs a full load of the dataset"
+        )
+
+    if os.path.exists(index):
+        with open(index, "r", encoding="utf-8") as file:
+            prev_index: INDEX_TYPE = json.load(file)
+    else:
+        prev_index = {}
+
+    delta = select_delta(iter_chunks(input), prev_index)
+    print(
+        f"Changed records: {len(delta['records'])}, "
+        f"removed records: {len(delta['removed'])}"
+    )
+
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(delta, file)
+
+    new_index = update_index(dict(prev_index), delta["records"])
+    for key in delta["removed"]:
+        del new_index[key]
+    with open(output_index, "w", encoding="utf-8") as file:
+        json.dump(new_index, file)
+
+
+def merge_delta(df: DataFrame, delta: Dict[str, list]) -> DataFrame:
+    df_delta = DataFrame(list(map(process_record, delta["records"])))
+    df_delta = df_delta.replace([None], NA)
+    outdated = set(delta["removed"])
+    if len(df_delta):
+        outdated |= set(df_delta.global_id.astype(str))
+    df = df.loc[~df.global_id.astype(str).isin(outdated)]
+    return concat([df, df_delta], ignore_index=True)
+
+
+@click.command()
+@click.option("--input", help="Staged data path", type=click.STRING, required=True)
+@click.option("--delta", help="Delta data path", type=click.STRING, required=True)
+@click.option("--output", help="Output data path", type=click.STRING, required=True)
+def merge_mosdata_delta(input: str, delta: str, output: str) -> None:
+    check_paths(input, output)
+    check_paths(delta, output)
+
+    with open(delta, "r", encoding="utf-8") as file:
+        delta_data = json.load(file)
+
+    read_csv(input).pipe(merge_delta, delta_data).to_csv(output, index=None)
+
+
 import re
 
 from src_rest.transformers.utils import (
@@ -61,6 +61,30 @@ def load_process_json(
     return func(data, basename)
 
 
+from src_rest.scrapying.cache import open_cache
+
+
+def load_process_records(
+    input: str, batch: list, func: Callable[[dict, str], list]
+) -> list:
+    """Processed records of a batch of a scrape cache: json files directory,
+    sqlite file or json lines shards"""
+    cache = open_cache(input)
+    result = []
+    for name, record in cache.iter_batch(batch):
+        result.extend(func(record, name))
+    cache.close()
+    return result
+
+
+def cache_batches(input: str, n_batches: int = 64) -> List[list]:
+    """Batches of a scrape cache, so that each job opens the cache once"""
+    cache = open_cache(input)
+    batches = cache.batches(n_batches)
+    cache.close()
+    return batches
+
+
 from typing import Union
 from pandas import Series
 from numpy import ndarray, radians, sin, cos, arcsin, sqrt